@@ -0,0 +1,319 @@
+"""Benchmarks for the DFA operations and L* learning.
+
+Run with ``python benchmarks/run.py`` (or ``nox -s bench``). Each
+benchmark is run several times, and we report the best and median wall
+clock times, along with any counts the benchmark reports (e.g. the number
+of membership queries made while learning). Everything is seeded, so the
+work done is the same on every run.
+
+Results are compared against the baselines stored in ``baselines.json``
+next to this file, if there are any. Pass ``--save-baseline`` to replace
+them with the results of this run. Timings are only comparable on the
+same machine, but counts should match exactly everywhere, so a change
+in them always indicates a change in behaviour.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from random import Random
+
+from drmaciver_junkdrawer.dfa import ConcreteDFA, MultiPatternDFA
+from drmaciver_junkdrawer.lstar import LStar
+
+BASELINES = Path(__file__).parent / "baselines.json"
+
+# Each benchmark is a function which takes a scale factor for the size of
+# the problem, does any setup, and returns a function to be timed. That
+# function may return a dict of counts to report alongside the time. As
+# many operations cache their results, setup is rerun for every timing.
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def scaled(n, scale):
+    return max(1, int(n * scale))
+
+
+def random_dfa(random, states, transitions_per_state, accepting_fraction=0.3):
+    """Returns a random ConcreteDFA in which each state has transitions on
+    ``transitions_per_state`` randomly chosen bytes."""
+    return ConcreteDFA(
+        [
+            {
+                c: random.randrange(states)
+                for c in random.sample(range(256), transitions_per_state)
+            }
+            for _ in range(states)
+        ],
+        {i for i in range(states) if random.random() < accepting_fraction} or {0},
+    )
+
+
+def total_random_dfa(random, states, alphabet):
+    """Returns a random ConcreteDFA over the bytes in ``range(alphabet)``
+    in which every state has a transition on every one of them, so that
+    it matches infinitely many strings of most lengths."""
+    return ConcreteDFA(
+        [{c: random.randrange(states) for c in range(alphabet)} for _ in range(states)],
+        {i for i in range(states) if random.random() < 0.5} or {0},
+    )
+
+
+# Languages of the sort people actually write regexes for. The last is
+# the classic example of a language whose minimal DFA is exponentially
+# larger than the regex.
+REGEXES = [
+    rb"[a-z_][a-z0-9_]*",
+    rb"-?[0-9]+(?:\.[0-9]+)?(?:e[+-]?[0-9]+)?",
+    rb"(?:ab|ba|c)*",
+    rb"[ab]*a[ab]{4}",
+]
+
+
+@benchmark
+def matches_random_dfa(scale):
+    random = Random(0)
+    dfa = total_random_dfa(random, scaled(2000, scale), 8)
+    strings = [
+        bytes(random.randrange(8) for _ in range(100))
+        for _ in range(scaled(2000, scale))
+    ]
+
+    def run():
+        for s in strings:
+            dfa.matches(s)
+
+    return run
+
+
+@benchmark
+def matches_compiled_regex(scale):
+    random = Random(0)
+    dfa = ConcreteDFA.from_regex(REGEXES[3]).compile()
+    strings = [
+        bytes(random.choice(b"ab") for _ in range(100))
+        for _ in range(scaled(20000, scale))
+    ]
+
+    def run():
+        for s in strings:
+            dfa.matches(s)
+
+    return run
+
+
+@benchmark
+def all_matching_regions(scale):
+    random = Random(0)
+    dfa = ConcreteDFA(*_regex_parts(REGEXES[1]))
+    text = bytes(random.choice(b"0123456789.-e ") for _ in range(scaled(20000, scale)))
+
+    def run():
+        return {"regions": len(dfa.all_matching_regions(text))}
+
+    return run
+
+
+@benchmark
+def scan_many_patterns(scale):
+    random = Random(0)
+    patterns = [ConcreteDFA.from_regex(pattern) for pattern in REGEXES[:3]] * 10
+    text = bytes(random.choice(b"ab_c09.-e ") for _ in range(scaled(5000, scale)))
+
+    def run():
+        scanner = MultiPatternDFA(patterns)
+        return {"matches": sum(1 for _ in scanner.scan(text))}
+
+    return run
+
+
+@benchmark
+def count_strings(scale):
+    dfa = total_random_dfa(Random(0), scaled(500, scale), 4)
+    length = scaled(200, scale)
+
+    def run():
+        return {"count_digits": len(str(dfa.count_strings(dfa.start, length)))}
+
+    return run
+
+
+@benchmark
+def max_length(scale):
+    # Every transition goes to a later state, so max_length is finite and
+    # has to consider many long paths.
+    random = Random(0)
+    n = scaled(5000, scale)
+    dfa = ConcreteDFA(
+        [
+            {c: random.randrange(i + 1, n) for c in random.sample(range(256), 3)}
+            for i in range(n - 1)
+        ]
+        + [{}],
+        {n - 1},
+    )
+
+    def run():
+        return {"max_length": dfa.max_length(dfa.start)}
+
+    return run
+
+
+@benchmark
+def equivalent(scale):
+    random = Random(0)
+    dfa = random_dfa(random, scaled(5000, scale), 20)
+    # Same language, but with every transition table converted to
+    # the other representation, so nothing can be shared between them.
+    other = ConcreteDFA(
+        [sorted(dfa.raw_transitions(i)) for i in range(len(dfa))],
+        {i for i in range(len(dfa)) if dfa.is_accepting(i)},
+    )
+
+    def run():
+        assert dfa.equivalent(other)
+
+    return run
+
+
+@benchmark
+def canonicalise(scale):
+    dfa = random_dfa(Random(0), scaled(2000, scale), 10)
+
+    def run():
+        return {"states": len(dfa.canonicalise())}
+
+    return run
+
+
+def _regex_parts(pattern):
+    dfa = ConcreteDFA.from_regex(pattern)
+    return (
+        [list(dfa.raw_transitions(i)) for i in range(len(dfa))],
+        {i for i in range(len(dfa)) if dfa.is_accepting(i)},
+    )
+
+
+def learning_benchmark(pattern, delay=0.0):
+    """Returns a benchmark that learns the language of ``pattern`` with L*,
+    using ``distinguishing_string`` as the equivalence oracle, and an oracle
+    for membership queries that takes ``delay`` seconds to answer."""
+
+    def setup(scale):
+        target = ConcreteDFA.from_regex(pattern)
+        queries = 0
+
+        def member(s):
+            nonlocal queries
+            queries += 1
+            if delay:
+                time.sleep(delay)
+            return target.matches(s)
+
+        def run():
+            learner = LStar(member)
+            counterexamples = 0
+            while True:
+                s = target.distinguishing_string(learner.dfa)
+                if s is None:
+                    break
+                counterexamples += 1
+                learner.learn(s)
+            return {"queries": queries, "counterexamples": counterexamples}
+
+        return run
+
+    return setup
+
+
+for i, pattern in enumerate(REGEXES):
+    BENCHMARKS[f"lstar_learn_regex_{i}"] = learning_benchmark(pattern)
+BENCHMARKS["lstar_learn_slow_oracle"] = learning_benchmark(REGEXES[2], delay=0.001)
+
+
+def run_benchmark(fn, scale, repeat):
+    times = []
+    counts = {}
+    for _ in range(repeat):
+        run = fn(scale)
+        start = time.perf_counter()
+        counts = run() or {}
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "counts": counts}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="Only run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply problem sizes by this. Results are only compared "
+        "against baselines taken at the same scale.",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINES)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    names = args.names or list(BENCHMARKS)
+
+    baselines = {}
+    if args.baseline.exists():
+        stored = json.loads(args.baseline.read_text())
+        if stored["scale"] == args.scale:
+            baselines = stored["results"]
+
+    results = {}
+    print(f"{'benchmark':<28} {'best':>9} {'median':>9} {'vs baseline':>12}  counts")
+    for name in names:
+        result = run_benchmark(BENCHMARKS[name], args.scale, args.repeat)
+        results[name] = result
+        comparison = ""
+        baseline = baselines.get(name)
+        if baseline is not None:
+            comparison = f"{result['best'] / baseline['best']:.2f}x"
+            if baseline["counts"] != result["counts"]:
+                comparison += " !"
+        counts = " ".join(f"{k}={v}" for k, v in result["counts"].items())
+        print(
+            f"{name:<28} {result['best']:>8.4f}s {result['median']:>8.4f}s "
+            f"{comparison:>12}  {counts}",
+            flush=True,
+        )
+        if baseline is not None and baseline["counts"] != result["counts"]:
+            print(f"    counts differ from baseline: {baseline['counts']}")
+
+    if args.save_baseline:
+        if baselines:
+            results = {**baselines, **results}
+        args.baseline.write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "scale": args.scale,
+                    "results": results,
+                },
+                indent=2,
+                sort_keys=True,
+            )
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -63,3 +63,10 @@ def tests(session: Session) -> None:
         if session.interactive and not session.posargs:
             session.run("coverage", "combine")
             session.run("coverage", "report", "--show-missing", "--fail-under=100")
+
+
+@session(python=python_versions[0])
+def bench(session: Session) -> None:
+    """Run the benchmarks, comparing against the stored baselines."""
+    session.install("-e", ".")
+    session.run("python", "benchmarks/run.py", *session.posargs)
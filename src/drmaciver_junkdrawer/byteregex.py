@@ -0,0 +1,446 @@
+"""Compiles a subset of Python's byte regular expression syntax to a
+deterministic automaton, by parsing it, building a nondeterministic
+automaton with Thompson's construction, and then determinising that
+with the subset construction.
+
+Patterns always match whole strings, as with ``re.fullmatch``.
+
+The supported syntax is:
+
+* Literal bytes, and ``\\`` followed by any ASCII punctuation for that
+  character literally.
+* The escapes ``\\a \\f \\n \\r \\t \\v``, ``\\xhh`` and octal escapes
+  ``\\0``, ``\\0o`` or ``\\ooo``.
+* The classes ``.`` (any byte except ``\\n``), ``\\d \\D \\s \\S \\w \\W``
+  (with their ASCII meanings) and ``[...]`` or ``[^...]``.
+* Groups, either capturing or as ``(?:...)`` and ``(?P<name>...)``.
+  These only affect precedence.
+* Alternation with ``|``.
+* The quantifiers ``* + ?`` and ``{m}``, ``{m,}``, ``{,n}`` and
+  ``{m,n}``, optionally followed by ``?``, which makes no difference
+  to what is matched.
+
+Anything else (e.g. anchors, lookarounds or backreferences) raises a
+``ValueError``.
+"""
+
+from collections import Counter
+
+MAX_BYTE = 255
+
+# Each byte set is represented as a sorted list of disjoint inclusive
+# ranges ``(u, v)``.
+DIGITS = [(ord("0"), ord("9"))]
+WORD = [
+    (ord("0"), ord("9")),
+    (ord("A"), ord("Z")),
+    (ord("_"), ord("_")),
+    (ord("a"), ord("z")),
+]
+SPACE = [(9, 13), (32, 32)]
+
+SIMPLE_ESCAPES = {
+    ord("a"): 7,
+    ord("f"): 12,
+    ord("n"): 10,
+    ord("r"): 13,
+    ord("t"): 9,
+    ord("v"): 11,
+}
+
+OCTAL_DIGITS = b"01234567"
+
+
+def normalize_ranges(ranges):
+    """Returns ``ranges`` sorted, with overlapping or adjacent ranges
+    merged together."""
+    result = []
+    for u, v in sorted(ranges):
+        if result and u <= result[-1][1] + 1:
+            result[-1] = (result[-1][0], max(v, result[-1][1]))
+        else:
+            result.append((u, v))
+    return result
+
+
+def complement_ranges(ranges):
+    """Returns the ranges of bytes not in the normalized ``ranges``."""
+    result = []
+    start = 0
+    for u, v in ranges:
+        if start < u:
+            result.append((start, u - 1))
+        start = v + 1
+    if start <= MAX_BYTE:
+        result.append((start, MAX_BYTE))
+    return result
+
+
+CLASS_ESCAPES = {
+    ord("d"): DIGITS,
+    ord("D"): complement_ranges(DIGITS),
+    ord("s"): SPACE,
+    ord("S"): complement_ranges(SPACE),
+    ord("w"): WORD,
+    ord("W"): complement_ranges(WORD),
+}
+
+NOT_NEWLINE = complement_ranges([(10, 10)])
+
+
+class Parser:
+    """Parses a byte regex into a syntax tree, whose nodes are tuples:
+
+    * ``("set", ranges)`` matches a single byte in ``ranges``.
+    * ``("concat", children)`` matches each child in turn.
+    * ``("alt", children)`` matches any one of the children.
+    * ``("repeat", child, lo, hi)`` matches between ``lo`` and ``hi``
+      copies of child, where ``hi`` may be None for no upper bound.
+    """
+
+    def __init__(self, pattern):
+        self.__pattern = pattern
+        self.__index = 0
+
+    def error(self, message):
+        return ValueError(f"{message} at position {self.__index} in {self.__pattern!r}")
+
+    def parse(self):
+        result = self.__alternation()
+        if self.__index < len(self.__pattern):
+            # The only thing that can stop an alternation early is
+            # an unmatched closing parenthesis.
+            raise self.error("Unbalanced parenthesis")
+        return result
+
+    def __peek(self):
+        if self.__index < len(self.__pattern):
+            return self.__pattern[self.__index]
+        return None
+
+    def __next(self):
+        c = self.__peek()
+        if c is None:
+            raise self.error("Unexpected end of pattern")
+        self.__index += 1
+        return c
+
+    def __accept(self, c):
+        if self.__peek() == c:
+            self.__index += 1
+            return True
+        return False
+
+    def __alternation(self):
+        children = [self.__concatenation()]
+        while self.__accept(ord("|")):
+            children.append(self.__concatenation())
+        if len(children) == 1:
+            return children[0]
+        return ("alt", children)
+
+    def __concatenation(self):
+        children = []
+        while self.__peek() not in (None, ord("|"), ord(")")):
+            children.append(self.__repetition())
+        if len(children) == 1:
+            return children[0]
+        return ("concat", children)
+
+    def __repetition(self):
+        result = self.__atom()
+        bounds = self.__quantifier()
+        if bounds is None:
+            return result
+        lo, hi = bounds
+        if hi is not None and hi < lo:
+            raise self.error("Min repeat greater than max repeat")
+        # A trailing ? makes a quantifier lazy, which doesn't change the
+        # language matched, but a trailing + makes it possessive, which
+        # does and isn't something we can support.
+        self.__accept(ord("?"))
+        if self.__peek() in (ord("*"), ord("+"), ord("?")) or self.__quantifier(
+            peek=True
+        ):
+            raise self.error("Multiple repeat")
+        return ("repeat", result, lo, hi)
+
+    def __quantifier(self, peek=False):
+        """Parses a quantifier if there is one at the current position,
+        returning its bounds, or returns None otherwise. If ``peek`` is
+        True, the position is left unchanged."""
+        start = self.__index
+        c = self.__peek()
+        if c == ord("*"):
+            bounds = (0, None)
+        elif c == ord("+"):
+            bounds = (1, None)
+        elif c == ord("?"):
+            bounds = (0, 1)
+        elif c == ord("{"):
+            # As with the re module, a { that doesn't start a valid
+            # repetition is just a literal.
+            end = self.__pattern.find(b"}", start)
+            if end <= start + 1:
+                return None
+            lo, comma, hi = self.__pattern[start + 1 : end].partition(b",")
+            if not all(part.isdigit() for part in (lo, hi) if part):
+                return None
+            lo = int(lo or 0)
+            if comma:
+                hi = int(hi) if hi else None
+            else:
+                hi = lo
+            bounds = (lo, hi)
+            self.__index = end
+        else:
+            return None
+        self.__index += 1
+        if peek:
+            self.__index = start
+        return bounds
+
+    def __atom(self):
+        c = self.__next()
+        if c == ord("("):
+            return self.__group()
+        if c == ord("["):
+            return ("set", self.__character_class())
+        if c == ord("."):
+            return ("set", NOT_NEWLINE)
+        if c == ord("\\"):
+            return ("set", self.__escape(in_class=False))
+        if c in b"*+?":
+            raise self.error("Nothing to repeat")
+        if c == ord("{"):
+            self.__index -= 1
+            if self.__quantifier(peek=True) is not None:
+                raise self.error("Nothing to repeat")
+            self.__index += 1
+        if c in b"^$":
+            raise self.error("Anchors are not supported")
+        return ("set", [(c, c)])
+
+    def __group(self):
+        if self.__accept(ord("?")):
+            if self.__accept(ord(":")):
+                pass
+            elif self.__accept(ord("P")) and self.__accept(ord("<")):
+                end = self.__pattern.find(b">", self.__index)
+                name = self.__pattern[self.__index : end]
+                if end < 0 or not name.decode("ascii", "replace").isidentifier():
+                    raise self.error("Bad group name")
+                self.__index = end + 1
+            else:
+                raise self.error("Unsupported group extension")
+        result = self.__alternation()
+        if not self.__accept(ord(")")):
+            raise self.error("Missing )")
+        return result
+
+    def __character_class(self):
+        negated = self.__accept(ord("^"))
+        ranges = []
+        first = True
+        while True:
+            c = self.__next()
+            if c == ord("]") and not first:
+                break
+            first = False
+            if c == ord("\\"):
+                items = self.__escape(in_class=True)
+            else:
+                items = [(c, c)]
+            if (
+                len(items) == 1
+                and items[0][0] == items[0][1]
+                and self.__peek() == ord("-")
+                and self.__index + 1 < len(self.__pattern)
+                and self.__pattern[self.__index + 1] != ord("]")
+            ):
+                self.__index += 1
+                d = self.__next()
+                if d == ord("\\"):
+                    end = self.__escape(in_class=True)
+                    if len(end) != 1 or end[0][0] != end[0][1]:
+                        raise self.error("Bad character range")
+                    d = end[0][0]
+                if d < items[0][0]:
+                    raise self.error("Bad character range")
+                items = [(items[0][0], d)]
+            ranges.extend(items)
+        ranges = normalize_ranges(ranges)
+        if negated:
+            ranges = complement_ranges(ranges)
+        return ranges
+
+    def __escape(self, in_class):
+        """Parses the rest of an escape sequence after the backslash,
+        returning the ranges of bytes it matches."""
+        c = self.__next()
+        if c in CLASS_ESCAPES:
+            return CLASS_ESCAPES[c]
+        if c in SIMPLE_ESCAPES:
+            result = SIMPLE_ESCAPES[c]
+        elif in_class and c == ord("b"):
+            result = 8
+        elif c == ord("x"):
+            digits = self.__pattern[self.__index : self.__index + 2]
+            if len(digits) != 2 or not all(
+                d in b"0123456789abcdefABCDEF" for d in digits
+            ):
+                raise self.error("Incomplete escape \\x")
+            self.__index += 2
+            result = int(digits, 16)
+        elif c in OCTAL_DIGITS and (c == ord("0") or self.__octal_digits_follow(2)):
+            # As with the re module, \0 may be followed by up to two more
+            # octal digits, but otherwise an octal escape needs exactly
+            # three as it would be a backreference otherwise.
+            digits = [c]
+            while len(digits) < 3 and self.__octal_digits_follow(1):
+                digits.append(self.__next())
+            result = int(bytes(digits), 8)
+            if result > MAX_BYTE:
+                raise self.error("Octal escape out of range")
+        elif c < 128 and chr(c).isalnum():
+            raise self.error(f"Unsupported escape \\{chr(c)}")
+        else:
+            result = c
+        return [(result, result)]
+
+    def __octal_digits_follow(self, n):
+        following = self.__pattern[self.__index : self.__index + n]
+        return len(following) == n and all(d in OCTAL_DIGITS for d in following)
+
+
+class NFA:
+    """A nondeterministic automaton with epsilon transitions, built from
+    a syntax tree produced by ``Parser``."""
+
+    def __init__(self, tree):
+        self.epsilons = []
+        self.edges = []
+        self.start = self.__new_state()
+        self.accept = self.__build(tree, self.start)
+
+    def __new_state(self):
+        self.epsilons.append([])
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def __build(self, tree, start):
+        """Adds states matching ``tree`` starting from ``start``, and
+        returns the state that they end at."""
+        kind = tree[0]
+        if kind == "set":
+            end = self.__new_state()
+            self.edges[start].append((tree[1], end))
+            return end
+        if kind == "concat":
+            for child in tree[1]:
+                start = self.__build(child, start)
+            return start
+        if kind == "alt":
+            end = self.__new_state()
+            for child in tree[1]:
+                child_start = self.__new_state()
+                self.epsilons[start].append(child_start)
+                self.epsilons[self.__build(child, child_start)].append(end)
+            return end
+        assert kind == "repeat"
+        _, child, lo, hi = tree
+        for _ in range(lo):
+            start = self.__build(child, start)
+        if hi is None:
+            # We go through a fresh state so that the loop back can't
+            # skip any of the required copies above.
+            loop = self.__new_state()
+            self.epsilons[start].append(loop)
+            self.epsilons[self.__build(child, loop)].append(loop)
+            return loop
+        end = self.__new_state()
+        for _ in range(hi - lo):
+            self.epsilons[start].append(end)
+            start = self.__build(child, start)
+        self.epsilons[start].append(end)
+        return end
+
+    def closure(self, states):
+        """Returns the set of states reachable from ``states`` by
+        following epsilon transitions."""
+        result = set(states)
+        stack = list(states)
+        while stack:
+            for j in self.epsilons[stack.pop()]:
+                if j not in result:
+                    result.add(j)
+                    stack.append(j)
+        return frozenset(result)
+
+
+def compile_regex(pattern):
+    """Compiles ``pattern``, a ``bytes`` regex, returning a pair
+    ``(transitions, accepting)`` in the form accepted by ``ConcreteDFA``,
+    with state 0 as the start state.
+
+    Each state's transitions are a list of ``(u, v, j)`` ranges (or
+    ``(c, j)`` for single bytes), omitting any bytes that don't
+    transition anywhere."""
+    if not isinstance(pattern, bytes):
+        raise TypeError(f"Expected a bytes pattern but got {pattern!r}")
+    nfa = NFA(Parser(pattern).parse())
+
+    # Maps each set of NFA states we've seen to its DFA state, and
+    # remembers the closure of each set of targets that we've already
+    # calculated, as many different sets of states will have
+    # transitions with the same targets.
+    states = {}
+    closures = {}
+    subsets = []
+
+    def state_for(targets):
+        try:
+            subset = closures[targets]
+        except KeyError:
+            subset = closures[targets] = nfa.closure(targets)
+        try:
+            return states[subset]
+        except KeyError:
+            states[subset] = len(subsets)
+            subsets.append(subset)
+            return states[subset]
+
+    state_for(frozenset([nfa.start]))
+    transitions = []
+    accepting = set()
+    i = 0
+    while i < len(subsets):
+        subset = subsets[i]
+        if nfa.accept in subset:
+            accepting.add(i)
+
+        # We sweep over the bytes in order, tracking which targets are
+        # active in each interval between consecutive range boundaries.
+        events = Counter()
+        changes = {}
+        for s in subset:
+            for ranges, j in nfa.edges[s]:
+                for u, v in ranges:
+                    changes.setdefault(u, Counter())[j] += 1
+                    changes.setdefault(v + 1, Counter())[j] -= 1
+        # Every NFA state is the target of a single edge, whose ranges are
+        # normalized, so the active targets change at every boundary and
+        # adjacent intervals never need merging.
+        table = []
+        boundaries = sorted(changes)
+        for u, v in zip(boundaries, boundaries[1:]):
+            events.update(changes[u])
+            active = frozenset(j for j, n in events.items() if n > 0)
+            if not active:
+                continue
+            j = state_for(active)
+            table.append((u, j) if u == v - 1 else (u, v - 1, j))
+        transitions.append(table)
+        i += 1
+
+    return transitions, accepting
@@ -0,0 +1,476 @@
+"""A lazily calculated DFA whose states are regular expressions, using
+Brzozowski derivatives to calculate its transitions.
+
+The derivative of a language ``L`` with respect to a byte ``c`` is the
+language of strings ``s`` such that ``c + s`` is in ``L``, and it is
+straightforward to calculate syntactically for regular expressions
+(including ones using intersection and complement, which are awkward
+to support with the usual NFA based constructions). Taking regular
+expressions as states and derivatives as transitions gives a DFA, which
+is guaranteed to be finite as long as we keep expressions in a form
+where equivalent unions are recognised as the same state.
+
+The nice thing about this is that it only ever calculates the states
+that are actually reached, so languages whose full DFA would be
+exponentially large (e.g. intersections of many patterns) are fine to
+use as long as we only look at a small part of them.
+
+The relevant paper is:
+
+* Owens, Scott, John Reppy, and Aaron Turon. "Regular-expression
+  derivatives re-examined." Journal of Functional Programming 19.2
+  (2009): 173-190.
+
+which describes the simplifications we use to keep the number of
+states finite (and, in practice, small).
+"""
+
+import threading
+from itertools import count
+from weakref import WeakValueDictionary
+
+from drmaciver_junkdrawer.byteregex import MAX_BYTE, Parser, normalize_ranges
+from drmaciver_junkdrawer.dfa import ALPHABET_SIZE, DEAD, DFA, cached
+
+# Every term is interned, so that structurally equal terms are always
+# the same object. This means that terms can be compared and hashed by
+# identity, which is much cheaper than comparing them structurally, and
+# matters because we use them as states (and so as cache keys).
+TERMS: WeakValueDictionary[tuple, "Term"] = WeakValueDictionary()
+TERMS_LOCK = threading.Lock()
+SERIAL_NUMBERS = count()
+
+
+class Term:
+    """A regular expression over bytes, in a canonical form. Terms should
+    only be created with the functions in this module, never directly.
+
+    Terms support ``|``, ``&``, ``+`` and ``~`` for union, intersection,
+    concatenation and complement respectively."""
+
+    __slots__ = ("kind", "args", "nullable", "boolean", "order", "__weakref__")
+
+    def __init__(self, kind, args, nullable, order):
+        self.kind = kind
+        self.args = args
+        # Whether this term matches the empty string.
+        self.nullable = nullable
+        # Whether this term contains any intersections or complements.
+        # If not, it matches some string unless it is EMPTY.
+        self.boolean = kind in ("intersection", "complement") or any(
+            isinstance(t, Term) and t.boolean for t in args
+        )
+        # Used to sort the children of unions and intersections so
+        # that they have a canonical order.
+        self.order = order
+
+    def __reduce__(self):
+        # Interning is per process, so we must go back through the
+        # constructors when unpickling.
+        return (rebuild_term, (self.kind, self.args))
+
+    def __or__(self, other):
+        return union(self, other)
+
+    def __and__(self, other):
+        return intersection(self, other)
+
+    def __add__(self, other):
+        return concatenation(self, other)
+
+    def __invert__(self):
+        return complement(self)
+
+    def __repr__(self):
+        if self.kind == "set":
+            return repr_ranges(self.args)
+        if self.kind == "epsilon":
+            return "()"
+        if self.kind == "concat":
+            return "".join(map(repr_operand, self.args))
+        if self.kind == "union":
+            return "|".join(map(repr, self.args))
+        if self.kind == "intersection":
+            return "&".join(map(repr_operand, self.args))
+        if self.kind == "complement":
+            return "~" + repr_operand(self.args[0])
+        assert self.kind == "repeat"
+        child, lo, hi = self.args
+        if (lo, hi) == (0, None):
+            bounds = "*"
+        elif lo == hi:
+            bounds = f"{{{lo}}}"
+        else:
+            bounds = f"{{{lo},{'' if hi is None else hi}}}"
+        return repr_operand(child) + bounds
+
+
+def repr_operand(term):
+    if term.kind in ("union", "intersection", "concat", "repeat"):
+        return f"({term!r})"
+    return repr(term)
+
+
+def repr_ranges(ranges):
+    def char(c):
+        s = repr(bytes([c]))[2:-1]
+        return "\\" + s if s in ("[", "]", "-", "^") else s
+
+    if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+        return char(ranges[0][0])
+    return (
+        "["
+        + "".join(char(u) if u == v else f"{char(u)}-{char(v)}" for u, v in ranges)
+        + "]"
+    )
+
+
+def intern_term(kind, args, nullable):
+    key = (kind, args)
+    with TERMS_LOCK:
+        term = TERMS.get(key)
+        if term is None:
+            term = Term(kind, args, nullable, next(SERIAL_NUMBERS))
+            TERMS[key] = term
+        return term
+
+
+def byte_set(ranges):
+    """Returns a term matching any single byte ``c`` with ``u <= c <= v``
+    for some ``(u, v)`` in ``ranges``."""
+    return intern_term("set", tuple(normalize_ranges(ranges)), False)
+
+
+def literal(string):
+    """Returns a term matching exactly ``string``."""
+    return concatenation(*(byte_set([(c, c)]) for c in string))
+
+
+EMPTY = byte_set(())
+"""Matches nothing at all."""
+
+EPSILON = intern_term("epsilon", (), True)
+"""Matches only the empty string."""
+
+
+def concatenation(*terms):
+    """Returns a term matching any string made up of a string matched by
+    each of ``terms`` in turn."""
+    result = EPSILON
+    for term in reversed(terms):
+        result = concatenate_pair(term, result)
+    return result
+
+
+def concatenate_pair(left, right):
+    if left is EMPTY or right is EMPTY:
+        return EMPTY
+    if left is EPSILON:
+        return right
+    if right is EPSILON:
+        return left
+    # We keep concatenations nested to the right, so if ``left`` is a
+    # concatenation we prepend each of its parts to ``right`` in turn.
+    parts = []
+    while left.kind == "concat":
+        first, left = left.args
+        parts.append(first)
+    parts.append(left)
+    result = right
+    for part in reversed(parts):
+        result = intern_term(
+            "concat", (part, result), part.nullable and result.nullable
+        )
+    return result
+
+
+def union(*terms):
+    """Returns a term matching any string matched by any of ``terms``."""
+    children = {}
+    ranges = []
+    for term in flatten("union", terms):
+        if term is EVERYTHING:
+            return EVERYTHING
+        if term.kind == "set":
+            ranges.extend(term.args)
+        else:
+            children[term] = None
+    if ranges:
+        children[byte_set(ranges)] = None
+    return combine("union", children, EMPTY, any)
+
+
+def intersection(*terms):
+    """Returns a term matching any string matched by all of ``terms``."""
+    children = {}
+    sets = []
+    for term in flatten("intersection", terms):
+        if term is EMPTY:
+            return EMPTY
+        if term is EVERYTHING:
+            continue
+        if term.kind == "set":
+            sets.append(term)
+        else:
+            children[term] = None
+    if sets:
+        # Sets only match single bytes, so their intersection is another
+        # set (which is EMPTY if they have no bytes in common).
+        common = set(range(ALPHABET_SIZE))
+        for term in sets:
+            common.intersection_update(c for u, v in term.args for c in range(u, v + 1))
+        if not common:
+            return EMPTY
+        children[byte_set([(c, c) for c in common])] = None
+    return combine("intersection", children, EVERYTHING, all)
+
+
+def flatten(kind, terms):
+    for term in terms:
+        if term.kind == kind:
+            yield from term.args
+        else:
+            yield term
+
+
+def combine(kind, children, identity, nullable):
+    if not children:
+        return identity
+    if len(children) == 1:
+        (result,) = children
+        return result
+    args = tuple(sorted(children, key=lambda term: term.order))
+    return intern_term(kind, args, nullable(term.nullable for term in args))
+
+
+def complement(term):
+    """Returns a term matching exactly the strings that ``term``
+    does not match."""
+    if term.kind == "complement":
+        return term.args[0]
+    return intern_term("complement", (term,), not term.nullable)
+
+
+EVERYTHING = complement(EMPTY)
+"""Matches every string."""
+
+ANY_BYTE = byte_set([(0, MAX_BYTE)])
+"""Matches any single byte."""
+
+
+def repeat(term, lo, hi=None):
+    """Returns a term matching between ``lo`` and ``hi`` copies of ``term``
+    in a row, or at least ``lo`` copies if ``hi`` is None."""
+    if lo < 0 or (hi is not None and hi < lo):
+        raise ValueError(f"Invalid bounds {lo}, {hi}")
+    if hi == 0 or term is EPSILON:
+        return EPSILON
+    if term is EMPTY:
+        return EPSILON if lo == 0 else EMPTY
+    if lo == hi == 1:
+        return term
+    if (lo, hi) == (0, None) and term is ANY_BYTE:
+        return EVERYTHING
+    if hi is None and term.kind == "repeat" and term.args[1:] == (0, None):
+        # Any number of copies of r* is just r* again.
+        return term
+    return intern_term("repeat", (term, lo, hi), lo == 0 or term.nullable)
+
+
+def star(term):
+    """Returns a term matching any number of copies of ``term``."""
+    return repeat(term, 0)
+
+
+def rebuild_term(kind, args):
+    if kind == "set":
+        return byte_set(args)
+    if kind == "epsilon":
+        return EPSILON
+    if kind == "concat":
+        return concatenation(*args)
+    if kind == "union":
+        return union(*args)
+    if kind == "intersection":
+        return intersection(*args)
+    if kind == "complement":
+        return complement(*args)
+    assert kind == "repeat"
+    return repeat(*args)
+
+
+def parse_regex(pattern):
+    """Returns a term matching exactly the strings that fully match
+    ``pattern``, a ``bytes`` regular expression using the syntax
+    described in ``byteregex``."""
+    if not isinstance(pattern, bytes):
+        raise TypeError(f"Expected a bytes pattern but got {pattern!r}")
+    return term_of_tree(Parser(pattern).parse())
+
+
+def term_of_tree(tree):
+    kind = tree[0]
+    if kind == "set":
+        return byte_set(tree[1])
+    if kind == "concat":
+        return concatenation(*map(term_of_tree, tree[1]))
+    if kind == "alt":
+        return union(*map(term_of_tree, tree[1]))
+    assert kind == "repeat"
+    _, child, lo, hi = tree
+    return repeat(term_of_tree(child), lo, hi)
+
+
+class DerivativeDFA(DFA):
+    """A DFA matching the language of ``term``, whose states are terms
+    and whose transitions are calculated (and cached) as derivatives
+    only when they are needed.
+
+    The state ``DEAD`` is used in place of ``EMPTY``. Other states may
+    still be dead (e.g. intersections of disjoint languages), but we
+    don't try to detect this until we're asked to, and only need to
+    explore the DFA to do so for terms using intersection or complement.
+    """
+
+    def __init__(self, term):
+        super().__init__()
+        self.term = term
+
+    @classmethod
+    def from_regex(cls, pattern):
+        """Returns a DFA matching exactly the strings that fully match
+        ``pattern``. See ``parse_regex``."""
+        return cls(parse_regex(pattern))
+
+    def __repr__(self):
+        return f"DerivativeDFA({self.term!r})"
+
+    @property
+    def start(self):
+        return DEAD if self.term is EMPTY else self.term
+
+    def is_accepting(self, i):
+        return i != DEAD and i.nullable
+
+    def is_live(self, state):
+        if state == DEAD:
+            return False
+        if not state.boolean:
+            return True
+        return super().is_live(state)
+
+    def transition(self, i, c):
+        if i == DEAD:
+            return DEAD
+        result = self.__derivative(i, self.byte_classes()[c])
+        return DEAD if result is EMPTY else result
+
+    @cached
+    def byte_classes(self):
+        # Every set appearing in a derivative of our term appears in the
+        # term itself, so bytes that are treated the same by all of those
+        # sets are treated the same everywhere.
+        boundaries = set()
+        seen = set()
+        stack = [self.term]
+        while stack:
+            term = stack.pop()
+            if term in seen:
+                continue
+            seen.add(term)
+            if term.kind == "set":
+                for u, v in term.args:
+                    boundaries.add(u)
+                    boundaries.add(v + 1)
+            elif term.kind != "epsilon":
+                stack.extend(t for t in term.args if isinstance(t, Term))
+        boundaries.discard(0)
+        boundaries.discard(MAX_BYTE + 1)
+        k = 0
+        classes = bytearray(ALPHABET_SIZE)
+        for c in range(ALPHABET_SIZE):
+            if c in boundaries:
+                k += 1
+            classes[c] = k
+        return bytes(classes)
+
+    def __derivative(self, term, k):
+        """Returns the derivative of ``term`` with respect to any byte in
+        byte class ``k``."""
+        # This is cached as if it used ``cached``, but terms can be nested
+        # very deeply (e.g. a concatenation is nested once per part), so
+        # rather than recursing we keep a stack of the subterms whose
+        # derivatives we need, and only calculate each one once those it
+        # depends on are known.
+        cache = self._DFA__cache("__derivative")
+        result = cache.get((term, k))
+        if result is not None:
+            return result
+        # As the cache may be bounded, we also keep everything we need
+        # here until we're done.
+        known = {}
+        stack = [term]
+        while stack:
+            t = stack[-1]
+            if t in known:
+                stack.pop()
+                continue
+            needed = []
+            for u in dependencies(t):
+                if u not in known:
+                    result = cache.get((u, k))
+                    if result is None:
+                        needed.append(u)
+                    else:
+                        known[u] = result
+            if needed:
+                stack.extend(needed)
+            else:
+                stack.pop()
+                known[t] = cache.setdefault((t, k), self.__derivative_from(t, k, known))
+        return known[term]
+
+    def __derivative_from(self, term, k, derivatives):
+        """Returns the derivative of ``term`` with respect to any byte in
+        byte class ``k``, given a dict ``derivatives`` containing the
+        derivatives of every term in ``dependencies(term)``."""
+        kind = term.kind
+        if kind == "set":
+            c = self.class_representatives()[k]
+            return EPSILON if any(u <= c <= v for u, v in term.args) else EMPTY
+        if kind == "epsilon":
+            return EMPTY
+        if kind == "concat":
+            left, right = term.args
+            result = concatenate_pair(derivatives[left], right)
+            if left.nullable:
+                result = union(result, derivatives[right])
+            return result
+        if kind == "union":
+            return union(*(derivatives[t] for t in term.args))
+        if kind == "intersection":
+            return intersection(*(derivatives[t] for t in term.args))
+        if kind == "complement":
+            return complement(derivatives[term.args[0]])
+        assert kind == "repeat"
+        child, lo, hi = term.args
+        # When the child is nullable this drops the derivatives of any
+        # later copies, but these are all already included, because an
+        # empty copy can always be added to make up the numbers.
+        return concatenate_pair(
+            derivatives[child],
+            repeat(child, max(lo - 1, 0), None if hi is None else hi - 1),
+        )
+
+
+def dependencies(term):
+    """Returns the subterms of ``term`` whose derivatives are needed to
+    calculate the derivative of ``term``."""
+    if term.kind in ("set", "epsilon"):
+        return ()
+    if term.kind == "concat":
+        left, right = term.args
+        return term.args if left.nullable else (left,)
+    if term.kind == "repeat":
+        return term.args[:1]
+    return term.args
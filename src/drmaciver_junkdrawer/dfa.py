@@ -8,10 +8,27 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file, You can
 # obtain one at https://mozilla.org/MPL/2.0/.
 
+import mmap
+import os
+import struct
+import sys
 import threading
+from array import array
+from bisect import bisect_right
 from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from functools import wraps
-from math import inf
+from itertools import accumulate, islice
+from math import inf, log
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from drmaciver_junkdrawer.aliassampler import VoseAliasSampler
+from drmaciver_junkdrawer.byteregex import compile_regex
+from drmaciver_junkdrawer.lrucache import LRUCache
+from drmaciver_junkdrawer.refinable import RefinablePartition
 
 
 def cached(fn):
@@ -39,15 +56,83 @@ class DFA:
     """
 
     def __init__(self):
-        self.__caches = threading.local()
+        self.configure_caches()
+
+    def configure_caches(self, *, shared=False, max_size=None, max_sizes=None):
+        """Sets how this DFA caches the results of its calculations,
+        discarding anything already cached.
+
+        * If ``shared`` is True, a single set of caches is shared between
+          all threads using this DFA. Otherwise (the default) each thread
+          gets its own caches, which avoids any locking.
+        * ``max_size`` is the maximum number of entries that each cache
+          may hold, with the least recently used entries being discarded
+          beyond that. If it is None, caches may grow without bound.
+        * ``max_sizes`` is a dict mapping cache names (which are the names
+          of the methods whose results are cached, as reported by
+          ``cache_info``) to limits which override ``max_size``.
+        """
+        self.__shared_caches = shared
+        self.__max_cache_size = max_size
+        self.__max_cache_sizes = dict(max_sizes or {})
+        self.__caches_lock = threading.Lock()
+        self.clear_caches()
+
+    def clear_caches(self):
+        """Discards everything cached by this DFA, in every thread."""
+        if self.__shared_caches:
+            self.__caches = {}
+        else:
+            self.__caches = threading.local()
+
+    def cache_info(self):
+        """Returns a dict mapping the name of each cache that is in use
+        to a ``CacheInfo`` with its hit and miss counts and its size. If
+        caches are not shared, this only reports on the current thread's
+        caches."""
+        return {
+            name: cache.cache_info() for name, cache in self.__cache_table().items()
+        }
+
+    def __getstate__(self):
+        # Caches contain locks (and may be thread local), neither of which
+        # can be pickled, and are usually cheaper to recalculate than to
+        # send anyway, so we drop them and start afresh when unpickling.
+        state = dict(self.__dict__)
+        del state["_DFA__caches"]
+        del state["_DFA__caches_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__caches_lock = threading.Lock()
+        self.clear_caches()
+
+    def __cache_table(self):
+        if self.__shared_caches:
+            return self.__caches
+        try:
+            return self.__caches.table
+        except AttributeError:
+            self.__caches.table = {}
+            return self.__caches.table
 
     def __cache(self, name):
+        table = self.__cache_table()
         try:
-            cache = getattr(self.__caches, name)
-        except AttributeError:
-            cache = {}
-            setattr(self.__caches, name, cache)
-        return cache
+            return table[name]
+        except KeyError:
+            pass
+        with self.__caches_lock:
+            try:
+                return table[name]
+            except KeyError:
+                cache = LRUCache(
+                    max_size=self.__max_cache_sizes.get(name, self.__max_cache_size),
+                    thread_safe=self.__shared_caches,
+                )
+                table[name] = cache
+                return cache
 
     @property
     def start(self):
@@ -67,18 +152,78 @@ class DFA:
     def alphabet(self):
         return range(256)
 
+    @cached
+    def byte_classes(self):
+        """Returns a ``bytes`` object of length 256 mapping each byte to
+        the index of its byte class. Bytes in the same class behave the
+        same way in every state, so many calculations only need to
+        consider one byte per class.
+
+        Classes are numbered in order of the smallest byte in them.
+
+        The default implementation puts every byte in a class of its
+        own, which is always correct. Subclasses that know more about
+        their structure should override this to find coarser classes.
+        """
+        return bytes(range(256))
+
+    @cached
+    def class_representatives(self):
+        """Returns a tuple whose ``k``'th element is the smallest byte
+        in byte class ``k``."""
+        return representatives_of(self.byte_classes())
+
+    @cached
+    def class_sizes(self):
+        """Returns a tuple whose ``k``'th element is the number of bytes
+        in byte class ``k``."""
+        sizes = [0] * len(self.class_representatives())
+        for k in self.byte_classes():
+            sizes[k] += 1
+        return tuple(sizes)
+
+    @cached
+    def class_members(self):
+        """Returns a tuple whose ``k``'th element is a tuple of the
+        bytes in byte class ``k``, in ascending order."""
+        members = [[] for _ in self.class_representatives()]
+        for c, k in enumerate(self.byte_classes()):
+            members[k].append(c)
+        return tuple(map(tuple, members))
+
+    def raw_class_transitions(self, i):
+        """Iterates over pairs (byte, state) of transitions out of
+        ``i``, one for each byte class in ascending order, where
+        the byte is the smallest one in its class."""
+        for c in self.class_representatives():
+            yield c, self.transition(i, c)
+
+    def class_transitions(self, i):
+        """Iterates over the pairs from ``raw_class_transitions``
+        which do not lead to dead states."""
+        for c, j in self.raw_class_transitions(i):
+            if not self.is_dead(j):
+                yield c, j
+
     def transitions(self, i):
         """Iterates over all pairs (byte, state) of transitions
         which do not lead to dead states."""
+        dead = {}
         for c, j in self.raw_transitions(i):
-            if not self.is_dead(j):
+            try:
+                is_dead = dead[j]
+            except KeyError:
+                is_dead = dead.setdefault(j, self.is_dead(j))
+            if not is_dead:
                 yield c, j
 
     @cached
     def transition_counts(self, state):
+        classes = self.byte_classes()
+        sizes = self.class_sizes()
         counts = Counter()
-        for _, j in self.transitions(state):
-            counts[j] += 1
+        for c, j in self.class_transitions(state):
+            counts[j] += sizes[classes[c]]
         return list(counts.items())
 
     def matches(self, s):
@@ -89,6 +234,40 @@ class DFA:
             i = self.transition(i, c)
         return self.is_accepting(i)
 
+    def matcher(self, state=None):
+        """Returns a ``StreamMatcher`` for incrementally matching input
+        against this DFA, starting from ``state`` (or the start state
+        if it is not given)."""
+        return StreamMatcher(self, state)
+
+    def matches_many(self, strings):
+        """Returns a NumPy boolean array whose ``i``'th entry is
+        ``self.matches(strings[i])``.
+
+        Strings are visited in sorted order, so that a prefix shared by
+        several of them is only read once. This is particularly worth
+        doing for lazily calculated DFAs, where transitions are expensive."""
+        strings = list(strings)
+        results = [False] * len(strings)
+
+        # Invariant: ``states[k]`` is the state reached after reading the
+        # first ``k`` characters of ``prev``.
+        prev = b""
+        states = [self.start]
+
+        for i in sorted(range(len(strings)), key=strings.__getitem__):
+            s = strings[i]
+            k = 0
+            common = min(len(s), len(prev))
+            while k < common and s[k] == prev[k]:
+                k += 1
+            del states[k + 1 :]
+            for j in range(k, len(s)):
+                states.append(self.transition(states[-1], s[j]))
+            results[i] = self.is_accepting(states[-1])
+            prev = s
+        return np.array(results, dtype=bool)
+
     def all_matching_regions(self, string):
         """Return all pairs ``(u, v)`` such that ``self.matches(string[u:v])``."""
 
@@ -121,6 +300,241 @@ class DFA:
                 stack.append((k + 1, next_state, next_indices))
         return results
 
+    def iter_matching_regions(self, string):
+        """Lazily yields the same pairs as ``all_matching_regions``, in
+        ascending order.
+
+        This reads ``string`` once from left to right in the same way as
+        ``count_matching_regions``, so it runs in time proportional to
+        ``len(string)`` times the number of live states, plus the number
+        of regions yielded. The regions starting from ``u`` are yielded
+        as soon as no start point up to ``u`` can lead to another match,
+        so only those regions still waiting on an earlier start point
+        are held in memory."""
+        n = len(string)
+        start_is_live = not self.is_dead(self.start)
+        # Maps each live state to a pair of the smallest start point that
+        # reaches it at the current position and a list of all of them.
+        threads = {}
+        # Maps start points to the ends of the regions found from them so
+        # far. Every start point before ``resolved`` has been yielded.
+        ends = {}
+        resolved = 0
+        for i in range(n + 1):
+            if i < n and start_is_live:
+                if self.start in threads:
+                    threads[self.start][1].append(i)
+                else:
+                    threads[self.start] = (i, [i])
+            for state, (_, starts) in threads.items():
+                if self.is_accepting(state):
+                    for u in starts:
+                        ends.setdefault(u, []).append(i)
+            if i < n:
+                c = string[i]
+                new_threads = {}
+                for state, (lowest, starts) in threads.items():
+                    j = self.transition(state, c)
+                    if self.is_dead(j):
+                        continue
+                    if j in new_threads:
+                        # Merging the shorter list into the longer one
+                        # means each start point is only copied
+                        # logarithmically many times.
+                        other_lowest, other = new_threads[j]
+                        if len(other) < len(starts):
+                            other, starts = starts, other
+                        other.extend(starts)
+                        lowest = min(lowest, other_lowest)
+                        starts = other
+                    new_threads[j] = (lowest, starts)
+                threads = new_threads
+                # A start point that no thread reaches can't match again.
+                done = min((lowest for lowest, _ in threads.values()), default=i + 1)
+            else:
+                done = n
+            while resolved < done:
+                for v in ends.pop(resolved, ()):
+                    yield (resolved, v)
+                resolved += 1
+
+    def count_matching_regions(self, string):
+        """Returns ``len(self.all_matching_regions(string))``, without
+        building the list of regions.
+
+        This reads ``string`` once from left to right, keeping track of
+        how many start points lead to each state, so it runs in time
+        proportional to ``len(string)`` times the number of live states
+        and in memory proportional to the number of live states."""
+        n = len(string)
+        start_is_live = not self.is_dead(self.start)
+        counts = Counter()
+        total = 0
+        for i in range(n + 1):  # pragma: no branch
+            if i < n and start_is_live:
+                counts[self.start] += 1
+            for state, k in counts.items():
+                if self.is_accepting(state):
+                    total += k
+            if i == n:
+                break
+            c = string[i]
+            new_counts = Counter()
+            for state, k in counts.items():
+                j = self.transition(state, c)
+                if not self.is_dead(j):
+                    new_counts[j] += k
+            counts = new_counts
+        return total
+
+    def finditer(self, string):
+        """Yields non-overlapping matching regions ``(u, v)`` of ``string``
+        from left to right, in the manner of ``re.finditer``.
+
+        Each region is the leftmost-longest match among those that start
+        no earlier than the end of the previous one (and as with ``re``,
+        after an empty match the search resumes one character later).
+        Every region yielded is one that ``all_matching_regions`` would
+        return.
+
+        Each search reads on from where the last match ended until no
+        start point it is tracking can lead to a better match, so when
+        matches are short but the DFA stays live for a long way past
+        them (e.g. ``a|a*b`` against a long run of ``a``) this takes time
+        quadratic in ``len(string)``.
+        """
+        n = len(string)
+        start_is_live = not self.is_dead(self.start)
+        pos = 0
+        while pos < n and start_is_live:
+            # Maps each state to the smallest start point that reaches it
+            # at the current position. Start points that reach the same
+            # state behave identically from then on, so the leftmost one
+            # is the only one that could be part of the match we want.
+            threads = {}
+            best = None
+            i = pos
+            while True:
+                # Once we have a candidate match, starting anywhere later
+                # can't beat it for being leftmost.
+                if best is None and i < n:
+                    threads.setdefault(self.start, i)
+                for state, u in threads.items():
+                    if self.is_accepting(state) and (best is None or u <= best[0]):
+                        best = (u, i)
+                if best is not None:
+                    threads = {state: u for state, u in threads.items() if u <= best[0]}
+                if not threads or i == n:
+                    break
+                c = string[i]
+                new_threads = {}
+                for state, u in threads.items():
+                    j = self.transition(state, c)
+                    if not self.is_dead(j) and u < new_threads.get(j, inf):
+                        new_threads[j] = u
+                threads = new_threads
+                i += 1
+            if best is None:
+                return
+            yield best
+            u, v = best
+            pos = v if v > u else u + 1
+
+    def edit_distance(self, s, max_distance):
+        """Returns the smallest Levenshtein distance (the number of single
+        byte insertions, deletions and substitutions needed to turn one
+        string into the other) between ``s`` and any string matched by
+        this DFA, if it is at most ``max_distance``, and None otherwise."""
+        costs = None
+        for costs in self.__edit_costs(s, max_distance, search=False):
+            if not costs:
+                return None
+        return self.__best_cost(costs)
+
+    def matches_within(self, s, k):
+        """Returns True if some string matched by this DFA is within
+        Levenshtein distance ``k`` of ``s``. See ``edit_distance``."""
+        return self.edit_distance(s, k) is not None
+
+    def search_within(self, s, k):
+        """Yields pairs ``(v, d)``, in ascending order of ``v``, such that
+        ``d <= k`` is the smallest edit distance between any substring
+        ``s[u:v]`` and a string matched by this DFA.
+
+        This is the approximate matching counterpart to searching for the
+        ends of matching regions, and takes a single pass over ``s``. It
+        doesn't keep track of where matches start, but once a match has
+        been found ending at ``v``, ``edit_distance`` can be used to find
+        the best ``u`` for it."""
+        for v, costs in enumerate(self.__edit_costs(s, k, search=True)):
+            d = self.__best_cost(costs)
+            if d is not None:
+                yield (v, d)
+
+    def __best_cost(self, costs):
+        return min((d for q, d in costs.items() if self.is_accepting(q)), default=None)
+
+    def __edit_costs(self, s, k, search):
+        """Yields, for each ``p`` in ``range(len(s) + 1)``, a dict mapping
+        each live state to the smallest number of edits to ``s[:p]`` that
+        reach it, if that is at most ``k``. If ``search`` is True, the
+        edits are to any suffix of ``s[:p]`` instead.
+
+        This is a lazily calculated product of this DFA with an automaton
+        that counts edits: reading a byte of ``s`` may either follow the
+        transition for it (free), follow any other transition (a
+        substitution), or stay put (a deletion), and at any point we may
+        follow a transition without reading anything (an insertion)."""
+        if k < 0:
+            raise ValueError(f"Invalid edit distance {k}")
+        classes = self.byte_classes()
+        # Maps each state to the pairs (class, state) of its live class
+        # transitions, as we look these up many times.
+        successors = {}
+
+        def live_successors(q):
+            try:
+                return successors[q]
+            except KeyError:
+                return successors.setdefault(
+                    q, [(classes[c], j) for c, j in self.class_transitions(q)]
+                )
+
+        def insert(costs):
+            # Every insertion costs one, so we can find the cheapest way to
+            # reach each state by a breadth first search in order of cost.
+            frontier = list(costs.items())
+            while frontier:
+                next_frontier = []
+                for q, d in frontier:
+                    if d >= k or costs[q] < d:
+                        continue
+                    for _, j in live_successors(q):
+                        if costs.get(j, inf) > d + 1:
+                            costs[j] = d + 1
+                            next_frontier.append((j, d + 1))
+                frontier = next_frontier
+            return costs
+
+        start = self.start
+        start_is_live = not self.is_dead(start)
+        costs = insert({start: 0} if start_is_live else {})
+        yield costs
+        for c in s:
+            x = classes[c]
+            new_costs = {}
+            for q, d in costs.items():
+                for y, j in live_successors(q):
+                    cost = d if y == x else d + 1
+                    if cost <= k and new_costs.get(j, inf) > cost:
+                        new_costs[j] = cost
+                if d < k and new_costs.get(q, inf) > d + 1:
+                    new_costs[q] = d + 1
+            if search and start_is_live:
+                new_costs[start] = 0
+            costs = insert(new_costs)
+            yield costs
+
     def max_length(self, i):
         """Returns the maximum length of a string that is
         accepted when starting from i."""
@@ -128,11 +542,31 @@ class DFA:
             return 0
 
         cache = self.__cache("max_length")
-
-        try:
-            return cache[i]
-        except KeyError:
-            pass
+        result = cache.get(i)
+        if result is not None:
+            return result
+
+        # We do all of our work in ``lengths`` and only save the results
+        # at the end, as entries may be evicted from the cache at any
+        # point. Values we find in the cache are copied into it, and
+        # ``missing`` notes the ones we didn't find.
+        lengths = {}
+        missing = set()
+
+        def known(k):
+            """Returns the max length for k if we know it, else None."""
+            try:
+                return lengths[k]
+            except KeyError:
+                pass
+            if k in missing:
+                return None
+            value = cache.get(k)
+            if value is None:
+                missing.add(k)
+            else:
+                lengths[k] = value
+            return value
 
         # Naively we can calculate this as 1 longer than the
         # max length of the non-dead states this can immediately
@@ -161,8 +595,8 @@ class DFA:
             # If any of the children have infinite max_length we don't
             # need to check all of them to know that this state does
             # too.
-            if any(cache.get(k) == inf for k in self.successor_states(j)):
-                cache[j] = inf
+            if any(known(k) == inf for k in self.successor_states(j)):
+                lengths[j] = inf
                 pop()
                 continue
 
@@ -174,18 +608,18 @@ class DFA:
                     # (since we never push dead states on the stack),
                     # so it can reach strings of unbounded length.
                     assert not self.is_dead(k)
-                    cache[k] = inf
+                    lengths[k] = inf
                     break
-                elif k not in cache and not self.is_dead(k):
+                elif known(k) is None and not self.is_dead(k):
                     stack.append(k)
                     stack_set.add(k)
                     break
             else:
                 # All of j's successors have a known max_length or are dead,
                 # so we can now compute a max_length for j itself.
-                cache[j] = max(
+                lengths[j] = max(
                     (
-                        1 + cache[k]
+                        1 + lengths[k]
                         for k in self.successor_states(j)
                         if not self.is_dead(k)
                     ),
@@ -193,9 +627,10 @@ class DFA:
                 )
 
                 # j is live so it must either be accepting or have a live child.
-                assert self.is_accepting(j) or cache[j] > 0
+                assert self.is_accepting(j) or lengths[j] > 0
                 pop()
-        return cache[i]
+        cache.update(lengths)
+        return lengths[i]
 
     @cached
     def has_strings(self, state, length):
@@ -205,13 +640,11 @@ class DFA:
 
         cache = self.__cache("has_strings")
 
-        try:
-            return cache[state, length]
-        except KeyError:
-            pass
-
+        # As entries may be evicted from the cache at any point, we copy
+        # any values we need from it into ``results`` and work from that.
         pending = [(state, length)]
         seen = set()
+        results = {}
         i = 0
 
         while i < len(pending):
@@ -220,34 +653,43 @@ class DFA:
             if n > 0:
                 for t in self.successor_states(s):
                     key = (t, n - 1)
-                    if key not in cache and key not in seen:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    value = cache.get(key)
+                    if value is None:
                         pending.append(key)
-                        seen.add(key)
+                    else:
+                        results[key] = value
 
         while pending:
             s, n = pending.pop()
             if n == 0:
-                cache[s, n] = self.is_accepting(s)
+                results[s, n] = self.is_accepting(s)
             else:
-                cache[s, n] = any(
-                    cache.get((t, n - 1)) for t in self.successor_states(s)
-                )
+                results[s, n] = any(results[t, n - 1] for t in self.successor_states(s))
 
-        return cache[state, length]
+        cache.update(results)
+        return results[state, length]
 
     def count_strings(self, state, length):
         """Returns the number of strings of length ``length``
-        that are accepted when starting from state ``state``."""
+        that are accepted when starting from state ``state``.
+
+        This caches a count for every state and every length up to
+        ``length``, so for very large lengths ``string_counter()``
+        is a better choice."""
         assert length >= 0
         cache = self.__cache("count_strings")
+        result = cache.get((state, length))
+        if result is not None:
+            return result
 
-        try:
-            return cache[state, length]
-        except KeyError:
-            pass
-
+        # As entries may be evicted from the cache at any point, we copy
+        # any values we need from it into ``results`` and work from that.
         pending = [(state, length)]
         seen = set()
+        results = {}
         i = 0
 
         while i < len(pending):
@@ -256,20 +698,61 @@ class DFA:
             if n > 0:
                 for t in self.successor_states(s):
                     key = (t, n - 1)
-                    if key not in cache and key not in seen:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    value = cache.get(key)
+                    if value is None:
                         pending.append(key)
-                        seen.add(key)
+                    else:
+                        results[key] = value
 
         while pending:
             s, n = pending.pop()
             if n == 0:
-                cache[s, n] = int(self.is_accepting(s))
+                results[s, n] = int(self.is_accepting(s))
             else:
-                cache[s, n] = sum(
-                    cache[t, n - 1] * k for t, k in self.transition_counts(s)
+                results[s, n] = sum(
+                    results[t, n - 1] * k for t, k in self.transition_counts(s)
                 )
 
-        return cache[state, length]
+        cache.update(results)
+        return results[state, length]
+
+    @cached
+    def string_counter(self):
+        """Returns a ``StringCounter`` for the states reachable from
+        ``self.start``. This is much faster than ``count_strings`` and
+        ``has_strings`` for large lengths, but always explores every
+        reachable state of the DFA."""
+        return StringCounter(self)
+
+    @cached
+    def viable_bytes(self, state):
+        """Returns a read-only NumPy boolean array whose ``c``'th element
+        is whether ``self.transition(state, c)`` is live, i.e. whether
+        appending ``c`` to a string leading to ``state`` leaves a string
+        that can still be extended to a match."""
+        classes = self.byte_classes()
+        live = np.zeros(len(self.class_representatives()), dtype=bool)
+        for c, _ in self.class_transitions(state):
+            live[classes[c]] = True
+        result = live[np.frombuffer(classes, dtype=np.uint8)]
+        result.flags.writeable = False
+        return result
+
+    def viable_bytes_many(self, states):
+        """Returns a 2D NumPy boolean array whose ``i``'th row is
+        ``self.viable_bytes(states[i])``."""
+        result = np.zeros((len(states), ALPHABET_SIZE), dtype=bool)
+        for i, state in enumerate(states):
+            result[i] = self.viable_bytes(state)
+        return result
+
+    def token_masker(self, tokens, cache_size=1024):
+        """Returns a ``TokenMasker`` for finding which of ``tokens`` can
+        be appended to strings matched by this DFA."""
+        return TokenMasker(self, tokens, cache_size)
 
     @cached
     def successor_states(self, state):
@@ -278,7 +761,7 @@ class DFA:
         smallest character that reaches them."""
         seen = set()
         result = []
-        for _, j in self.raw_transitions(state):
+        for _, j in self.raw_class_transitions(state):
             if j not in seen:
                 seen.add(j)
                 result.append(j)
@@ -298,10 +781,19 @@ class DFA:
         # We work this out by calculating is_live for all nodes
         # reachable from state which have not already had it calculated.
         cache = self.__cache("is_live")
-        try:
-            return cache[state]
-        except KeyError:
-            pass
+        result = cache.get(state)
+        if result is not None:
+            return result
+
+        # Entries may be evicted from the cache at any point, so we
+        # remember what we look up in it in case we need it again.
+        looked_up = {}
+
+        def lookup(j):
+            try:
+                return looked_up[j]
+            except KeyError:
+                return looked_up.setdefault(j, cache.get(j))
 
         # roots are states that we know already must be live,
         # either because we have previously calculated them to
@@ -321,7 +813,8 @@ class DFA:
         queue = deque([state])
         while queue:
             j = queue.popleft()
-            if cache.get(j, self.is_accepting(j)):
+            known = lookup(j)
+            if known or (known is None and self.is_accepting(j)):
                 # If j can be immediately determined to be live
                 # then there is no point in exploring beneath it,
                 # because any effect of states below it is screened
@@ -329,7 +822,7 @@ class DFA:
                 roots.add(j)
                 continue
 
-            if j in cache:
+            if known is not None:
                 # Likewise if j is known to be dead then there is
                 # no point exploring beneath it because we know
                 # that all nodes reachable from it must be dead.
@@ -352,16 +845,140 @@ class DFA:
             marked_live.add(j)
             for k in backwards_graph[j]:
                 queue.append(k)
-        for j in explored:
-            cache[j] = j in marked_live
+        results = {j: j in marked_live for j in explored}
+        cache.update(results)
+        return results[state]
+
+    def sample(self, length, random):
+        """Returns a string of length ``length`` chosen uniformly at
+        random from those matched by this DFA, using ``random`` as
+        the source of randomness. Raises ValueError if there are no
+        such strings."""
+        if not self.has_strings(self.start, length):
+            raise ValueError(f"No strings of length {length} are matched")
+        classes = self.byte_classes()
+        members = self.class_members()
+        result = bytearray()
+        state = self.start
+        for remaining in range(length, 0, -1):
+            options, sampler = self.__transition_sampler(state, remaining)
+            c, state = options[sampler.sample(random)]
+            result.append(random.choice(members[classes[c]]))
+        assert self.is_accepting(state)
+        return bytes(result)
+
+    def sample_many(self, length, n, random):
+        """Returns a list of ``n`` independent results of
+        ``self.sample(length, random)``.
+
+        The tables used for sampling are calculated the first time
+        they are needed and reused for every subsequent draw, so this
+        is much cheaper per string than calling ``sample`` once."""
+        return [self.sample(length, random) for _ in range(n)]
 
-        return cache[state]
+    @cached
+    def __transition_sampler(self, state, remaining):
+        """Returns a pair ``(options, sampler)`` where ``options`` is a list
+        of pairs ``(c, j)`` from ``class_transitions(state)`` and each
+        ``sampler.sample(random)`` picks an index into ``options``, such
+        that picking a random byte from the class of ``c`` and continuing
+        from ``j`` gives a uniformly random string of length ``remaining``
+        that is accepted starting from ``state``."""
+        classes = self.byte_classes()
+        sizes = self.class_sizes()
+        options = []
+        weights = []
+        for c, j in self.class_transitions(state):
+            count = self.count_strings(j, remaining - 1)
+            if count > 0:
+                options.append((c, j))
+                weights.append(sizes[classes[c]] * count)
+        return options, VoseAliasSampler(weights)
 
-    def all_matching_strings_of_length(self, k):
+    @cached
+    def __class_runs(self):
+        """Returns a list of triples ``(u, v, k)``, splitting the bytes
+        into maximal runs ``u <= c <= v`` that all have byte class ``k``."""
+        runs = []
+        for c, k in enumerate(self.byte_classes()):
+            if runs and runs[-1][2] == k:
+                runs[-1][1] = c
+            else:
+                runs.append([c, c, k])
+        return [tuple(run) for run in runs]
+
+    def __class_counts(self, state, length):
+        """Returns a list whose k'th element is the number of strings of
+        length ``length`` that match starting from the state that
+        ``state`` transitions to on bytes of class ``k``."""
+        classes = self.byte_classes()
+        counts = [0] * len(self.class_representatives())
+        for c, j in self.class_transitions(state):
+            counts[classes[c]] = self.count_strings(j, length)
+        return counts
+
+    def rank(self, s):
+        """Returns the number of matching strings that have the same
+        length as ``s`` and are lexicographically smaller than it, which
+        is the position of ``s`` in ``all_matching_strings_of_length`` if
+        it matches.
+
+        This takes time proportional to ``len(s)`` times the number of
+        runs of bytes with the same byte class, once the string counts
+        it needs have been calculated."""
+        runs = self.__class_runs()
+        result = 0
+        state = self.start
+        for i, c in enumerate(s):
+            counts = self.__class_counts(state, len(s) - i - 1)
+            for u, v, k in runs:
+                if u >= c:
+                    break
+                result += counts[k] * (min(v, c - 1) - u + 1)
+            state = self.transition(state, c)
+        return result
+
+    def unrank(self, length, n):
+        """Returns the matching string ``s`` with ``len(s) == length`` and
+        ``self.rank(s) == n``. That is, the ``n``'th element (counting
+        from zero) of ``all_matching_strings_of_length(length)``.
+
+        Raises IndexError if there are not that many matching strings."""
+        if not 0 <= n < self.count_strings(self.start, length):
+            raise IndexError(f"No matching string of length {length} at index {n}")
+        runs = self.__class_runs()
+        result = bytearray()
+        state = self.start
+        for i in range(length):
+            counts = self.__class_counts(state, length - i - 1)
+            for u, v, k in runs:
+                size = counts[k] * (v - u + 1)
+                if n < size:
+                    c = u + n // counts[k]
+                    n %= counts[k]
+                    break
+                n -= size
+            else:
+                raise NotImplementedError("Should be unreachable")
+            result.append(c)
+            state = self.transition(state, c)
+        assert self.is_accepting(state)
+        return bytes(result)
+
+    def all_matching_strings_of_length(self, k, after=None):
         """Yields all matching strings whose length is ``k``, in ascending
-        lexicographic order."""
+        lexicographic order.
+
+        If ``after`` is given, only yields strings that come strictly after
+        it in this order, without having to enumerate those that don't, so
+        an enumeration can be resumed from the last string it produced."""
+        if after is not None and len(after) != k:
+            if len(after) > k:
+                return
+            after = None
+
         if k == 0:
-            if self.is_accepting(self.start):
+            if after is None and self.is_accepting(self.start):
                 yield b""
             return
 
@@ -379,6 +996,16 @@ class DFA:
         # starting point.
         states = [self.start]
 
+        if after is not None:
+            # We skip straight to the first matching string after ``after``,
+            # which is already a complete path.
+            n = self.rank(after) + self.matches(after)
+            if n == self.count_strings(self.start, k):
+                return
+            path.extend(self.unrank(k, n))
+            for c in path:
+                states.append(self.transition(states[-1], c))
+
         while True:
             # First we build up our current best prefix to the lexicographically
             # first string starting with it.
@@ -428,22 +1055,97 @@ class DFA:
                     if self.count_strings(states[-1], k - len(path)) > 0:
                         break
 
-    def all_matching_strings(self, min_length=0):
+    def all_matching_strings(self, min_length=0, after=None):
         """Iterate over all strings matched by this automaton
-        in shortlex-ascending order."""
+        in shortlex-ascending order.
+
+        If ``after`` is given, only strings that come strictly after it
+        in shortlex order are produced."""
         # max_length might be infinite, hence the while loop
         max_length = self.max_length(self.start)
         length = min_length
+        if after is not None:
+            length = max(length, len(after))
         while length <= max_length:
-            yield from self.all_matching_strings_of_length(length)
+            yield from self.all_matching_strings_of_length(length, after=after)
             length += 1
 
+    def parallel_matching_strings(
+        self,
+        min_length=0,
+        max_length=None,
+        *,
+        processes=None,
+        chunk_size=10000,
+        ordered=True,
+    ):
+        """Yields the strings from ``all_matching_strings`` whose length is
+        between ``min_length`` and ``max_length`` (inclusive), calculating
+        them in a pool of ``processes`` worker processes (by default one per
+        CPU). This DFA must be picklable.
+
+        The strings of each length are split into ranges of ``chunk_size``
+        consecutive strings, using ``count_strings`` to find where those
+        ranges start, and each range is handed to a worker. If ``ordered``
+        is True the results are yielded in the same shortlex-ascending order
+        as ``all_matching_strings``. Otherwise each range is yielded as
+        soon as it is ready, which keeps the workers busier.
+
+        ``max_length`` may be omitted if this DFA only matches finitely
+        many strings, and is required otherwise."""
+        if chunk_size <= 0:
+            raise ValueError(f"Invalid chunk_size {chunk_size}")
+        longest = self.max_length(self.start)
+        if max_length is None:
+            if longest == inf:
+                raise ValueError(
+                    "A max_length is required as this DFA matches infinitely "
+                    "many strings"
+                )
+            max_length = longest
+        max_length = min(max_length, longest)
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        def ranges():
+            for length in range(min_length, max_length + 1):
+                count = self.count_strings(self.start, length)
+                for start in range(0, count, chunk_size):
+                    yield length, start, min(start + chunk_size, count)
+
+        executor = ProcessPoolExecutor(
+            processes, initializer=set_worker_dfa, initargs=(self,)
+        )
+        try:
+            # There may be far too many ranges to submit them all at once, so
+            # we only keep enough in flight to keep every worker busy.
+            pending = deque()
+            tasks = ranges()
+            while True:
+                for task in tasks:
+                    pending.append(executor.submit(matching_strings_in_range, *task))
+                    if len(pending) >= 2 * processes:
+                        break
+                if not pending:
+                    break
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = next(iter(done))
+                    pending.remove(future)
+                yield from future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
     def raw_transitions(self, i):
+        classes = self.byte_classes()
+        targets = [j for _, j in self.raw_class_transitions(i)]
         for c in self.alphabet:
-            j = self.transition(i, c)
-            yield c, j
+            yield c, targets[classes[c]]
 
-    def canonicalise(self):
+    def canonicalise(self, verify=False):
         """Return a canonical version of ``self`` as a ConcreteDFA.
 
         The DFA is not minimized, but nodes are sorted and relabelled
@@ -452,40 +1154,305 @@ class DFA:
         This is mildly important because it means that the output of
         L* should produce the same canonical DFA regardless of what
         order we happen to have run it in.
-        """
-        # We map all states to their index of appearance in depth
-        # first search. This both is useful for canonicalising and
-        # also allows for states that aren't integers.
-        state_map = {}
-        reverse_state_map = []
-        accepting = set()
-
-        seen = set()
 
+        If ``verify`` is True, we also check that the result is
+        equivalent to ``self``, raising AssertionError if not. This is
+        as expensive as the canonicalisation itself, so is off by default.
+        """
+        # We first explore every state reachable from the start, reading
+        # the transitions of each exactly once (which for lazily calculated
+        # DFAs is most of the work), and then work out which of them are
+        # live all at once by searching backwards from the accepting ones.
+        rows = {self.start: None}
+        accepting_states = []
         queue = deque([self.start])
         while queue:
             state = queue.popleft()
-            if state in state_map:
-                continue
-            i = len(reverse_state_map)
             if self.is_accepting(state):
-                accepting.add(i)
-            reverse_state_map.append(state)
-            state_map[state] = i
-            for _, j in self.transitions(state):
-                if j in seen:
-                    continue
-                seen.add(j)
-                queue.append(j)
-
-        transitions = [
-            {c: state_map[s] for c, s in self.transitions(t)} for t in reverse_state_map
-        ]
+                accepting_states.append(state)
+            row = rows[state] = list(self.raw_class_transitions(state))
+            for _, j in row:
+                if j not in rows:
+                    rows[j] = None
+                    queue.append(j)
+
+        predecessors = defaultdict(list)
+        for state, row in rows.items():
+            for _, j in row:
+                predecessors[j].append(state)
+        live = set(accepting_states)
+        stack = list(accepting_states)
+        while stack:
+            for j in predecessors[stack.pop()]:
+                if j not in live:
+                    live.add(j)
+                    stack.append(j)
+        self.__cache("is_live").update({state: state in live for state in rows})
+
+        # We map all states to their index of appearance in breadth
+        # first search through the live states. This both is useful for
+        # canonicalising and also allows for states that aren't integers.
+        reverse_state_map = [self.start]
+        state_map = {self.start: 0}
+        for state in reverse_state_map:
+            for _, j in rows[state]:
+                if j in live and j not in state_map:
+                    state_map[j] = len(reverse_state_map)
+                    reverse_state_map.append(j)
+        accepting = {state_map[state] for state in accepting_states}
+
+        classes = self.byte_classes()
+        runs = self.__class_runs()
+        transitions = []
+        for state in reverse_state_map:
+            targets = {classes[c]: state_map[j] for c, j in rows[state] if j in live}
+            transitions.append([(u, v, targets[k]) for u, v, k in runs if k in targets])
 
         result = ConcreteDFA(transitions, accepting)
-        assert self.equivalent(result)
+        if verify and not self.equivalent(result):
+            raise AssertionError(f"{result!r} is not equivalent to {self!r}")
         return result
 
+    def minimize(self):
+        """Return a minimal ConcreteDFA matching the same language as
+        ``self``. Equivalent DFAs have identical minimized forms.
+
+        Uses Hopcroft's algorithm:
+        Hopcroft, John. "An n log n algorithm for minimizing states in a
+        finite automaton." Theory of machines and computations.
+        Academic Press, 1971. 189-196.
+        """
+        canon = self.canonicalise()
+
+        # Hopcroft's algorithm wants a complete DFA, so we add an explicit
+        # dead state at the end to receive every missing transition.
+        n = len(canon)
+        dead = n
+
+        # Every byte in a byte class behaves the same way, so we only need
+        # to split on one byte per class. inverse[j] maps the smallest byte
+        # c of each class to the states i with canon.transition(i, c) == j.
+        representatives = canon.class_representatives()
+        inverse = [defaultdict(list) for _ in range(n + 1)]
+        for i in range(n):
+            targets = dict(canon.raw_class_transitions(i))
+            for c in representatives:
+                inverse[targets.get(c, dead)][c].append(i)
+        for c in representatives:
+            inverse[dead][c].append(dead)
+
+        partition = RefinablePartition(n + 1)
+        partition.mark([i for i in range(n) if canon.is_accepting(i)])
+
+        # The basic idea is that we repeatedly pick some "splitter" block
+        # and split every other block into the states that transition into
+        # the splitter on a given character and the states that don't.
+        # When a block is split we only need to use the smaller half as a
+        # future splitter (unless the block is already pending, in which
+        # case both halves are needed), because splitting on the other
+        # half is implied by splitting on the smaller one and the original
+        # block. This is where the n log n comes from.
+        pending = list(range(len(partition)))
+        is_pending = set(pending)
+
+        while pending:
+            block = pending.pop()
+            is_pending.remove(block)
+
+            preimages = defaultdict(list)
+            for j in partition[block]:
+                for c, sources in inverse[j].items():
+                    preimages[c].extend(sources)
+
+            for sources in preimages.values():
+                # We note one marked state per block so that after marking
+                # we can tell whether that block has been split, as the
+                # marked part of a split block moves to a new block.
+                touched = {int(partition.partition_of(i)): i for i in sources}
+                partition.mark(sources)
+                for old, i in touched.items():
+                    new = int(partition.partition_of(i))
+                    if new == old:
+                        continue
+                    if old in is_pending:
+                        added = new
+                    elif len(partition[new]) <= len(partition[old]):
+                        added = new
+                    else:
+                        added = old
+                    pending.append(added)
+                    is_pending.add(added)
+
+        block_of = [int(partition.partition_of(i)) for i in range(n + 1)]
+        dead_block = block_of[dead]
+
+        classes = canon.byte_classes()
+        transitions = [{} for _ in range(len(partition))]
+        accepting = set()
+        for i in range(n):
+            b = block_of[i]
+            if canon.is_accepting(i):
+                accepting.add(b)
+            targets = {
+                classes[c]: block_of[j] for c, j in canon.raw_class_transitions(i)
+            }
+            transitions[b].update(
+                (c, targets[k])
+                for c, k in enumerate(classes)
+                if targets.get(k, dead_block) != dead_block
+            )
+
+        # The blocks are numbered in whatever order they happened to get
+        # split off, so we canonicalise to get a consistent labelling.
+        return ConcreteDFA(transitions, accepting, block_of[canon.start]).canonicalise()
+
+    def shortest_string(self):
+        """Returns the shortlex-least string matched by this DFA, or None
+        if it does not match any strings.
+
+        Unlike ``is_dead`` this stops as soon as it finds a matching
+        string, so only explores as much of the DFA as it needs to."""
+        # A breadth first search that tries bytes in ascending order
+        # visits states in the shortlex order of the least string that
+        # reaches them, so the first accepting state we find gives us
+        # the answer.
+        parents = {self.start: None}
+        queue = deque([self.start])
+        while queue:
+            state = queue.popleft()
+            if self.is_accepting(state):
+                path = bytearray()
+                while parents[state] is not None:
+                    state, c = parents[state]
+                    path.append(c)
+                path.reverse()
+                return bytes(path)
+            for c, j in self.raw_class_transitions(state):
+                if j not in parents:
+                    parents[j] = (state, c)
+                    queue.append(j)
+        return None
+
+    def shortest_completion(self, state):
+        """Returns the shortlex-least string that is matched starting from
+        ``state``, or None if there is no such string.
+
+        Unlike ``shortest_string``, this calculates the answer for every
+        state at once, so that subsequent calls only need to follow a
+        precomputed path."""
+        index, distances, next_bytes, next_indices = self.__completion_table_for(state)
+        i = index[state]
+        if distances[i] == len(distances):
+            return None
+        result = bytearray()
+        for _ in range(distances[i]):
+            result.append(next_bytes[i])
+            i = next_indices[i]
+        return bytes(result)
+
+    def distance_to_accept(self, state):
+        """Returns the length of ``shortest_completion(state)``, or
+        ``inf`` if there is no such string."""
+        index, distances, _, _ = self.__completion_table_for(state)
+        distance = distances[index[state]]
+        if distance == len(distances):
+            return inf
+        return distance
+
+    def __completion_table_for(self, state):
+        # Usually we're asked about states reachable from the start, so
+        # there's a single table for all of them, but we can build one
+        # for any other state if we need to.
+        table = self.__completion_table(self.start)
+        if state not in table[0]:
+            table = self.__completion_table(state)
+        return table
+
+    @cached
+    def __completion_table(self, root):
+        """Returns a tuple ``(index, distances, next_bytes, next_indices)``
+        describing the shortest completions of every state reachable
+        from ``root``. ``index`` maps each of those states to an integer
+        ``i``, and then ``distances[i]`` is the length of its shortest
+        completion (or the number of states if it has none), and its
+        completion starts with ``next_bytes[i]``, with the rest being the
+        completion of the state with index ``next_indices[i]``."""
+        # First we find every reachable state and the transitions
+        # between them, recording each in reverse. We label transitions
+        # by the smallest byte in their class, as that's the only one
+        # that can appear in a shortlex-least completion.
+        classes = self.byte_classes()
+        representatives = self.class_representatives()
+        states = [root]
+        index = {root: 0}
+        predecessors = [[]]
+        edges = []
+        for i, state in enumerate(states):
+            out = []
+            for c, j in self.raw_class_transitions(state):
+                try:
+                    k = index[j]
+                except KeyError:
+                    k = index[j] = len(states)
+                    states.append(j)
+                    predecessors.append([])
+                predecessors[k].append(i)
+                out.append((representatives[classes[c]], k))
+            edges.append(out)
+
+        # Then a breadth first search backwards from every accepting
+        # state gives us the distance of every state from accepting.
+        n = len(states)
+        distances = [n] * n
+        queue = deque()
+        for i, state in enumerate(states):
+            if self.is_accepting(state):
+                distances[i] = 0
+                queue.append(i)
+        while queue:
+            i = queue.popleft()
+            for k in predecessors[i]:
+                if distances[k] == n:
+                    distances[k] = distances[i] + 1
+                    queue.append(k)
+
+        # Finally, the shortlex-least completion of each state must start
+        # with the smallest byte leading to a state one step closer.
+        next_bytes = bytearray(n)
+        next_indices = [0] * n
+        for i, out in enumerate(edges):
+            if 0 < distances[i] < n:
+                next_bytes[i], next_indices[i] = min(
+                    (c, k) for c, k in out if distances[k] == distances[i] - 1
+                )
+        return (
+            index,
+            typed_array(distances),
+            bytes(next_bytes),
+            typed_array(next_indices),
+        )
+
+    def is_subset(self, other):
+        """Checks whether every string matched by this DFA is also
+        matched by ``other``."""
+        return DifferenceDFA(self, other).shortest_string() is None
+
+    def intersects(self, other):
+        """Checks whether some string is matched by both this DFA
+        and ``other``."""
+        return IntersectionDFA(self, other).shortest_string() is not None
+
+    def distinguishing_string(self, other):
+        """Returns the shortlex-least string that is matched by exactly
+        one of this DFA and ``other``, or None if they are equivalent."""
+        left = flat_form(self)
+        right = flat_form(other)
+        if left is not None and right is not None:
+            if flat_equivalent(left, right):
+                return None
+            return flat_distinguishing_string(left, right)
+        return SymmetricDifferenceDFA(self, other).shortest_string()
+
     def equivalent(self, other):
         """Checks whether this DFA and other match precisely the same
         language.
@@ -493,7 +1460,14 @@ class DFA:
         Uses the classic algorithm of Hopcroft and Karp (more or less):
         Hopcroft, John E. A linear algorithm for testing equivalence
         of finite automata. Vol. 114. Defense Technical Information Center, 1971.
+
+        If you want to know why two DFAs are not equivalent, use
+        ``distinguishing_string`` instead.
         """
+        left = flat_form(self)
+        right = flat_form(other)
+        if left is not None and right is not None:
+            return flat_equivalent(left, right)
 
         # The basic idea of this algorithm is that we repeatedly
         # merge states that would be equivalent if the two start
@@ -538,7 +1512,10 @@ class DFA:
             t = find(t)
             table[s] = t
 
-        alphabet = sorted(set(self.alphabet) | set(other.alphabet))
+        # Two bytes that are in the same class in both DFAs always
+        # lead to the same pair of states, so we only need to follow
+        # one byte from each such joint class.
+        alphabet = representatives_of(joint_byte_classes([self, other]))
 
         queue = deque([(self.start, other.start)])
         while queue:
@@ -570,12 +1547,652 @@ class DFA:
         return True
 
 
+class StreamMatcher:
+    """Matches a string against a DFA one chunk at a time, so that
+    arbitrarily large inputs can be checked in constant memory.
+
+    Chunks may be any object supporting the buffer protocol (``bytes``,
+    ``bytearray``, ``memoryview``, ``mmap``...) and are read in place
+    without copying. As soon as the matcher reaches a dead state it
+    stops reading, as no further input can make the string match.
+    """
+
+    def __init__(self, dfa, state=None):
+        self.__dfa = dfa
+        self.__state = dfa.start if state is None else state
+        self.__dead = dfa.is_dead(self.__state)
+        self.__position = 0
+
+    @property
+    def state(self):
+        """The state reached by reading all input so far."""
+        return self.__state
+
+    @property
+    def position(self):
+        """The number of characters read so far. This stops increasing
+        once the matcher is dead."""
+        return self.__position
+
+    @property
+    def accepting(self):
+        """Whether the input read so far is matched by the DFA."""
+        return self.__dfa.is_accepting(self.__state)
+
+    @property
+    def is_dead(self):
+        """Whether no continuation of the input read so far can be
+        matched by the DFA."""
+        return self.__dead
+
+    def feed(self, chunk):
+        """Reads ``chunk`` as the next part of the input. Returns False
+        if the matcher is now dead, in which case the rest of the input
+        need not be fed to it."""
+        if self.__dead:
+            return False
+        transition = self.__dfa.transition
+        is_dead = self.__dfa.is_dead
+        state = self.__state
+        read = 0
+        # Viewing the chunk as unsigned bytes means that iterating over it
+        # gives us integers without copying, whatever its type. We make
+        # sure to release the views afterwards, because e.g. an mmap cannot
+        # be closed while there are views of it.
+        with memoryview(chunk) as view, view.cast("B") as data:
+            for c in data:
+                read += 1
+                next_state = transition(state, c)
+                # A state that transitions to itself can't have changed
+                # whether it is dead, so we only need to check on changes.
+                if next_state != state:
+                    state = next_state
+                    if is_dead(state):
+                        self.__dead = True
+                        break
+        self.__state = state
+        self.__position += read
+        return not self.__dead
+
+    def feed_file(self, file, chunk_size=2**16):
+        """Reads the rest of ``file`` (a binary file object) as the next
+        part of the input, stopping early if the matcher becomes dead.
+        Returns whether the input read is accepted."""
+        buffer = bytearray(chunk_size)
+        with memoryview(buffer) as view:
+            while not self.__dead:
+                n = file.readinto(buffer)
+                if not n:
+                    break
+                self.feed(view[:n])
+        return self.accepting
+
+
+class TokenMasker:
+    """Answers which of a fixed vocabulary of ``tokens`` (each a sequence
+    of bytes) can be appended to strings leading to some state of a DFA,
+    so that the result can still be extended to a match.
+
+    The tokens are stored in a trie, so that tokens with a common prefix
+    share the work of transitioning on it, and we stop as soon as we reach
+    a dead state, which rules out every token below it at once. Results
+    are cached for the ``cache_size`` most recently used states.
+    """
+
+    def __init__(self, dfa, tokens, cache_size=1024):
+        self.__dfa = dfa
+        self.__size = 0
+        # The trie is stored as a list of nodes, with node 0 as its root.
+        # ``children[i]`` maps bytes to the node they lead to from node
+        # ``i``, and ``ends[i]`` lists the ids of the tokens ending there.
+        self.__children = [{}]
+        self.__ends = [[]]
+        for token_id, token in enumerate(tokens):
+            node = 0
+            for c in bytes(token):
+                try:
+                    node = self.__children[node][c]
+                except KeyError:
+                    self.__children[node][c] = len(self.__children)
+                    node = len(self.__children)
+                    self.__children.append({})
+                    self.__ends.append([])
+            self.__ends[node].append(token_id)
+            self.__size += 1
+        self.__cache = LRUCache(max_size=cache_size)
+
+    def __len__(self):
+        return self.__size
+
+    def viable_tokens(self, state):
+        """Returns a read-only NumPy boolean array whose ``i``'th element
+        is whether reading token ``i`` from ``state`` leads to a live
+        state."""
+        try:
+            return self.__cache[state]
+        except KeyError:
+            pass
+        dfa = self.__dfa
+        children = self.__children
+        ends = self.__ends
+        viable = []
+        stack = [(0, state)] if dfa.is_live(state) else []
+        while stack:
+            node, state_at_node = stack.pop()
+            viable.extend(ends[node])
+            for c, child in children[node].items():
+                j = dfa.transition(state_at_node, c)
+                if dfa.is_live(j):
+                    stack.append((child, j))
+        result = np.zeros(self.__size, dtype=bool)
+        result[viable] = True
+        result.flags.writeable = False
+        return self.__cache.setdefault(state, result)
+
+    def viable_tokens_many(self, states):
+        """Returns a 2D NumPy boolean array whose ``i``'th row is
+        ``self.viable_tokens(states[i])``."""
+        result = np.zeros((len(states), self.__size), dtype=bool)
+        for i, state in enumerate(states):
+            result[i] = self.viable_tokens(state)
+        return result
+
+
+def log_matmul(x, y):
+    """Returns ``log(exp(x) @ exp(y))``, for ``x`` a 2D array and ``y``
+    a 1D or 2D array, without leaving log space."""
+    if y.ndim == 1:
+        return np.logaddexp.reduce(x + y, axis=1)
+    result = np.empty((x.shape[0], y.shape[1]))
+    for i, row in enumerate(x):
+        result[i] = np.logaddexp.reduce(row[:, None] + y, axis=0)
+    return result
+
+
+class StringCounter:
+    """Counts the strings of a given length accepted from states of a
+    DFA, using NumPy to work on every state at once.
+
+    The number of strings of length ``n`` accepted from each state is
+    ``M ** n @ a``, where ``M`` is the matrix of transition counts
+    between live states and ``a`` is the vector indicating which of
+    them are accepting. We calculate this either one layer (i.e. one
+    multiplication by ``M``) at a time, which needs memory proportional
+    only to the number of states, or for large ``n`` by repeated
+    squaring of ``M``, whichever is expected to be cheaper.
+
+    Exact counts can be astronomically large, so there are also
+    modes for calculating them modulo some integer and for calculating
+    their natural logarithm as a float, which works in log space
+    throughout.
+    """
+
+    def __init__(self, dfa):
+        self.__dfa = dfa
+        self.__index = {dfa.start: 0}
+        states = [dfa.start]
+        edges = []
+        i = 0
+        while i < len(states):
+            for j, k in dfa.transition_counts(states[i]):
+                if j not in self.__index:
+                    self.__index[j] = len(states)
+                    states.append(j)
+                edges.append((i, self.__index[j], k))
+            i += 1
+        self.__accepting = np.array([dfa.is_accepting(s) for s in states], dtype=bool)
+
+        # We store M sparsely as a list of edges sorted by their source.
+        # To multiply by M we multiply each edge's weight by the value of
+        # its destination, then sum over each run of edges with the same
+        # source, which np.add.reduceat does in one go.
+        self.__sources = np.array([e[0] for e in edges], dtype=np.intp)
+        self.__destinations = np.array([e[1] for e in edges], dtype=np.intp)
+        self.__weights = np.array([e[2] for e in edges], dtype=np.int64)
+        self.__has_edges, self.__runs = np.unique(self.__sources, return_index=True)
+
+    def __len__(self):
+        return len(self.__accepting)
+
+    def __position(self, state):
+        if state is None:
+            return 0
+        try:
+            return self.__index[state]
+        except KeyError:
+            if self.__dfa.is_dead(state):
+                return None
+            raise ValueError(f"State {state!r} is not reachable from the start")
+
+    def __step(self, weights, vector):
+        result = np.zeros(len(self), dtype=vector.dtype)
+        if len(weights):
+            result[self.__has_edges] = np.add.reduceat(
+                weights * vector[self.__destinations], self.__runs
+            )
+        return result
+
+    def __matrix(self, dtype):
+        matrix = np.zeros((len(self), len(self)), dtype=dtype)
+        matrix[self.__sources, self.__destinations] = self.__weights
+        return matrix
+
+    def __use_squaring(self, length):
+        n = len(self)
+        return n**3 * length.bit_length() < length * max(len(self.__weights), 1)
+
+    def __log_step(self, log_weights, vector):
+        result = np.full(len(self), -inf)
+        if len(log_weights):
+            result[self.__has_edges] = np.logaddexp.reduceat(
+                log_weights + vector[self.__destinations], self.__runs
+            )
+        return result
+
+    def __power(self, length, vector, matrix, multiply, step):
+        """Returns ``M ** length @ vector``, in whatever representation
+        ``vector`` is in. ``matrix()`` returns ``M`` in that representation,
+        ``multiply`` multiplies two matrices or a matrix and a vector, and
+        ``step(v)`` calculates ``M @ v`` from the sparse edges."""
+        if self.__use_squaring(length):
+            matrix = matrix()
+            while length:
+                if length & 1:
+                    vector = multiply(matrix, vector)
+                length >>= 1
+                if length:
+                    matrix = multiply(matrix, matrix)
+        else:
+            for _ in range(length):
+                vector = step(vector)
+        return vector
+
+    def __integer_power(self, length, dtype, reduce):
+        """Returns ``M ** length @ a`` as an array of ``dtype``, with
+        ``reduce`` applied to every intermediate result."""
+        weights = self.__weights.astype(dtype)
+        return self.__power(
+            length,
+            reduce(self.__accepting.astype(dtype)),
+            lambda: reduce(self.__matrix(dtype)),
+            lambda x, y: reduce(x @ y),
+            lambda vector: reduce(self.__step(weights, vector)),
+        )
+
+    def count(self, length, state=None, modulus=None):
+        """Returns the number of strings of length ``length`` accepted
+        starting from ``state`` (by default the start state), modulo
+        ``modulus`` if it is given."""
+        assert length >= 0
+        i = self.__position(state)
+        if i is None:
+            return 0
+        if modulus is None:
+            dtype = object
+
+            def reduce(x):
+                return x
+
+        else:
+            if modulus < 1:
+                raise ValueError(f"Invalid modulus {modulus}")
+            # Python integers are much slower than int64, so we only use
+            # them if we can't rule out overflow.
+            largest = max(256, len(self) * (modulus - 1)) * (modulus - 1)
+            dtype = np.int64 if largest < 2**63 else object
+
+            def reduce(x):
+                return x % modulus
+
+        return int(self.__integer_power(length, dtype, reduce)[i])
+
+    def log_count(self, length, state=None):
+        """Returns the natural logarithm of the number of strings of length
+        ``length`` accepted starting from ``state`` (by default the start
+        state), or ``-inf`` if there are none."""
+        assert length >= 0
+        i = self.__position(state)
+        if i is None:
+            return -inf
+
+        # We work with the logarithm of every entry, rather than scaling
+        # them all by a common factor, so that small counts aren't lost
+        # next to large ones. Zero entries become -inf, which behaves as
+        # it should under addition and logaddexp.
+        def log_of(x):
+            with np.errstate(divide="ignore"):
+                return np.log(x.astype(np.float64))
+
+        log_weights = log_of(self.__weights)
+        vector = self.__power(
+            length,
+            log_of(self.__accepting),
+            lambda: log_of(self.__matrix(np.float64)),
+            log_matmul,
+            lambda vector: self.__log_step(log_weights, vector),
+        )
+        return float(vector[i])
+
+    def has_strings(self, length, state=None):
+        """Returns whether any strings of length ``length`` are accepted
+        starting from ``state`` (by default the start state)."""
+        assert length >= 0
+        i = self.__position(state)
+        if i is None:
+            return False
+
+        def reduce(x):
+            # Clamping to 0 or 1 means this can never overflow.
+            return np.minimum(x, 1)
+
+        return bool(self.__integer_power(length, np.int64, reduce)[i])
+
+
 DEAD = "DEAD"
 
+# A state that matches every string, used by ``ComplementDFA`` in place of
+# the ``DEAD`` state of the DFA it complements.
+UNIVERSAL = "UNIVERSAL"
+
+# Stands in for the state of a pattern that can no longer match in the
+# states of a ``MultiPatternDFA``. This is never passed to the pattern,
+# so doesn't need to be distinct from its states.
+STOPPED = "STOPPED"
+
+ALPHABET_SIZE = 256
+
+ARRAY_CODES = ["B", "H", "I", "L", "Q"]
+
+
+def byte_classes_of_rows(rows):
+    """Calculates ``DFA.byte_classes`` from a transition table.
+
+    ``rows`` is an iterable with one element per state, each of
+    which is an iterable of (byte, state) pairs. Any byte not
+    present in a row is assumed to go to the same (dead) state.
+    """
+    # Each byte has a label, with bytes in the same class having the
+    # same label. Processing a row gives every byte in it a fresh label
+    # determined by its old one and where it goes, which splits classes
+    # exactly where the row disagrees with them while only looking at
+    # the bytes in the row. Bytes not in the row keep their old label,
+    # which can't clash with any of the fresh ones.
+    labels = [0] * ALPHABET_SIZE
+    fresh = 1
+    for row in rows:
+        relabelled = {}
+        for c, j in row:
+            key = (labels[c], j)
+            try:
+                labels[c] = relabelled[key]
+            except KeyError:
+                labels[c] = relabelled[key] = fresh
+                fresh += 1
+    classes = {label: k for k, label in enumerate(dict.fromkeys(labels))}
+    return bytes(map(classes.__getitem__, labels))
+
+
+def byte_classes_of_intervals(tables):
+    """Calculates ``DFA.byte_classes`` from a transition table in which
+    each state's transitions are given as a list of disjoint intervals
+    ``(u, v, j)``, as returned by ``intervals_of_table``."""
+    # Bytes between consecutive ends of intervals always go to the same
+    # state as each other, so we work out the classes of these segments
+    # rather than of every byte, which is much cheaper when intervals
+    # are large.
+    # We mark the first byte of every segment but the first, so that
+    # summing the marks up to a byte gives the index of its segment.
+    marks = bytearray(ALPHABET_SIZE + 1)
+    for intervals in tables:
+        for u, v, _ in intervals:
+            marks[u] = marks[v + 1] = 1
+    marks[0] = 0
+    segment_of = bytes(accumulate(marks[:ALPHABET_SIZE]))
+    segment_classes = byte_classes_of_rows(
+        [
+            (k, j)
+            for u, v, j in intervals
+            for k in range(segment_of[u], segment_of[v] + 1)
+        ]
+        for intervals in tables
+    )
+    # The segments are in ascending order, so their classes are already
+    # numbered in order of their smallest byte.
+    return bytes(segment_of.translate(segment_classes))
+
+
+def representatives_of(classes):
+    """Given byte classes as returned by ``DFA.byte_classes``,
+    returns a tuple of the smallest byte in each class."""
+    representatives = {}
+    for c, k in enumerate(classes):
+        representatives.setdefault(k, c)
+    return tuple(representatives.values())
+
+
+def joint_byte_classes(dfas):
+    """Returns byte classes for the coarsest partition of bytes that
+    refines the byte classes of each of ``dfas``, i.e. two bytes are
+    in the same class if and only if they are in the same class for
+    every one of ``dfas``."""
+    keys = {}
+    return bytes(
+        keys.setdefault(key, len(keys))
+        for key in zip(*(dfa.byte_classes() for dfa in dfas))
+    )
+
+
+# Limits on the size of a CompiledDFA for approximate matching to work
+# with sets of states as bitmasks, which needs tables with an entry for
+# every byte class (plus one for any byte), every block of eight
+# consecutive states and every subset of such a block. These take about a
+# microsecond per entry to build, and the bitmasks grow with the number
+# of states, so past these we use the general approach instead.
+BIT_PARALLEL_MAX_STATES = 256
+BIT_PARALLEL_MAX_TABLE_ITEMS = 2**17
+
+
+def uses_bit_parallel(dfa):
+    """Returns True if approximate matching with ``dfa`` should be done
+    with sets of states as bitmasks, as described above."""
+    n = len(dfa)
+    items = (len(dfa.class_representatives()) + 1) * -(-n // 8) * 256
+    return n <= BIT_PARALLEL_MAX_STATES and items <= BIT_PARALLEL_MAX_TABLE_ITEMS
+
+
+# The most entries ``CompiledDFA.run_all`` will put in a table of
+# compositions of functions, or gather from it at once.
+RUN_ALL_TABLE_ITEMS = 2**20
+RUN_ALL_BLOCK_ITEMS = 2**22
+
+STORED_MAGIC = b"JDFA"
+
+STORED_VERSION = 1
+
+STORED_ALIGNMENT = 8
+
+# magic, version, byte order, item size, number of states, start state.
+STORED_HEADER = struct.Struct("<4sBBBxQQ")
+
+STORED_BYTE_ORDERS = ("little", "big")
+
+STORED_ITEM_CODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def typed_array(values):
+    """Returns an ``array`` of ``values`` using the smallest
+    unsigned integer type that can hold all of them."""
+    for code in ARRAY_CODES:
+        try:
+            return array(code, values)
+        except OverflowError:
+            pass
+    raise OverflowError(f"Values too large to store in an array: {max(values)}")
+
+
+# The DFA being enumerated by parallel_matching_strings in this worker
+# process, which is set when the worker starts rather than being sent
+# with every task.
+worker_dfa = None
+
+
+def set_worker_dfa(dfa):
+    global worker_dfa
+    worker_dfa = dfa
+
+
+def matching_strings_in_range(length, start, stop):
+    """Returns the matching strings of ``worker_dfa`` with length
+    ``length`` and ranks in ``range(start, stop)``."""
+    first = worker_dfa.unrank(length, start)
+    rest = worker_dfa.all_matching_strings_of_length(length, after=first)
+    return [first, *islice(rest, stop - start - 1)]
+
+
+def set_worker_input(dfa, source):
+    """Sets ``worker_dfa`` to ``dfa``, and ``worker_input`` to a view of
+    the input described by ``source``: Either ``("file", path)`` to map
+    the file at ``path`` into memory, or ``("shared", name, size)`` for
+    the first ``size`` bytes of an existing ``SharedMemory``."""
+    global worker_input, worker_input_owner
+    set_worker_dfa(dfa)
+    if source[0] == "file":
+        with open(source[1], "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap refuses to map an empty file.
+                worker_input_owner = None
+                worker_input = memoryview(b"")
+                return
+            worker_input_owner = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        worker_input = memoryview(worker_input_owner)
+    else:
+        _, name, size = source
+        # Worker processes share their parent's resource tracker, so the
+        # parent unlinking this when it's done is all the cleanup needed.
+        worker_input_owner = SharedMemory(name=name)
+        worker_input = worker_input_owner.buf[:size]
+
+
+def run_all_in_range(start, stop):
+    """Returns ``worker_dfa.run_all`` of ``worker_input[start:stop]``."""
+    return worker_dfa.run_all(worker_input[start:stop])
+
+
+def accepting_positions_in_range(start, stop, state):
+    """Returns the positions ``p`` in ``range(start, stop + 1)`` such that
+    reading ``worker_input[start:p]`` from ``state`` ends in an accepting
+    state of ``worker_dfa``, except for ``start`` itself unless it is 0
+    (because then it is the end of the previous chunk)."""
+    positions = worker_dfa.accepting_positions(worker_input[start:stop], state)
+    if start > 0 and len(positions) and positions[0] == 0:
+        positions = positions[1:]
+    return start + positions
+
+
+def flat_form(dfa):
+    """Returns a ``CompiledDFA`` matching the same language as ``dfa``
+    if one is cheaply available, or None otherwise."""
+    if isinstance(dfa, CompiledDFA):
+        return dfa
+    if isinstance(dfa, ConcreteDFA):
+        return dfa.compile()
+    return None
+
+
+def flat_columns(left, right):
+    """Returns the smallest byte of each joint byte class of two
+    ``CompiledDFA``s, together with a list for each of them whose
+    ``i``'th element lists the successors of state ``i`` on each of
+    those bytes in turn."""
+    alphabet = representatives_of(joint_byte_classes([left, right]))
+    successors = []
+    for dfa in (left, right):
+        classes = dfa.byte_classes()
+        rows = np.asarray(dfa.table).reshape(len(dfa), -1)
+        successors.append(rows[:, [classes[c] for c in alphabet]].tolist())
+    return alphabet, *successors
+
+
+def flat_equivalent(left, right):
+    """Implements ``DFA.equivalent`` for two ``CompiledDFA``s, working
+    directly on their tables with integers rather than on states."""
+    # This is the same algorithm as in DFA.equivalent, but with the
+    # states of right numbered after those of left so that the union
+    # find can be a flat list.
+    _, left_successors, right_successors = flat_columns(left, right)
+    left_accepting = left.accepting
+    right_accepting = right.accepting
+    offset = len(left)
+    table = list(range(offset + len(right)))
+
+    def find(s):
+        while table[s] != s:
+            table[s] = s = table[table[s]]
+        return s
+
+    # Unlike DFA.equivalent we don't care about the order in which we
+    # do merges, so we use a stack as it's slightly cheaper.
+    stack = [(left.start, right.start)]
+    while stack:
+        i, j = stack.pop()
+        s = find(i)
+        t = find(offset + j)
+        if s == t:
+            continue
+        if bool(left_accepting[i]) != bool(right_accepting[j]):
+            return False
+        table[s] = t
+        stack.extend(zip(left_successors[i], right_successors[j]))
+    return True
+
+
+def flat_distinguishing_string(left, right):
+    """Implements ``DFA.distinguishing_string`` for two ``CompiledDFA``s,
+    working directly on their tables."""
+    # This is a breadth first search over pairs of states, exactly
+    # as in shortest_string, but with each pair packed into a single
+    # integer.
+    alphabet, left_successors, right_successors = flat_columns(left, right)
+    left_accepting = left.accepting
+    right_accepting = right.accepting
+    m = len(right)
+
+    start = left.start * m + right.start
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        pair = queue.popleft()
+        i, j = divmod(pair, m)
+        if bool(left_accepting[i]) != bool(right_accepting[j]):
+            path = bytearray()
+            while parents[pair] is not None:
+                pair, c = parents[pair]
+                path.append(c)
+            path.reverse()
+            return bytes(path)
+        for c, u, v in zip(alphabet, left_successors[i], right_successors[j]):
+            successor = u * m + v
+            if successor not in parents:
+                parents[successor] = (pair, c)
+                queue.append(successor)
+    return None
+
+
+# Compiled regexes, as in the re module's cache.
+REGEX_CACHE = LRUCache(max_size=512, thread_safe=True)
+
 
 class ConcreteDFA(DFA):
     """A concrete representation of a DFA in terms of an explicit list
-    of states."""
+    of states.
+
+    Transitions are stored compactly, in the style of a compressed sparse
+    row matrix: Each state's transitions are a sorted run of intervals of
+    bytes that all go to the same state, and the runs for all states are
+    stored in a few flat arrays, with lookups done by bisection. A state
+    whose intervals would take up at least as much space as a row with an
+    entry for every byte class is stored as such a row instead, which is
+    much faster to look up."""
 
     def __init__(self, transitions, accepting, start=0):
         """
@@ -585,7 +2202,8 @@ class ConcreteDFA(DFA):
           are a list they may contain tuples of length 2 or 3. A tuple ``(c, j)``
           indicates that this state transitions to state ``j`` given ``c``. A
           tuple ``(u, v, j)`` indicates this state transitions to state ``j``
-          given any ``c`` with ``u <= c <= v``.
+          given any ``c`` with ``u <= c <= v``. If several tuples in a list
+          apply to the same byte, the first one is used.
         * ``accepting`` is a set containing the integer labels of accepting
           states.
         * ``start`` is the integer label of the starting state.
@@ -593,25 +2211,79 @@ class ConcreteDFA(DFA):
         super().__init__()
         self.__start = start
         self.__accepting = accepting
-        self.__transitions = list(transitions)
+
+        tables = [intervals_of_table(table) for table in transitions]
+        n = len(tables)
+        classes = byte_classes_of_intervals(tables)
+        width = max(classes) + 1
+        # Dense rows use n to mean DEAD, so we need to be able to store it.
+        itemsize = typed_array([n]).itemsize
+
+        offsets = [0]
+        starts = bytearray()
+        ends = bytearray()
+        targets = []
+        # For each state, the index in ``dense`` at which its dense row
+        # starts, or None if it is stored as intervals.
+        bases = [None] * n
+        dense = []
+        max_intervals = -(-width * itemsize // (2 + itemsize))
+        for i, intervals in enumerate(tables):
+            if len(intervals) >= max_intervals:
+                bases[i] = len(dense)
+                dense.extend([n] * width)
+                for u, v, j in intervals:
+                    for k in set(classes[u : v + 1]):
+                        dense[bases[i] + k] = j
+            elif intervals:
+                state_starts, state_ends, state_targets = zip(*intervals)
+                starts.extend(state_starts)
+                ends.extend(state_ends)
+                targets.extend(state_targets)
+            offsets.append(len(targets))
+        self.__classes = classes
+        self.__bases = bases
+        self.__dense = typed_array(dense)
+        self.__dead = n
+        self.__width = width
+        self.__offsets = typed_array(offsets)
+        self.__starts = bytes(starts)
+        self.__ends = bytes(ends)
+        self.__targets = typed_array(targets)
+
+    @classmethod
+    def from_regex(cls, pattern):
+        """Returns a DFA matching exactly the strings that fully match
+        ``pattern``, a ``bytes`` regular expression using the subset of
+        Python's syntax described in ``byteregex``. Raises ValueError if
+        the pattern is invalid or uses unsupported features.
+
+        As with the ``re`` module, compiled patterns are cached, so calling
+        this repeatedly with the same pattern returns the same DFA."""
+        key = (cls, pattern)
+        try:
+            return REGEX_CACHE[key]
+        except KeyError:
+            pass
+        transitions, accepting = compile_regex(pattern)
+        return REGEX_CACHE.setdefault(key, cls(transitions, accepting))
 
     def __repr__(self):
         transitions = []
         # Particularly for including in source code it's nice to have the more
         # compact repr, so where possible we convert to the tuple based representation
         # which can represent ranges more compactly.
-        for i in range(len(self.__transitions)):
-            table = []
-            for c, j in self.transitions(i):
-                if not table or j != table[-1][-1] or c != table[-1][1] + 1:
-                    table.append([c, c, j])
-                else:
-                    table[-1][1] = c
-            transitions.append([(u, j) if u == v else (u, v, j) for u, v, j in table])
+        for i in range(len(self)):
+            transitions.append(
+                [(u, j) if u == v else (u, v, j) for u, v, j in self.__intervals(i)]
+            )
 
         start = "" if self.__start == 0 else f", start={self.__start!r}"
         return f"ConcreteDFA({transitions!r}, {self.__accepting!r}{start})"
 
+    def __len__(self):
+        return len(self.__offsets) - 1
+
     @property
     def start(self):
         return self.__start
@@ -622,52 +2294,1005 @@ class ConcreteDFA(DFA):
     def transition(self, state, char):
         """Returns the state that i transitions to on reading
         character c from a string."""
-        if state == DEAD:
+        try:
+            base = self.__bases[state]
+        except TypeError:
+            # The only state that isn't an integer is DEAD, and letting the
+            # lookup fail is cheaper than checking for it every time.
+            return DEAD
+        if base is None:
+            offsets = self.__offsets
+            lo = offsets[state]
+            k = bisect_right(self.__starts, char, lo, offsets[state + 1]) - 1
+            if k >= lo and char <= self.__ends[k]:
+                return self.__targets[k]
             return DEAD
+        j = self.__dense[base + self.__classes[char]]
+        return DEAD if j == self.__dead else j
 
-        table = self.__transitions[state]
+    def matches(self, s):
+        # This is transition inlined, which is much faster than calling
+        # it for every byte.
+        classes = self.__classes
+        bases = self.__bases
+        dense = self.__dense
+        offsets = self.__offsets
+        starts = self.__starts
+        ends = self.__ends
+        targets = self.__targets
+        dead = self.__dead
+        state = self.__start
+        for c in s:
+            base = bases[state]
+            if base is not None:
+                state = dense[base + classes[c]]
+                if state == dead:
+                    return False
+                continue
+            lo = offsets[state]
+            k = bisect_right(starts, c, lo, offsets[state + 1]) - 1
+            if k < lo or c > ends[k]:
+                return False
+            state = targets[k]
+        return state in self.__accepting
 
-        # Given long transition tables we convert them to
-        # dictionaries for more efficient lookup.
-        if not isinstance(table, dict) and len(table) >= 5:
-            new_table = {}
-            for t in table:
-                if len(t) == 2:
-                    new_table[t[0]] = t[1]
-                else:
-                    u, v, j = t
-                    for c in range(u, v + 1):
-                        new_table[c] = j
-            self.__transitions[state] = new_table
-            table = new_table
+    def byte_classes(self):
+        return self.__classes
 
-        if isinstance(table, dict):
-            try:
-                return self.__transitions[state][char]
-            except KeyError:
-                return DEAD
+    def successor_states(self, state):
+        # It's cheaper to read these directly off our tables than to go
+        # through raw_class_transitions.
+        row = self.__class_row(state)
+        if row is None:
+            targets = (j for _, _, j in self.__intervals(state))
         else:
-            for t in table:
-                if len(t) == 2:
-                    if t[0] == char:
-                        return t[1]
-                else:
-                    u, v, j = t
-                    if u <= char <= v:
-                        return j
-            return DEAD
+            targets = (j for j in row if j != self.__dead)
+        return tuple(dict.fromkeys(targets))
+
+    def raw_class_transitions(self, i):
+        # Reading these off our tables is cheaper than looking up each
+        # class separately, and means that as with raw_transitions we
+        # omit any transitions to DEAD.
+        row = self.__class_row(i)
+        if row is not None:
+            dead = self.__dead
+            for c, j in zip(self.class_representatives(), row):
+                if j != dead:
+                    yield c, j
+            return
+        classes = self.byte_classes()
+        seen = set()
+        for c, j in self.raw_transitions(i):
+            k = classes[c]
+            if k not in seen:
+                seen.add(k)
+                yield c, j
+
+    @cached
+    def compile(self):
+        """Returns a ``CompiledDFA`` matching the same language as this one,
+        with every transition stored in a single dense table (with one
+        column per byte class).
+
+        States keep their labels, and one extra state is added at the end
+        to stand in for ``DEAD``."""
+        classes = self.byte_classes()
+        width = len(self.class_representatives())
+        n = len(self)
+        table = [n] * ((n + 1) * width)
+        for i in range(n):
+            base = i * width
+            for c, j in self.raw_class_transitions(i):
+                table[base + classes[c]] = j
+        accepting = bytes(i in self.__accepting for i in range(n + 1))
+        return CompiledDFA(typed_array(table), accepting, self.__start, classes)
+
+    def to_python_source(self, name="matches"):
+        """Returns the source code of a Python module defining a matcher
+        for this DFA. See ``CompiledDFA.to_python_source``."""
+        return self.compile().to_python_source(name)
+
+    def compile_function(self, name="matches"):
+        """Returns a standalone function that matches the same strings
+        as this DFA. See ``CompiledDFA.compile_function``."""
+        return self.compile().compile_function(name)
+
+    def edit_distance(self, s, max_distance):
+        # Compiling lets us use sets of states as bitmasks, which is much
+        # faster if the tables for that aren't too large.
+        if uses_bit_parallel(self):
+            return self.compile().edit_distance(s, max_distance)
+        return super().edit_distance(s, max_distance)
+
+    def search_within(self, s, k):
+        if uses_bit_parallel(self):
+            return self.compile().search_within(s, k)
+        return super().search_within(s, k)
+
+    def parallel_matches(self, data, **kwargs):
+        """Returns ``self.matches(data)``, calculated in parallel. See
+        ``CompiledDFA.parallel_run``."""
+        return self.compile().parallel_matches(data, **kwargs)
+
+    def parallel_accepting_positions(self, data, **kwargs):
+        """Returns the positions ``p`` such that ``self.matches(data[:p])``,
+        calculated in parallel. See ``CompiledDFA.parallel_run``."""
+        return self.compile().parallel_accepting_positions(data, **kwargs)
 
     def raw_transitions(self, i):
+        for u, v, j in self.__intervals(i):
+            for c in range(u, v + 1):
+                yield c, j
+
+    def __class_row(self, i):
+        """Returns the targets of state ``i`` for each byte class if it is
+        stored as a row over them, or None otherwise."""
+        if i == DEAD:
+            return None
+        base = self.__bases[i]
+        if base is None:
+            return None
+        return self.__dense[base : base + self.__width]
+
+    def __intervals(self, i):
+        """Yields triples ``(u, v, j)`` such that state ``i`` transitions
+        to ``j`` on any byte ``u <= c <= v``, in ascending order, with
+        adjacent intervals always going to different states."""
         if i == DEAD:
             return
-        transitions = self.__transitions[i]
-        if isinstance(transitions, dict):
-            yield from sorted(transitions.items())
+        base = self.__bases[i]
+        if base is None:
+            for k in range(self.__offsets[i], self.__offsets[i + 1]):
+                yield self.__starts[k], self.__ends[k], self.__targets[k]
+            return
+        row = [self.__dense[base + k] for k in self.__classes]
+        u = 0
+        for c in range(1, ALPHABET_SIZE + 1):
+            if c == ALPHABET_SIZE or row[c] != row[u]:
+                if row[u] != self.__dead:
+                    yield u, c - 1, row[u]
+                u = c
+
+
+def intervals_of_table(table):
+    """Converts a single state's transitions, in any of the forms accepted
+    by ``ConcreteDFA``, to a sorted list of disjoint intervals ``(u, v, j)``
+    meaning that any byte ``u <= c <= v`` goes to state ``j``, merging
+    adjacent intervals that go to the same state."""
+    if isinstance(table, dict):
+        entries = [(c, c, table[c]) for c in sorted(table)]
+    else:
+        entries = []
+        for t in table:
+            if len(t) == 2:
+                c, j = t
+                entries.append((c, c, j))
+            else:
+                entries.append(tuple(t))
+        if any(u > v for u, v, _ in entries):
+            raise ValueError(f"Invalid transitions {table!r}")
+        # If any of the entries overlap then the first one to match a byte
+        # wins, and the easiest way to work that out is one byte at a time.
+        ordered = sorted(entries)
+        if any(ordered[k][0] <= ordered[k - 1][1] for k in range(1, len(ordered))):
+            targets = {}
+            for u, v, j in entries:
+                for c in range(u, v + 1):
+                    targets.setdefault(c, j)
+            ordered = sorted((c, c, j) for c, j in targets.items())
+        entries = ordered
+    intervals = []
+    for interval in entries:
+        u, v, j = interval
+        if j == DEAD:
+            continue
+        if intervals:
+            last_u, last_v, last_j = intervals[-1]
+            if last_j == j and last_v == u - 1:
+                intervals[-1] = (last_u, v, j)
+                continue
+        intervals.append(interval)
+    return intervals
+
+
+class CompiledDFA(DFA):
+    """A DFA whose transitions are stored as a dense table of integers,
+    for fast matching. Usually obtained from ``ConcreteDFA.compile()``.
+
+    States are the integers in ``range(len(self))``, and there is no
+    ``DEAD`` sentinel: a state with no way to reach an accepting one is
+    just an ordinary state that happens to transition to itself.
+
+    The table has one column per byte class rather than per byte, which
+    typically makes it many times smaller. Input is translated from bytes
+    to classes with ``bytes.translate`` before matching, which costs
+    almost nothing.
+
+    A CompiledDFA can be written out with ``save`` or ``to_bytes``, and
+    read back with ``load`` or ``from_buffer``, which use the stored
+    table in place rather than copying it.
+    """
+
+    def __init__(self, table, accepting, start=0, classes=None):
+        """
+        * ``table`` is a flat sequence of integers supporting the buffer
+          protocol (e.g. an ``array``), where ``table[i * width + k]`` is
+          the state that state ``i`` transitions to on reading a byte of
+          class ``k``, with ``width`` being the number of classes.
+        * ``accepting`` is a sequence with one entry per state, which is
+          truthy if and only if that state is accepting.
+        * ``start`` is the integer label of the starting state.
+        * ``classes`` is a ``bytes`` of length 256 mapping each byte to
+          its class, numbered in order of the smallest byte in each class.
+          If it is not given, every byte is in its own class.
+        """
+        super().__init__()
+        if classes is None:
+            classes = bytes(range(ALPHABET_SIZE))
+        classes = bytes(classes)
+        if len(classes) != ALPHABET_SIZE:
+            raise ValueError(f"Expected {ALPHABET_SIZE} byte classes")
+        width = len(representatives_of(classes))
+        if list(dict.fromkeys(classes)) != list(range(width)):
+            raise ValueError(
+                "Byte classes must be numbered in order of their smallest byte"
+            )
+        if len(table) % width != 0:
+            raise ValueError(f"Table length {len(table)} is not a multiple of {width}")
+        n = len(table) // width
+        if len(accepting) != n:
+            raise ValueError(f"Expected {n} accepting flags but got {len(accepting)}")
+        self.__table = table
+        self.__accepting = accepting
+        self.__start = start
+        self.__classes = classes
+
+        # Slicing a memoryview doesn't copy, so this gives us a row per
+        # state for the cost of a handful of small objects, and indexing
+        # ``rows[i][k]`` turns out to be faster than doing the arithmetic
+        # to index into the flat table directly.
+        view = memoryview(table)
+        self.__rows = [view[i * width : (i + 1) * width] for i in range(n)]
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __reduce__(self):
+        # Our table may be a view of a mapped file, and our rows are views
+        # of it, so we pickle ourself in our serialised form instead.
+        return (CompiledDFA.from_buffer, (self.to_bytes(),))
+
+    @property
+    def table(self):
+        """The flat transition table this DFA was created with."""
+        return self.__table
+
+    @property
+    def accepting(self):
+        """The accepting flags this DFA was created with."""
+        return self.__accepting
+
+    @property
+    def start(self):
+        return self.__start
+
+    def is_accepting(self, i):
+        return bool(self.__accepting[i])
+
+    def transition(self, i, c):
+        return self.__rows[i][self.__classes[c]]
+
+    def byte_classes(self):
+        return self.__classes
+
+    def raw_class_transitions(self, i):
+        return zip(self.class_representatives(), self.__rows[i])
+
+    def raw_transitions(self, i):
+        row = self.__rows[i]
+        for c, k in enumerate(self.__classes):
+            yield c, row[k]
+
+    def run(self, s, state=None):
+        """Returns the state reached by reading ``s``, starting from
+        ``state`` (or from the start state if it is not given)."""
+        rows = self.__rows
+        if state is None:
+            state = self.__start
+        for k in bytes(s).translate(self.__classes):
+            state = rows[state][k]
+        return state
+
+    def matches(self, s):
+        rows = self.__rows
+        state = self.__start
+        for k in bytes(s).translate(self.__classes):
+            state = rows[state][k]
+        return bool(self.__accepting[state])
+
+    def viable_bytes_many(self, states):
+        # With a dense table we can do every state at once: look up the
+        # row of targets for each state and check which of them are live.
+        table = np.asarray(self.__table).reshape(len(self), -1)
+        targets = table[np.asarray(states, dtype=np.intp)]
+        live = self.__live_states()[targets]
+        return live[:, np.frombuffer(self.__classes, dtype=np.uint8)]
+
+    @cached
+    def __live_states(self):
+        return np.array([self.is_live(i) for i in range(len(self))], dtype=bool)
+
+    def edit_distance(self, s, max_distance):
+        if not uses_bit_parallel(self):
+            return super().edit_distance(s, max_distance)
+        levels = None
+        for levels in self.__edit_levels(s, max_distance, search=False):
+            if not levels[-1]:
+                return None
+        return self.__best_level(levels)
+
+    def search_within(self, s, k):
+        if not uses_bit_parallel(self):
+            yield from super().search_within(s, k)
+            return
+        for v, levels in enumerate(self.__edit_levels(s, k, search=True)):
+            d = self.__best_level(levels)
+            if d is not None:
+                yield (v, d)
+
+    def __best_level(self, levels):
+        accepting = self.__bit_tables()[2]
+        for d, states in enumerate(levels):
+            if states & accepting:
+                return d
+        return None
+
+    def __edit_levels(self, s, k, search):
+        """Yields the same information as ``DFA.__edit_costs``, but as a
+        list whose ``d``'th element is the set of states reachable with at
+        most ``d`` edits, as a bitmask. Working with whole sets of states
+        at once like this is much faster when there aren't many states."""
+        if k < 0:
+            raise ValueError(f"Invalid edit distance {k}")
+        steps, any_steps, _, start = self.__bit_tables()
+
+        def step(states, tables):
+            result = 0
+            for table in tables:
+                if not states:
+                    break
+                result |= table[states & 255]
+                states >>= 8
+            return result
+
+        def insert(levels):
+            for d in range(1, k + 1):
+                levels[d] |= levels[d - 1] | step(levels[d - 1], any_steps)
+            return levels
+
+        levels = insert([start] + [0] * k)
+        yield levels
+        for x in bytes(s).translate(self.__classes):
+            tables = steps[x]
+            new_levels = [step(levels[0], tables)]
+            for d in range(1, k + 1):
+                # Reading the byte, substituting it, or deleting it.
+                previous = levels[d - 1]
+                new_levels.append(
+                    step(levels[d], tables) | step(previous, any_steps) | previous
+                )
+            if search:
+                new_levels = [states | start for states in new_levels]
+            levels = insert(new_levels)
+            yield levels
+
+    @cached
+    def __bit_tables(self):
+        """Returns a tuple ``(steps, any_steps, accepting, start)`` for
+        working with sets of live states represented as bitmasks.
+
+        ``steps[k][j][v]`` is the set of live states reached on a byte of
+        class ``k`` from the states ``8 * j + i`` for each bit ``i`` set in
+        the byte ``v``, and ``any_steps[j][v]`` is the same for bytes of any
+        class. ``accepting`` and ``start`` are the sets of accepting states
+        and of the start state (if it is live)."""
+        n = len(self)
+        width = len(self.class_representatives())
+        live = [not self.is_dead(i) for i in range(n)]
+        steps = [[] for _ in range(width)]
+        any_steps = []
+        for base in range(0, n, 8):
+            any_table = [0] * 256
+            for k in range(width):
+                table = [0] * 256
+                for v in range(1, 256):
+                    low = v & -v
+                    i = base + low.bit_length() - 1
+                    table[v] = table[v ^ low]
+                    if i < n and live[self.__rows[i][k]]:
+                        table[v] |= 1 << self.__rows[i][k]
+                    any_table[v] |= table[v]
+                steps[k].append(table)
+            any_steps.append(any_table)
+        accepting = sum(1 << i for i in range(n) if self.__accepting[i])
+        start = 1 << self.__start if live[self.__start] else 0
+        return steps, any_steps, accepting, start
+
+    def accepting_positions(self, s, state=None):
+        """Returns a NumPy array of every ``p`` such that reading ``s[:p]``
+        from ``state`` (or from the start state if it is not given) ends
+        in an accepting state, in ascending order."""
+        rows = self.__rows
+        accepting = self.__accepting
+        if state is None:
+            state = self.__start
+        positions = [0] if accepting[state] else []
+        for i, k in enumerate(bytes(s).translate(self.__classes), 1):
+            state = rows[state][k]
+            if accepting[state]:
+                positions.append(i)
+        return np.array(positions, dtype=np.int64)
+
+    def run_all(self, s):
+        """Returns a NumPy array whose ``i``'th element is ``self.run(s, i)``,
+        i.e. the state reached by reading ``s`` from every state at once.
+
+        Rather than reading ``s`` once per state, we look up the column of
+        the table for each byte, which is the function mapping each state to
+        the one it transitions to, and compose these in pairs until only
+        one is left. This is all done with NumPy, and never depends on the
+        result of running any other part of the input, which makes it easy
+        to parallelise."""
+        n = len(self)
+        table = np.asarray(self.__table).reshape(n, -1)
+        # Each row of ``maps`` is a function from states to states, and
+        # ``codes`` is the sequence of functions to compose, as indices
+        # into it. We start with a function for each byte class, plus the
+        # identity to use as padding.
+        maps = np.concatenate([table.T, np.arange(n, dtype=table.dtype)[None]])
+        identity = len(maps) - 1
+        codes = np.frombuffer(bytes(s).translate(self.__classes), dtype=np.uint8)
+        codes = codes.astype(np.intp)
+
+        # Composing pairs of codes is much cheaper than composing pairs of
+        # functions, so while there aren't too many pairs we replace maps
+        # with all of its compositions, and codes with codes for each pair.
+        while len(codes) > 1 and len(maps) ** 2 * n <= RUN_ALL_TABLE_ITEMS:
+            if len(codes) % 2:
+                codes = np.append(codes, identity)
+            width = len(maps)
+            maps = np.take_along_axis(
+                np.tile(maps, (width, 1)), np.repeat(maps, width, axis=0), axis=1
+            )
+            codes = codes[0::2] * width + codes[1::2]
+            identity = identity * width + identity
+
+        result = np.arange(n)
+        # Composing the remaining functions needs a copy of each of them,
+        # so we work through them in blocks to keep that from getting too
+        # large.
+        block_size = max(1, RUN_ALL_BLOCK_ITEMS // max(n, 1))
+        for start in range(0, len(codes), block_size):
+            block = maps[codes[start : start + block_size]]
+            while len(block) > 1:
+                m = len(block) // 2 * 2
+                # Applying block[i] and then block[i + 1] takes each state
+                # s to block[i + 1][block[i][s]].
+                composed = np.take_along_axis(block[1:m:2], block[0:m:2], axis=1)
+                if m < len(block):
+                    composed = np.concatenate([composed, block[m:]])
+                block = composed
+            result = block[0][result]
+        return result
+
+    def parallel_run(self, data, *, state=None, processes=None, chunk_size=2**24):
+        """Returns ``self.run(data, state)``, splitting ``data`` into chunks
+        of ``chunk_size`` bytes and running them in a pool of ``processes``
+        worker processes (by default one per CPU).
+
+        A chunk can't be run until we know what state the chunks before
+        it finished in, so instead each worker calculates ``run_all`` for
+        its chunk, and we compose the results. This is only worth doing
+        for DFAs with few states and inputs large enough to make up for
+        the cost of starting the workers.
+
+        ``data`` may be any object supporting the buffer protocol, which
+        is copied once into shared memory for the workers to read, or
+        the path of a file, which each worker maps into memory itself."""
+        if state is None:
+            state = self.__start
+        with self.__workers(data, processes, chunk_size) as (executor, chunks):
+            return self.__chunk_start_states(executor, chunks, state)[-1]
+
+    def parallel_matches(self, data, **kwargs):
+        """Returns ``self.matches(data)``, using ``parallel_run``, which
+        see for the arguments."""
+        return self.is_accepting(self.parallel_run(data, **kwargs))
+
+    def parallel_accepting_positions(
+        self, data, *, state=None, processes=None, chunk_size=2**24
+    ):
+        """Returns ``self.accepting_positions(data, state)``, calculated
+        in parallel with the same arguments as ``parallel_run``.
+
+        This takes two passes over ``data``: First we find the state that
+        each chunk starts in as ``parallel_run`` does, and then we find the
+        accepting positions in every chunk at once."""
+        if state is None:
+            state = self.__start
+        with self.__workers(data, processes, chunk_size) as (executor, chunks):
+            states = self.__chunk_start_states(executor, chunks, state)
+            futures = [
+                executor.submit(accepting_positions_in_range, start, stop, chunk_state)
+                for (start, stop), chunk_state in zip(chunks, states)
+            ]
+            return np.concatenate([future.result() for future in futures])
+
+    def __chunk_start_states(self, executor, chunks, state):
+        """Returns a list of the state that each of ``chunks`` starts in
+        when reading from ``state``, followed by the final state."""
+        futures = [executor.submit(run_all_in_range, *chunk) for chunk in chunks]
+        states = [state]
+        for future in futures:
+            states.append(int(future.result()[states[-1]]))
+        return states
+
+    @contextmanager
+    def __workers(self, data, processes, chunk_size):
+        """Starts a pool of worker processes with ``worker_dfa`` set to this
+        DFA and ``worker_input`` set to ``data``, and yields it along with
+        a list of ranges ``(start, stop)`` splitting ``data`` into chunks."""
+        if chunk_size <= 0:
+            raise ValueError(f"Invalid chunk_size {chunk_size}")
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        shared = None
+        if isinstance(data, (str, os.PathLike)):
+            source = ("file", os.fspath(data))
+            size = os.path.getsize(data)
+        else:
+            with memoryview(data) as view, view.cast("B") as data_bytes:
+                size = len(data_bytes)
+                # A SharedMemory can't be empty.
+                shared = SharedMemory(create=True, size=max(size, 1))
+                shared.buf[:size] = data_bytes
+            source = ("shared", shared.name, size)
+        # We always have at least one chunk, even if it's empty, so that
+        # there's somewhere to report an accepting start state from.
+        chunks = [
+            (start, min(start + chunk_size, size))
+            for start in range(0, max(size, 1), chunk_size)
+        ]
+        try:
+            executor = ProcessPoolExecutor(
+                processes, initializer=set_worker_input, initargs=(self, source)
+            )
+            try:
+                yield executor, chunks
+            finally:
+                executor.shutdown(cancel_futures=True)
+        finally:
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+
+    def to_python_source(self, name="matches"):
+        """Returns the source code of a Python module defining a function
+        called ``name``, which takes a ``bytes``-like argument and returns
+        whether this DFA matches it. The module has no dependencies other
+        than the standard library, so can be saved and imported (and
+        cached in ``__pycache__``) like any other.
+
+        The transition table is inlined as a constant, with each entry
+        pre-multiplied by the table's width so that the matching loop
+        only has to do a single addition and index per byte."""
+        if not name.isidentifier():
+            raise ValueError(f"Invalid function name {name!r}")
+        width = len(self.class_representatives())
+        table = [j * width for j in self.__table]
+        accepting = sorted(i * width for i in range(len(self)) if self.__accepting[i])
+
+        lines = [
+            '"""Generated by drmaciver_junkdrawer.dfa.CompiledDFA.to_python_source."""',
+            "",
+        ]
+        if max(table, default=0) < 256:
+            table_source = repr(bytes(table))
+        else:
+            lines.extend(["from array import array", ""])
+            code = typed_array(table).typecode
+            table_source = f"array({code!r}, {tuple(table)!r})"
+        lines.extend(
+            [
+                f"TABLE = {table_source}",
+                f"ACCEPTING = frozenset({accepting!r})",
+                f"START = {self.__start * width!r}",
+            ]
+        )
+        # When every byte is in its own class, there's no need to
+        # translate the input.
+        if self.__classes == bytes(range(ALPHABET_SIZE)):
+            characters = "s"
         else:
-            for t in transitions:
-                if len(t) == 2:
-                    yield t
+            lines.append(f"CLASSES = {self.__classes!r}")
+            characters = "bytes(s).translate(CLASSES)"
+        lines.extend(
+            [
+                "",
+                "",
+                f"def {name}(s):",
+                "    table = TABLE",
+                "    state = START",
+                f"    for c in {characters}:",
+                "        state = table[state + c]",
+                "    return state in ACCEPTING",
+                "",
+            ]
+        )
+        return "\n".join(lines)
+
+    def compile_function(self, name="matches"):
+        """Returns the function defined by ``to_python_source(name)``."""
+        namespace = {}
+        exec(compile(self.to_python_source(name), f"<dfa {name}>", "exec"), namespace)
+        return namespace[name]
+
+    def to_bytes(self):
+        """Returns a compact binary representation of this DFA, which
+        can be read back with ``from_buffer``.
+
+        The format is a fixed size header, then the byte classes, then
+        a bitmap of accepting states, then the transition table as an
+        array of unsigned integers in native byte order, aligned to a
+        multiple of 8 bytes."""
+        n = len(self)
+        table = memoryview(self.__table)
+        header = STORED_HEADER.pack(
+            STORED_MAGIC,
+            STORED_VERSION,
+            STORED_BYTE_ORDERS.index(sys.byteorder),
+            table.itemsize,
+            n,
+            self.__start,
+        )
+        accepting = np.packbits(
+            np.array([self.is_accepting(i) for i in range(n)], dtype=bool),
+            bitorder="little",
+        ).tobytes()
+        prefix = header + self.__classes + accepting
+        padding = bytes(-len(prefix) % STORED_ALIGNMENT)
+        return prefix + padding + table.tobytes()
+
+    def save(self, path):
+        """Writes ``self.to_bytes()`` to the file at ``path``."""
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Returns a CompiledDFA from the output of ``to_bytes``, which
+        may be in any object supporting the buffer protocol. Unless it
+        was written on a machine with a different byte order, the
+        transition table is used in place without copying, and so the
+        buffer must not be modified while the result is in use."""
+        view = memoryview(buffer).cast("B")
+        if len(view) < STORED_HEADER.size:
+            raise ValueError("Buffer is too short to contain a stored DFA")
+        magic, version, byte_order, itemsize, n, start = STORED_HEADER.unpack_from(view)
+        if magic != STORED_MAGIC:
+            raise ValueError(f"Buffer does not contain a stored DFA (magic={magic!r})")
+        if version != STORED_VERSION:
+            raise ValueError(f"Unsupported stored DFA version {version}")
+        if byte_order >= len(STORED_BYTE_ORDERS):
+            raise ValueError(f"Invalid byte order {byte_order} in stored DFA")
+        if itemsize not in STORED_ITEM_CODES:
+            raise ValueError(f"Invalid item size {itemsize} in stored DFA")
+        if start >= n:
+            raise ValueError(f"Start state {start} out of range for {n} states")
+
+        offset = STORED_HEADER.size
+        classes = bytes(view[offset : offset + ALPHABET_SIZE])
+        offset += ALPHABET_SIZE
+        width = len(representatives_of(classes))
+
+        accepting_size = (n + 7) // 8
+        accepting = np.unpackbits(
+            np.frombuffer(view[offset : offset + accepting_size], dtype=np.uint8),
+            count=n,
+            bitorder="little",
+        ).tobytes()
+        offset += accepting_size
+        offset += -offset % STORED_ALIGNMENT
+
+        table_size = n * width * itemsize
+        if len(view) != offset + table_size:
+            raise ValueError(
+                f"Expected stored DFA of {offset + table_size} bytes but got {len(view)}"
+            )
+        table = view[offset:].cast(STORED_ITEM_CODES[itemsize])
+        if STORED_BYTE_ORDERS[byte_order] != sys.byteorder:
+            table = array(table.format, table)
+            table.byteswap()
+        # A single vectorised pass over the table (which reads it in place
+        # rather than copying it) is cheap next to using the DFA at all.
+        largest = np.frombuffer(table, dtype=STORED_ITEM_CODES[itemsize]).max()
+        if largest >= n:
+            raise ValueError(
+                f"Transition to state {largest} out of range for {n} states"
+            )
+        return cls(table, accepting, start, classes)
+
+    @classmethod
+    def load(cls, path):
+        """Returns a CompiledDFA from a file written by ``save``.
+
+        The file is memory-mapped rather than read, so loading is fast
+        regardless of size and processes loading the same file share a
+        single copy of its transition table."""
+        with open(path, "rb") as f:
+            # The mapping stays open as long as the DFA holds views of it,
+            # so we don't need to keep the file open.
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(mapped)
+
+
+class ProductDFA(DFA):
+    """A DFA matching some boolean combination of the languages of
+    two other DFAs, which it reads in parallel.
+
+    States are pairs of a state from each DFA, and are only calculated
+    as we traverse the product (each transition being cached once
+    calculated), so it is cheap to create even when the full product
+    would be very large. Pairs that are certainly dead are all replaced
+    by the single state ``DEAD``.
+
+    Subclasses define the combination by implementing ``combine``,
+    and optionally ``is_dead_pair``.
+    """
+
+    def __init__(self, left, right):
+        super().__init__()
+        self.left = left
+        self.right = right
+
+    def combine(self, left_accepting, right_accepting):
+        """Returns whether a pair of states is accepting, given whether
+        each of them is accepting."""
+        raise NotImplementedError
+
+    def is_dead_pair(self, left_state, right_state):
+        """Returns True if the pair of these two states can be determined
+        to be dead by looking at each state separately. This is allowed
+        to return False for dead pairs."""
+        return False
+
+    def __pair(self, left_state, right_state):
+        if self.is_dead_pair(left_state, right_state):
+            return DEAD
+        return (left_state, right_state)
+
+    @property
+    def start(self):
+        return self.__pair(self.left.start, self.right.start)
+
+    def is_accepting(self, i):
+        if i == DEAD:
+            return False
+        left_state, right_state = i
+        return self.combine(
+            self.left.is_accepting(left_state), self.right.is_accepting(right_state)
+        )
+
+    @cached
+    def transition(self, i, c):
+        if i == DEAD:
+            return DEAD
+        left_state, right_state = i
+        return self.__pair(
+            self.left.transition(left_state, c), self.right.transition(right_state, c)
+        )
+
+    @cached
+    def byte_classes(self):
+        return joint_byte_classes([self.left, self.right])
+
+
+class IntersectionDFA(ProductDFA):
+    """Matches the strings that both ``left`` and ``right`` match."""
+
+    def combine(self, left_accepting, right_accepting):
+        return left_accepting and right_accepting
+
+    def is_dead_pair(self, left_state, right_state):
+        return self.left.is_dead(left_state) or self.right.is_dead(right_state)
+
+
+class UnionDFA(ProductDFA):
+    """Matches the strings that either ``left`` or ``right`` match."""
+
+    def combine(self, left_accepting, right_accepting):
+        return left_accepting or right_accepting
+
+    def is_dead_pair(self, left_state, right_state):
+        return self.left.is_dead(left_state) and self.right.is_dead(right_state)
+
+
+class DifferenceDFA(ProductDFA):
+    """Matches the strings that ``left`` matches but ``right`` does not."""
+
+    def combine(self, left_accepting, right_accepting):
+        return left_accepting and not right_accepting
+
+    def is_dead_pair(self, left_state, right_state):
+        return self.left.is_dead(left_state)
+
+
+class SymmetricDifferenceDFA(ProductDFA):
+    """Matches the strings that exactly one of ``left`` and ``right``
+    matches."""
+
+    def combine(self, left_accepting, right_accepting):
+        return left_accepting != right_accepting
+
+    def is_dead_pair(self, left_state, right_state):
+        return self.left.is_dead(left_state) and self.right.is_dead(right_state)
+
+
+class ComplementDFA(DFA):
+    """Matches exactly the strings that ``dfa`` does not match.
+
+    States are those of ``dfa``, except that its ``DEAD`` state, which
+    matches every string in the complement, is replaced by ``UNIVERSAL``
+    so that ``DEAD`` is still dead here. Conversely a ``UNIVERSAL`` state
+    of ``dfa`` (e.g. if it is itself a complement) is replaced by ``DEAD``.
+    """
+
+    def __init__(self, dfa):
+        super().__init__()
+        self.dfa = dfa
+
+    def __swap(self, i):
+        if i == DEAD:
+            return UNIVERSAL
+        if i == UNIVERSAL:
+            return DEAD
+        return i
+
+    @property
+    def start(self):
+        return self.__swap(self.dfa.start)
+
+    def is_accepting(self, i):
+        if i == DEAD or i == UNIVERSAL:
+            return i == UNIVERSAL
+        return not self.dfa.is_accepting(i)
+
+    def transition(self, i, c):
+        if i == DEAD or i == UNIVERSAL:
+            return i
+        return self.__swap(self.dfa.transition(i, c))
+
+    def byte_classes(self):
+        return self.dfa.byte_classes()
+
+
+class MultiPatternDFA(DFA):
+    """A DFA that runs each of ``patterns`` (a sequence of DFAs) in
+    parallel, matching the strings that any of them match. The index of
+    each pattern in ``patterns`` is its pattern id.
+
+    As with ``ProductDFA``, states are only calculated as we traverse
+    the combined DFA. They are tuples with a state from each pattern,
+    in which any state that is dead is replaced by ``STOPPED`` (and if
+    every one of them is dead, the whole tuple is replaced by ``DEAD``),
+    so that patterns which have stopped matching do not multiply the
+    number of states.
+
+    Use ``accepted_patterns`` to find out which patterns match at an
+    accepting state, or ``scan`` to find the matches of every pattern in
+    a string at once.
+    """
+
+    def __init__(self, patterns):
+        super().__init__()
+        self.patterns = tuple(patterns)
+
+    def __combine(self, states):
+        states = tuple(
+            STOPPED if state == STOPPED or pattern.is_dead(state) else state
+            for pattern, state in zip(self.patterns, states)
+        )
+        if all(state == STOPPED for state in states):
+            return DEAD
+        return states
+
+    @property
+    def start(self):
+        return self.__combine(pattern.start for pattern in self.patterns)
+
+    def is_accepting(self, i):
+        return bool(self.accepted_patterns(i))
+
+    @cached
+    def accepted_patterns(self, i):
+        """Returns a tuple of the ids, in ascending order, of the patterns
+        that accept at state ``i``."""
+        if i == DEAD:
+            return ()
+        return tuple(
+            pattern_id
+            for pattern_id, (pattern, state) in enumerate(zip(self.patterns, i))
+            if state != STOPPED and pattern.is_accepting(state)
+        )
+
+    @cached
+    def transition(self, i, c):
+        if i == DEAD:
+            return DEAD
+        return self.__combine(
+            STOPPED if state == STOPPED else pattern.transition(state, c)
+            for pattern, state in zip(self.patterns, i)
+        )
+
+    @cached
+    def byte_classes(self):
+        return joint_byte_classes(self.patterns)
+
+    def scan(self, string):
+        """Yields every triple ``(pattern_id, start, end)`` such that
+        ``self.patterns[pattern_id].matches(string[start:end])``, with
+        ``start < len(string)``. That is, the results for each pattern
+        are those of its ``all_matching_regions``.
+
+        This reads ``string`` once from left to right, so takes time
+        proportional to its length times the number of distinct states
+        reachable from different start points (plus the number of
+        matches), however many patterns there are. Matches are yielded
+        as soon as they are found, in ascending order of ``end``, then
+        ``start``, then ``pattern_id``.
+        """
+        n = len(string)
+        start = self.start
+        # Maps each state to a dict of its transitions that we have used
+        # so far, which saves going through the cache for every character.
+        rows = {}
+        # Maps each live state to the start points that reach it at the
+        # current position. Start points that reach the same state behave
+        # identically from then on, so are all moved along together.
+        threads = {}
+        for i in range(n + 1):  # pragma: no branch
+            if i < n and start != DEAD:
+                threads.setdefault(start, []).append(i)
+            matches = [
+                (u, pattern_id)
+                for state, starts in threads.items()
+                for pattern_id in self.accepted_patterns(state)
+                for u in starts
+            ]
+            matches.sort()
+            for u, pattern_id in matches:
+                yield (pattern_id, u, i)
+            if i == n:
+                break
+            c = string[i]
+            new_threads = {}
+            for state, starts in threads.items():
+                try:
+                    row = rows[state]
+                except KeyError:
+                    row = rows[state] = {}
+                try:
+                    j = row[c]
+                except KeyError:
+                    j = row[c] = self.transition(state, c)
+                if j == DEAD:
+                    continue
+                # Each list of start points belongs to exactly one state,
+                # so we can reuse them rather than copying.
+                existing = new_threads.get(j)
+                if existing is None:
+                    new_threads[j] = starts
                 else:
-                    u, v, j = t
-                    for c in range(u, v + 1):
-                        yield c, j
+                    existing.extend(starts)
+            threads = new_threads
@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import nullcontext
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "max_size", "size"])
+
+
+class LRUCache:
+    """A mapping that holds at most ``max_size`` entries (or arbitrarily
+    many if ``max_size`` is None), discarding the least recently used
+    entry whenever it would otherwise grow beyond that.
+
+    Lookups with ``get`` or ``[]`` count as hits or misses, which can be
+    read back with ``cache_info()``. If ``thread_safe`` is True, every
+    operation holds a lock, so that the cache can be shared between
+    threads.
+    """
+
+    __slots__ = ("__data", "__max_size", "__lock", "__hits", "__misses")
+
+    def __init__(self, max_size=None, thread_safe=False):
+        if max_size is not None and max_size < 0:
+            raise ValueError(f"Invalid max_size {max_size}")
+        self.__data = OrderedDict()
+        self.__max_size = max_size
+        self.__lock = threading.Lock() if thread_safe else None
+        self.__hits = 0
+        self.__misses = 0
+
+    def __repr__(self):
+        return f"LRUCache({dict(self.__data)!r}, max_size={self.__max_size!r})"
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        """Checks whether ``key`` is present, without counting as a
+        hit or a miss or marking it as recently used."""
+        return key in self.__data
+
+    def __getitem__(self, key):
+        if self.__lock is None:
+            return self.__get(key)
+        with self.__lock:
+            return self.__get(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self.__locked():
+            self.__set(key, value)
+
+    def setdefault(self, key, value):
+        """Returns the value for ``key`` if present, otherwise sets it to
+        ``value`` and returns that. Does not count as a hit or a miss."""
+        with self.__locked():
+            try:
+                existing = self.__data[key]
+            except KeyError:
+                self.__set(key, value)
+                return value
+            self.__touch(key)
+            return existing
+
+    def update(self, values):
+        with self.__locked():
+            for key, value in values.items():
+                self.__set(key, value)
+
+    def clear(self):
+        """Removes every entry, leaving the hit and miss counts intact."""
+        with self.__locked():
+            self.__data.clear()
+
+    def cache_info(self):
+        """Returns a ``CacheInfo`` describing the current usage of
+        this cache."""
+        return CacheInfo(self.__hits, self.__misses, self.__max_size, len(self))
+
+    def __locked(self):
+        return nullcontext() if self.__lock is None else self.__lock
+
+    def __get(self, key):
+        try:
+            value = self.__data[key]
+        except KeyError:
+            self.__misses += 1
+            raise
+        self.__hits += 1
+        self.__touch(key)
+        return value
+
+    def __touch(self, key):
+        # Recency only matters if we're ever going to evict anything.
+        if self.__max_size is not None:
+            self.__data.move_to_end(key)
+
+    def __set(self, key, value):
+        if self.__max_size == 0:
+            return
+        self.__data[key] = value
+        self.__touch(key)
+        if self.__max_size is not None and len(self.__data) > self.__max_size:
+            self.__data.popitem(last=False)
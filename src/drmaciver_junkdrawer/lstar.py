@@ -416,18 +416,12 @@ class LearnedDFA(DFA):
         return self.__lstar.transition(i, c)
 
     @cached
-    def successor_states(self, state):
-        """Returns all of the distinct states that can be reached via one
-        transition from ``state``, in the lexicographic order of the
-        smallest character that reaches them."""
-        seen = set()
-        result = []
-        for c in self.__lstar.normalizer.representatives():
-            j = self.transition(state, c)
-            if j not in seen:
-                seen.add(j)
-                result.append(j)
-        return tuple(result)
+    def byte_classes(self):
+        # Every byte is normalized before we transition on it, so the
+        # classes are exactly the bytes with the same normalized value.
+        normalizer = self.__lstar.normalizer
+        indices = {c: k for k, c in enumerate(normalizer.representatives())}
+        return bytes(indices[normalizer.normalize(c)] for c in self.alphabet)
 
 
 class IntegerNormalizer:
@@ -0,0 +1,64 @@
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+RUN_BENCHMARKS = Path(__file__).parent.parent / "benchmarks" / "run.py"
+
+
+@pytest.fixture(scope="module")
+def benchmarks():
+    spec = importlib.util.spec_from_file_location("benchmarks_run", RUN_BENCHMARKS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_benchmarks_run_and_compare_with_baseline(benchmarks, tmp_path, capsys):
+    baseline = tmp_path / "baselines.json"
+    args = ["--repeat", "1", "--scale", "0.02", "--baseline", str(baseline)]
+    benchmarks.main([*args, "--save-baseline"])
+    stored = json.loads(baseline.read_text())
+    assert set(stored["results"]) == set(benchmarks.BENCHMARKS)
+    assert stored["results"]["lstar_learn_regex_0"]["counts"]["queries"] > 0
+
+    capsys.readouterr()
+    benchmarks.main([*args, "max_length", "lstar_learn_regex_2"])
+    output = capsys.readouterr().out
+    assert "counts differ" not in output
+    rows = {line.split()[0]: line.split() for line in output.splitlines()[1:]}
+    assert set(rows) == {"max_length", "lstar_learn_regex_2"}
+    for row in rows.values():
+        # Name, best, median, then the comparison with the baseline.
+        assert row[3].endswith("x")
+
+
+def test_unknown_benchmarks_are_an_error(benchmarks):
+    with pytest.raises(SystemExit):
+        benchmarks.main(["no_such_benchmark"])
+
+
+def test_benchmarks_report_changed_counts(benchmarks, tmp_path, capsys):
+    baseline = tmp_path / "baselines.json"
+    args = ["--repeat", "1", "--scale", "0.02", "--baseline", str(baseline)]
+    benchmarks.main([*args, "--save-baseline", "max_length"])
+    stored = json.loads(baseline.read_text())
+    stored["results"]["max_length"]["counts"] = {"states": -1}
+    baseline.write_text(json.dumps(stored))
+
+    capsys.readouterr()
+    benchmarks.main([*args, "max_length"])
+    output = capsys.readouterr().out
+    assert "counts differ from baseline: {'states': -1}" in output
+    assert output.splitlines()[1].split()[4] == "!"
+
+    # Saving some benchmarks keeps the stored results for the others.
+    benchmarks.main([*args, "--save-baseline", "lstar_learn_regex_2"])
+    stored = json.loads(baseline.read_text())
+    assert set(stored["results"]) == {"max_length", "lstar_learn_regex_2"}
+
+    # Results stored at a different scale aren't compared against.
+    capsys.readouterr()
+    benchmarks.main(["--repeat", "1", "--scale", "0.01", "--baseline", str(baseline)])
+    assert "counts differ" not in capsys.readouterr().out
@@ -0,0 +1,132 @@
+import itertools
+import re
+
+import pytest
+
+from hypothesis import given, settings, strategies as st
+from drmaciver_junkdrawer.byteregex import compile_regex
+from drmaciver_junkdrawer.dfa import ConcreteDFA
+from drmaciver_junkdrawer.lstar import LStar
+
+atoms = st.sampled_from(
+    [b"a", b"b", b"c", b".", b"[ab]", b"[^a]", b"\\d", b"\\W", b"\\x61", b"\\.", b""]
+)
+quantifiers = st.sampled_from(
+    [b"", b"*", b"+", b"?", b"*?", b"{2}", b"{1,2}", b"{,2}", b"{2,}"]
+)
+
+
+def groups(children):
+    return st.tuples(
+        st.sampled_from([b"(", b"(?:"]),
+        st.lists(children, min_size=1, max_size=3),
+        quantifiers,
+    ).map(lambda t: t[0] + b"|".join(t[1]) + b")" + t[2])
+
+
+regexes = st.recursive(
+    st.tuples(atoms, quantifiers).map(lambda t: t[0] + t[1] if t[0] else b""),
+    lambda children: st.lists(children | groups(children), min_size=1).map(b"".join),
+    max_leaves=8,
+)
+
+
+@settings(max_examples=200, deadline=None)
+@given(
+    regexes,
+    st.lists(st.lists(st.sampled_from(b"abc1.\n"), max_size=6).map(bytes), max_size=20),
+)
+def test_agrees_with_re(pattern, strings):
+    dfa = ConcreteDFA.from_regex(pattern)
+    compiled = re.compile(pattern)
+    strings.extend(itertools.islice(dfa.all_matching_strings(), 20))
+    for s in strings:
+        assert dfa.matches(s) == (compiled.fullmatch(s) is not None), s
+
+
+@pytest.mark.parametrize(
+    "pattern, matching, not_matching",
+    [
+        (b"", [b""], [b"a"]),
+        (b"a|", [b"a", b""], [b"aa"]),
+        (b"[]a]", [b"]", b"a"], [b""]),
+        (b"[a-]", [b"a", b"-"], [b"b"]),
+        (b"[\\d-]", [b"1", b"-"], [b"a"]),
+        (b"a{", [b"a{"], [b"a"]),
+        (b"a{,}", [b"", b"aaa"], [b"a{,}"]),
+        (b"a{x}", [b"a{x}"], [b"ax"]),
+        (b"\\0\\012\\101", [b"\0\nA"], [b"\0"]),
+        (b"[\\x00-\\x02]\\n", [b"\1\n"], [b"\3\n"]),
+        (b"\\\\", [b"\\"], [b""]),
+        (b"[^\\x00-\\xff]", [], [b"a", b""]),
+        (b"(?P<name>a)b", [b"ab"], [b"a"]),
+        (b"[\\b]", [b"\x08"], [b"b"]),
+    ],
+)
+def test_examples(pattern, matching, not_matching):
+    dfa = ConcreteDFA.from_regex(pattern)
+    for s in matching:
+        assert dfa.matches(s)
+        assert re.fullmatch(pattern, s)
+    for s in not_matching:
+        assert not dfa.matches(s)
+        assert not re.fullmatch(pattern, s)
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        b"(",
+        b"a)",
+        b"*",
+        b"{2}",
+        b"a**",
+        b"a*+",
+        b"a{2}{3}",
+        b"a{3,2}",
+        b"^a",
+        b"a$",
+        b"\\b",
+        b"\\1",
+        b"(?=a)",
+        b"(?P<1>a)",
+        b"[a",
+        b"[b-a]",
+        b"[a-\\d]",
+        b"\\x4",
+        b"\\777",
+        b"\\",
+    ],
+)
+def test_rejects_invalid_or_unsupported_patterns(pattern):
+    with pytest.raises(ValueError):
+        compile_regex(pattern)
+
+
+def test_rejects_string_patterns():
+    with pytest.raises(TypeError):
+        compile_regex("a")
+
+
+def test_transitions_are_range_compressed():
+    transitions, accepting = compile_regex(b"[a-z]+|0")
+    assert transitions[0] == [(ord("0"), 1), (ord("a"), ord("z"), 2)]
+    assert transitions[1] == []
+    assert transitions[2] == [(ord("a"), ord("z"), 3)]
+    assert accepting == {1, 2, 3}
+
+
+def test_compiled_patterns_are_cached():
+    assert ConcreteDFA.from_regex(b"[ab]*c") is ConcreteDFA.from_regex(b"[ab]*c")
+
+
+def test_regex_agrees_with_learned_dfa():
+    pattern = b"(?:ab|c)*"
+    learner = LStar(lambda s: re.fullmatch(pattern, s) is not None)
+    dfa = ConcreteDFA.from_regex(pattern)
+    while True:
+        counterexample = dfa.distinguishing_string(learner.dfa)
+        if counterexample is None:
+            break
+        learner.learn(counterexample)
+    assert learner.dfa.matches(b"abcab")
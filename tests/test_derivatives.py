@@ -0,0 +1,195 @@
+import pickle
+import re
+
+import pytest
+
+from hypothesis import given, settings, strategies as st
+from drmaciver_junkdrawer.derivatives import (
+    EMPTY,
+    EPSILON,
+    EVERYTHING,
+    DerivativeDFA,
+    byte_set,
+    complement,
+    concatenation,
+    intersection,
+    literal,
+    parse_regex,
+    repeat,
+    star,
+    union,
+)
+from drmaciver_junkdrawer.dfa import (
+    DEAD,
+    ComplementDFA,
+    ConcreteDFA,
+    IntersectionDFA,
+    UnionDFA,
+)
+
+PATTERNS = [rb"a*", rb"(?:ab|b)*", rb"[ab]{2,3}", rb"a?b", rb".*b.*", rb""]
+
+
+def combinations():
+    """Generates pairs of a term and an equivalent DFA built from
+    ``ConcreteDFA.from_regex`` and the product constructions."""
+    leaves = st.sampled_from(PATTERNS).map(
+        lambda p: (parse_regex(p), ConcreteDFA.from_regex(p))
+    )
+
+    def extend(children):
+        return (
+            st.tuples(children, children).map(
+                lambda t: (t[0][0] & t[1][0], IntersectionDFA(t[0][1], t[1][1]))
+            )
+            | st.tuples(children, children).map(
+                lambda t: (t[0][0] | t[1][0], UnionDFA(t[0][1], t[1][1]))
+            )
+            | children.map(lambda t: (~t[0], ComplementDFA(t[1])))
+        )
+
+    return st.recursive(leaves, extend, max_leaves=4)
+
+
+@settings(max_examples=100, deadline=None)
+@given(combinations(), st.lists(st.binary(max_size=6), max_size=10))
+def test_agrees_with_product_constructions(combination, strings):
+    term, model = combination
+    dfa = DerivativeDFA(term)
+    for s in strings:
+        assert dfa.matches(s) == model.matches(s)
+    for length in range(4):
+        assert dfa.count_strings(dfa.start, length) == model.count_strings(
+            model.start, length
+        )
+    assert dfa.equivalent(model)
+
+
+@settings(max_examples=100, deadline=None)
+@given(
+    st.sampled_from(PATTERNS + [rb"a{2,}b?", rb"(?:a|bc){1,3}", rb"[^a]+"]),
+    st.binary(max_size=20),
+)
+def test_regexes_agree_with_re(pattern, string):
+    dfa = DerivativeDFA.from_regex(pattern)
+    assert dfa.matches(string) == (re.fullmatch(pattern, string) is not None)
+    assert sorted(dfa.all_matching_regions(string)) == sorted(
+        ConcreteDFA.from_regex(pattern).all_matching_regions(string)
+    )
+
+
+def test_equal_terms_are_identical():
+    a = literal(b"ab")
+    b = literal(b"b")
+    assert union(a, b) is union(b, a) is union(a, union(b, a))
+    assert concatenation(literal(b"a"), b) is a
+    assert intersection(a, b, a) is intersection(b, a)
+    assert complement(complement(a)) is a
+    assert star(star(a)) is star(a)
+    assert parse_regex(rb"(?:ab|b)") is union(a, b)
+    for term in [EPSILON, a + b, a | b, a & star(b), ~a, repeat(a, 1, 3)]:
+        assert pickle.loads(pickle.dumps(term)) is term
+
+
+@pytest.mark.parametrize(
+    "term, expected",
+    [
+        (concatenation(literal(b"a"), EMPTY), EMPTY),
+        (union(EMPTY, EPSILON), EPSILON),
+        (union(literal(b"a"), EVERYTHING), EVERYTHING),
+        (intersection(literal(b"a"), EMPTY), EMPTY),
+        (intersection(literal(b"a"), EVERYTHING), literal(b"a")),
+        (intersection(), EVERYTHING),
+        (union(), EMPTY),
+        (union(byte_set([(0, 5)]), byte_set([(3, 9)])), byte_set([(0, 9)])),
+        (intersection(byte_set([(0, 5)]), byte_set([(3, 9)])), byte_set([(3, 5)])),
+        (intersection(literal(b"a"), literal(b"b")), EMPTY),
+        (repeat(literal(b"a"), 0, 0), EPSILON),
+        (repeat(EMPTY, 0), EPSILON),
+        (repeat(EMPTY, 1), EMPTY),
+        (repeat(literal(b"a"), 1, 1), literal(b"a")),
+    ],
+)
+def test_simplifications(term, expected):
+    assert term is expected
+
+
+def test_rejects_invalid_bounds():
+    with pytest.raises(ValueError):
+        repeat(literal(b"a"), 2, 1)
+    with pytest.raises(ValueError):
+        repeat(literal(b"a"), -1)
+
+
+def test_rejects_string_patterns():
+    with pytest.raises(TypeError):
+        parse_regex("a")
+
+
+def test_only_builds_states_that_are_used():
+    # The minimal DFA for this has more than a million states, because
+    # it has to remember the last 21 bytes it has seen.
+    dfa = DerivativeDFA.from_regex(rb"[ab]*a[ab]{20}")
+    string = b"ab" * 100 + b"a" * 21
+    assert dfa.matches(string)
+    assert not dfa.matches(string + b"b" * 21)
+    assert dfa.count_strings(dfa.start, 10) == 0
+    assert dfa.cache_info()["__derivative"].size < 10000
+
+
+def test_deeply_nested_terms():
+    dfa = DerivativeDFA.from_regex(b"a?" * 2000 + b"b")
+    assert dfa.matches(b"b")
+    assert dfa.matches(b"ab")
+    assert not dfa.matches(b"ba")
+    dfa = DerivativeDFA.from_regex(b"(" + b"a" * 1200 + b")*")
+    assert dfa.matches(b"a" * 2400)
+    assert not dfa.matches(b"a" * 1201)
+
+
+@pytest.mark.parametrize("max_size", [None, 1, 3])
+def test_derivatives_with_bounded_cache(max_size):
+    dfa = DerivativeDFA.from_regex(rb"(?:ab|a(?:c|d)*)*b?")
+    dfa.configure_caches(max_size=max_size)
+    for s in [b"", b"ab", b"acdcab", b"acb", b"ba", b"acx"]:
+        assert dfa.matches(s) == (re.fullmatch(rb"(?:ab|a(?:c|d)*)*b?", s) is not None)
+
+
+def contains(c):
+    return parse_regex(rb"[\x00-\xff]*" + bytes([c]) + rb"[\x00-\xff]*")
+
+
+def test_intersections_of_many_patterns():
+    # Strings containing every one of these bytes, in any order, and
+    # no z. Determinising this eagerly would need a state for every
+    # subset of the bytes seen so far.
+    letters = b"abcdefghijklmnopqrst"
+    term = intersection(*map(contains, letters), complement(contains(ord("z"))))
+    dfa = DerivativeDFA(term)
+    assert dfa.matches(letters[::-1])
+    assert dfa.matches(b"x" + letters + letters)
+    assert not dfa.matches(letters[1:])
+    assert not dfa.matches(letters + b"z")
+    assert dfa.transition(dfa.start, ord("z")) == DEAD
+
+
+def test_shortest_string_of_intersection():
+    dfa = DerivativeDFA(intersection(*map(contains, b"cab")))
+    assert dfa.shortest_string() == b"abc"
+    assert star(byte_set([(0, 255)])) is EVERYTHING
+
+
+def test_dead_states():
+    dfa = DerivativeDFA(intersection(literal(b"ab"), literal(b"ac")))
+    assert dfa.start is not DEAD
+    assert dfa.is_dead(dfa.start)
+    assert DerivativeDFA(EMPTY).start == DEAD
+    assert DerivativeDFA(literal(b"a")).transition(literal(b"a"), ord("b")) == DEAD
+
+
+def test_repr():
+    term = parse_regex(rb"[a-c]x*|(?:ab){2,}")
+    assert repr(DerivativeDFA(term)) == f"DerivativeDFA({term!r})"
+    assert "x*" in repr(term)
+    assert "{2,}" in repr(term)
+    assert repr(~literal(b"a") & literal(b"b")) in ("~a&b", "b&~a")
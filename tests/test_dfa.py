@@ -8,9 +8,19 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file, You can
 # obtain one at https://mozilla.org/MPL/2.0/.
 
+import importlib
+import io
+from array import array
 import itertools
+import mmap
+import pickle
+import re
+import sys
+import threading
+from collections import Counter, deque
 import math
 from math import inf
+from random import Random
 
 import pytest
 
@@ -24,7 +34,21 @@ from hypothesis import (
     settings,
     strategies as st,
 )
-from drmaciver_junkdrawer.dfa import DEAD, ConcreteDFA
+import drmaciver_junkdrawer.dfa as dfa_module
+from drmaciver_junkdrawer.dfa import (
+    DEAD,
+    DFA,
+    CompiledDFA,
+    ComplementDFA,
+    ConcreteDFA,
+    DifferenceDFA,
+    IntersectionDFA,
+    MultiPatternDFA,
+    ProductDFA,
+    UNIVERSAL,
+    SymmetricDifferenceDFA,
+    UnionDFA,
+)
 
 
 def test_enumeration_when_sizes_do_not_agree():
@@ -126,6 +150,42 @@ def test_canonicalised_matches_same_strings(dfa, via_repr):
     )
 
 
+def canonicalise_model(dfa):
+    # The original, much slower, implementation of canonicalise, which
+    # the current one should agree with exactly.
+    state_map = {}
+    reverse_state_map = []
+    accepting = set()
+    queue = deque([dfa.start])
+    while queue:
+        state = queue.popleft()
+        if state in state_map:
+            continue
+        if dfa.is_accepting(state):
+            accepting.add(len(reverse_state_map))
+        state_map[state] = len(reverse_state_map)
+        reverse_state_map.append(state)
+        queue.extend(j for _, j in dfa.transitions(state))
+    transitions = [
+        {c: state_map[s] for c, s in dfa.transitions(t)} for t in reverse_state_map
+    ]
+    return ConcreteDFA(transitions, accepting)
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), dfas(), st.sampled_from([IntersectionDFA, UnionDFA, DifferenceDFA]))
+def test_canonicalise_agrees_with_model(left, right, product):
+    for dfa in [left, product(left, right), ComplementDFA(left)]:
+        assert repr(dfa.canonicalise()) == repr(canonicalise_model(dfa))
+
+
+def test_canonicalise_can_verify():
+    dfa = UnionDFA(
+        ConcreteDFA([{0: 1}, {1: 1}], {1}), ConcreteDFA([{2: 1}, {}, {}], {1})
+    )
+    assert dfa.canonicalise(verify=True).equivalent(dfa)
+
+
 # filters about 80% of examples. should potentially improve at some point.
 @settings(max_examples=20, suppress_health_check=[HealthCheck.filter_too_much])
 @given(dfas())
@@ -137,15 +197,82 @@ def test_has_string_of_max_length(dfa):
     assert dfa.count_strings(dfa.start, length) > 0
 
 
-def test_converts_long_tables_to_dicts():
+def test_stores_long_tables_as_intervals():
+    # The last state splits the bytes into 32 classes, so that a row over
+    # them would take more space than the intervals of the first state.
     dfa = ConcreteDFA(
-        [[(0, 0), (1, 1), (2, 2), (3, 1), (4, 0), (7, 10, 1)], [(0, 0)], []], {2}
+        [
+            [(0, 0), (1, 1), (2, 2), (3, 1), (4, 0), (7, 10, 1)],
+            [(0, 0)],
+            [],
+            *[[] for _ in range(28)],
+            {c: c % 32 for c in range(256)},
+        ],
+        {2},
     )
     assert dfa.transition(0, 2) == 2
     assert dfa.transition(1, 0) == 0
+    assert dfa.transition(0, 8) == 1
+    assert dfa.transition(0, 5) == DEAD
+    assert dfa.transition(0, 11) == DEAD
+
+    assert list(dfa._ConcreteDFA__bases) == [None] * 31 + [0]
+    assert list(dfa._ConcreteDFA__starts) == [0, 1, 2, 3, 4, 7, 0]
+    assert list(dfa._ConcreteDFA__ends) == [0, 1, 2, 3, 4, 10, 0]
+    assert list(dfa._ConcreteDFA__offsets) == [0, 6] + [7] * 31
+    assert dfa.transition(31, 33) == 1
 
-    assert isinstance(dfa._ConcreteDFA__transitions[0], dict)
-    assert isinstance(dfa._ConcreteDFA__transitions[1], list)
+
+def test_stores_fragmented_tables_densely():
+    alternating = {c: c % 2 for c in range(256) if c != 7}
+    dfa = ConcreteDFA([alternating, {0: 0}], {1})
+    assert list(dfa._ConcreteDFA__bases) == [0, None]
+    assert list(dfa.raw_class_transitions(0)) == [(0, 0), (1, 1), (2, 0)]
+    assert dfa.successor_states(0) == (0, 1)
+    assert dfa.successor_states(DEAD) == ()
+    assert dfa.transition(0, 4) == 0
+    assert dfa.transition(0, 5) == 1
+    assert dfa.transition(0, 7) == DEAD
+    assert dfa.transition(1, 0) == 0
+    assert dict(dfa.raw_transitions(0)) == alternating
+    assert eval(repr(dfa)).equivalent(dfa)
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=10), max_size=10))
+def test_concrete_matches_agrees_with_transitions(dfa, strings):
+    for s in strings:
+        assert dfa.matches(s) == DFA.matches(dfa, s)
+
+
+def test_concrete_matches_uses_dense_rows():
+    alternating = {c: c % 2 for c in range(256) if c != 7}
+    dfa = ConcreteDFA([alternating, {0: 0}], {1})
+    assert dfa.matches(b"\2\3")
+    assert dfa.matches(b"\3\0\1")
+    assert not dfa.matches(b"\3\1")
+    assert not dfa.matches(b"\7\1")
+
+
+@pytest.mark.parametrize(
+    "table",
+    [
+        [(0, 1), (0, 2)],
+        [(0, 3, 1), (2, 1), (1, 5, 2)],
+        [(5, 1), (0, 10, 2)],
+        [(0, DEAD), (0, 3, 1), (4, DEAD), (5, 1)],
+    ],
+)
+def test_first_matching_transition_wins(table):
+    dfa = ConcreteDFA([table, [], []], {1})
+    for c in range(12):
+        expected = next((t[-1] for t in table if t[0] <= c <= t[-2]), DEAD)
+        assert dfa.transition(0, c) == expected
+
+
+def test_rejects_empty_ranges():
+    with pytest.raises(ValueError):
+        ConcreteDFA([[(3, 2, 0)]], {0})
 
 
 @settings(max_examples=20)
@@ -212,3 +339,1126 @@ def test_transitions_out_of_dead_are_empty():
 def test_can_transition_from_dead():
     dfa = ConcreteDFA([{}], {0})
     assert dfa.transition(DEAD, 0) == DEAD
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=20), max_size=10))
+def test_compiled_dfa_matches_same_strings(dfa, strings):
+    compiled = dfa.compile()
+    for s in strings:
+        assert compiled.matches(s) == dfa.matches(s)
+    for s in itertools.islice(dfa.all_matching_strings(), 10):
+        assert compiled.matches(s)
+
+
+def test_compiled_dfa_has_ordinary_dead_state():
+    dfa = ConcreteDFA([{0: 1}, {}], {1})
+    compiled = dfa.compile()
+    assert len(compiled) == 3
+    dead = compiled.transition(compiled.start, 1)
+    assert dead == 2
+    assert compiled.is_dead(dead)
+    assert compiled.run(b"\1\0\0") == dead
+    assert compiled.run(b"\0", state=dead) == dead
+    assert compiled.run(b"\0") == 1
+    assert compiled.equivalent(dfa)
+    assert list(compiled.raw_transitions(0)) == [(0, 1)] + [
+        (c, 2) for c in range(1, 256)
+    ]
+
+
+def test_compiled_dfa_is_cached():
+    dfa = ConcreteDFA([{0: 1}, {}], {1})
+    assert dfa.compile() is dfa.compile()
+
+
+def test_compiled_dfa_uses_small_table():
+    dfa = ConcreteDFA([{0: 1}, {}], {1})
+    assert dfa.compile().table.typecode == "B"
+
+
+def test_typed_array_uses_smallest_type():
+    assert dfa_module.typed_array([0, 255]).typecode == "B"
+    assert dfa_module.typed_array([0, 256]).typecode == "H"
+    with pytest.raises(OverflowError):
+        dfa_module.typed_array([2**64])
+
+
+def test_compiled_dfa_validates_table_size():
+    with pytest.raises(ValueError):
+        CompiledDFA(bytes(10), b"\0")
+    with pytest.raises(ValueError):
+        CompiledDFA(bytes(256), b"\0\0")
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=20), max_size=10))
+def test_generated_function_matches_same_strings(dfa, strings):
+    matches = dfa.compile_function()
+    strings.extend(itertools.islice(dfa.all_matching_strings(), 10))
+    for s in strings:
+        assert matches(s) == dfa.matches(s)
+
+
+def test_generated_source_is_importable(tmp_path, monkeypatch):
+    dfa = ConcreteDFA.from_regex(b"(?:ab|c)*d")
+    source = dfa.to_python_source("is_abcd")
+    assert "drmaciver_junkdrawer" not in source.split('"""')[-1]
+    (tmp_path / "abcd_matcher.py").write_text(source)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    try:
+        module = importlib.import_module("abcd_matcher")
+    finally:
+        sys.modules.pop("abcd_matcher", None)
+    assert module.is_abcd(b"abcd")
+    assert module.is_abcd(bytearray(b"cd"))
+    assert not module.is_abcd(b"ab")
+
+
+def test_generated_source_handles_large_tables():
+    # Counts to 300, so needs more than a byte per table entry, and every
+    # byte behaves differently in the start state so there's no need for
+    # byte classes.
+    transitions = [{c: c + 1 for c in range(256)}]
+    transitions.extend({0: i + 1} for i in range(1, 300))
+    transitions.append({})
+    dfa = ConcreteDFA(transitions, {300})
+    source = dfa.to_python_source()
+    assert "array(" in source
+    assert "CLASSES" not in source
+    matches = dfa.compile_function()
+    assert matches(bytes([1]) + bytes(298))
+    assert matches(bytes([255]) + bytes(44))
+    assert matches(bytes(300))
+    assert not matches(bytes(301))
+    assert not matches(bytes([255]) + bytes(45))
+
+
+def test_generated_function_needs_valid_name():
+    with pytest.raises(ValueError):
+        ConcreteDFA([{}], {0}).to_python_source("not a name")
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=10)))
+def test_matches_many_agrees_with_matches(dfa, strings):
+    results = dfa.matches_many(strings)
+    assert results.dtype == bool
+    assert list(results) == [dfa.matches(s) for s in strings]
+
+
+class CountingDFA(ConcreteDFA):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transitions_taken = 0
+
+    def transition(self, state, char):
+        self.transitions_taken += 1
+        return super().transition(state, char)
+
+
+def test_matches_many_shares_prefixes():
+    dfa = CountingDFA([{c: 0 for c in range(256)}], {0})
+    strings = [bytes(10) + bytes([c]) for c in range(10)] * 2
+    assert dfa.matches_many(strings).all()
+    assert dfa.transitions_taken == 20
+
+
+def test_matches_many_of_nothing():
+    dfa = ConcreteDFA([{}], {0})
+    assert len(dfa.matches_many([])) == 0
+
+
+def test_minimize_merges_redundant_states():
+    # A trie for the words "ab" and "cb", which shares the "b" suffix
+    # once minimized.
+    dfa = ConcreteDFA([{97: 1, 99: 2}, {98: 3}, {98: 4}, {}, {}], {3, 4})
+    minimal = dfa.minimize()
+    assert len(minimal) == 3
+    assert minimal.equivalent(dfa)
+
+
+def test_minimize_empty_language():
+    dfa = ConcreteDFA([{0: 1}, {0: 0}], set())
+    minimal = dfa.minimize()
+    assert len(minimal) == 1
+    assert not minimal.is_accepting(minimal.start)
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas())
+# Refining this splits a block that isn't pending, with the marked part
+# being the larger one.
+@example(ConcreteDFA([{0: 1}, {1: 2}, {1: 0}], {0, 1, 2}))
+def test_minimize_is_equivalent_and_minimal(dfa):
+    minimal = dfa.minimize()
+    assert minimal.equivalent(dfa)
+    assert len(minimal) <= len(dfa.canonicalise())
+    assert repr(minimal.minimize()) == repr(minimal)
+
+
+@settings(max_examples=50)
+@given(dfas(), st.data())
+def test_minimize_gives_same_result_for_equivalent_dfas(dfa, data):
+    # Duplicating every state gives a different DFA for the same language.
+    n = len(dfa)
+    copy_of = data.draw(st.lists(st.booleans(), min_size=n, max_size=n))
+    transitions = []
+    for i in range(2 * n):
+        transitions.append(
+            {c: j + n * copy_of[j] for c, j in dfa.raw_transitions(i % n)}
+        )
+    accepting = {i for i in range(2 * n) if dfa.is_accepting(i % n)}
+    doubled = ConcreteDFA(transitions, accepting, dfa.start + n)
+    assert repr(doubled.minimize()) == repr(dfa.minimize())
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=5), max_size=5))
+def test_stream_matcher_agrees_with_matches(dfa, chunks):
+    matcher = dfa.matcher()
+    for chunk in chunks:
+        matcher.feed(memoryview(chunk))
+    string = b"".join(chunks)
+    assert matcher.accepting == dfa.matches(string)
+    if not matcher.is_dead:
+        assert matcher.position == len(string)
+        assert matcher.state == dfa.compile().run(string)
+
+
+def test_stream_matcher_stops_when_dead():
+    dfa = ConcreteDFA([{0: 0, 1: 1}, {}], {1})
+    matcher = dfa.matcher()
+    assert matcher.feed(bytes(3))
+    assert not matcher.feed(b"\0\2\1\1")
+    assert matcher.is_dead
+    assert matcher.position == 5
+    assert not matcher.feed(b"\1")
+    assert matcher.position == 5
+    assert not matcher.accepting
+
+
+def test_stream_matcher_starting_dead():
+    dfa = ConcreteDFA([{}, {0: 1}], {0}, start=1)
+    assert dfa.matcher().is_dead
+
+
+def test_stream_matcher_reads_files_and_mmaps(tmp_path):
+    dfa = ConcreteDFA([{0: 0, 1: 1}, {}], {1})
+    path = tmp_path / "input"
+    path.write_bytes(bytes(100) + b"\1")
+
+    with open(path, "rb") as f:
+        assert dfa.matcher().feed_file(f, chunk_size=7)
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        matcher = dfa.matcher()
+        matcher.feed(m)
+        assert matcher.accepting
+
+
+def test_stream_matcher_stops_reading_files_when_dead():
+    dfa = ConcreteDFA([{0: 0}], {0})
+    f = io.BytesIO(bytes(10) + b"\1" + bytes(100))
+    assert not dfa.matcher().feed_file(f, chunk_size=4)
+    assert f.tell() == 12
+
+
+@settings(max_examples=50)
+@given(dfas(), st.binary(max_size=20))
+def test_iter_matching_regions_agrees_with_all_matching_regions(dfa, string):
+    regions = sorted(dfa.all_matching_regions(string))
+    assert list(dfa.iter_matching_regions(string)) == regions
+    assert dfa.count_matching_regions(string) == len(regions)
+
+
+@pytest.mark.parametrize(
+    "dfa, string, regions",
+    [
+        # Every region runs into the end of the string while still live.
+        (ConcreteDFA([{97: 0}], {0}), b"aa", [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2)]),
+        # Regions stop as soon as the next byte leads to a dead state.
+        (ConcreteDFA([{97: 1}, {}], {1}), b"aba", [(0, 1), (2, 3)]),
+        (ConcreteDFA([{}], set()), b"ab", []),
+        # Start points that reached different states end up in the same one.
+        (ConcreteDFA([{97: 1}, {97: 1}], {1}), b"aa", [(0, 1), (0, 2), (1, 2)]),
+        (
+            ConcreteDFA([{97: 0, 98: 1}, {97: 1, 98: 1}], {1}),
+            b"bab",
+            [(0, 1), (0, 2), (0, 3), (1, 3), (2, 3)],
+        ),
+    ],
+)
+def test_matching_regions_of_small_dfas(dfa, string, regions):
+    assert list(dfa.iter_matching_regions(string)) == regions
+    assert dfa.count_matching_regions(string) == len(regions)
+    assert sorted(dfa.all_matching_regions(string)) == regions
+
+
+def test_iter_matching_regions_reads_each_byte_once_per_state():
+    # Matches the regular expression "a*b", so every start point stays
+    # live until the end of the string without ever matching.
+    dfa = CountingDFA([{ord("a"): 0, ord("b"): 1}, {}], {1})
+    string = b"a" * 20000
+    assert list(dfa.iter_matching_regions(string)) == []
+    assert dfa.transitions_taken == len(string)
+    assert list(dfa.iter_matching_regions(string + b"b")) == [
+        (u, len(string) + 1) for u in range(len(string) + 1)
+    ]
+
+
+def leftmost_longest_model(dfa, string):
+    regions = set(dfa.all_matching_regions(string))
+    pos = 0
+    while pos < len(string):
+        candidates = [(u, v) for u, v in regions if u >= pos]
+        if not candidates:
+            return
+        u = min(u for u, _ in candidates)
+        v = max(v for w, v in candidates if w == u)
+        yield (u, v)
+        pos = v if v > u else u + 1
+
+
+@settings(max_examples=100)
+@given(dfas(), st.binary(max_size=20))
+def test_finditer_gives_leftmost_longest_matches(dfa, string):
+    assert list(dfa.finditer(string)) == list(leftmost_longest_model(dfa, string))
+
+
+@pytest.mark.parametrize(
+    "string", [b"", b"a", b"b", b"aab", b"baaab", b"abba", b"bbaaabbbabaa"]
+)
+def test_finditer_agrees_with_re_for_simple_patterns(string):
+    # Matches the regular expression "a+"
+    dfa = ConcreteDFA([{ord("a"): 1}, {ord("a"): 1}], {1})
+    assert list(dfa.finditer(string)) == [m.span() for m in re.finditer(b"a+", string)]
+
+
+def test_byte_classes_of_concrete_dfa():
+    dfa = ConcreteDFA([[(0, 9, 1)], [(0, 9, 1), (20, 1)]], {1})
+    classes = dfa.byte_classes()
+    assert len(classes) == 256
+    assert set(classes[:10]) == {0}
+    assert classes[20] == 2
+    assert dfa.class_representatives() == (0, 10, 20)
+    assert dfa.class_sizes() == (10, 245, 1)
+
+
+def test_default_byte_classes_are_trivial():
+    class Everything(DFA):
+        start = 0
+
+        def is_accepting(self, i):
+            return True
+
+        def transition(self, i, c):
+            return 0
+
+    dfa = Everything()
+    assert dfa.byte_classes() == bytes(range(256))
+    assert dfa.successor_states(0) == (0,)
+    assert dfa.transition_counts(0) == [(0, 256)]
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_byte_classes_are_exact(dfa):
+    classes = dfa.byte_classes()
+    representatives = dfa.class_representatives()
+    assert list(representatives) == sorted(representatives)
+    assert sum(dfa.class_sizes()) == 256
+
+    rows = [[dfa.transition(i, c) for c in range(256)] for i in range(len(dfa))]
+    for c in range(256):
+        representative = representatives[classes[c]]
+        for row in rows:
+            assert row[c] == row[representative]
+    for a, b in itertools.combinations(representatives, 2):
+        assert any(row[a] != row[b] for row in rows)
+
+    assert dfa.compile().byte_classes() == classes
+
+
+@settings(max_examples=50)
+@given(dfas(), dfas(), st.lists(st.binary(max_size=6), max_size=10))
+def test_product_dfas_combine_languages(x, y, strings):
+    intersection = IntersectionDFA(x, y)
+    union = UnionDFA(x, y)
+    difference = DifferenceDFA(x, y)
+    complement = ComplementDFA(x)
+    strings.extend(itertools.islice(x.all_matching_strings(), 5))
+    strings.extend(itertools.islice(y.all_matching_strings(), 5))
+    for s in strings:
+        assert intersection.matches(s) == (x.matches(s) and y.matches(s))
+        assert union.matches(s) == (x.matches(s) or y.matches(s))
+        assert difference.matches(s) == (x.matches(s) and not y.matches(s))
+        assert complement.matches(s) == (not x.matches(s))
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), dfas())
+def test_subset_and_intersection_checks(x, y):
+    assert x.is_subset(x)
+    assert x.is_subset(UnionDFA(x, y))
+    assert IntersectionDFA(x, y).is_subset(y)
+    assert not x.intersects(ComplementDFA(x))
+    assert x.is_subset(y) == DifferenceDFA(x, y).is_dead(DifferenceDFA(x, y).start)
+    assert x.intersects(y) == (
+        not IntersectionDFA(x, y).is_dead(IntersectionDFA(x, y).start)
+    )
+    assert x.is_subset(y) == (x.minimize().equivalent(IntersectionDFA(x, y)))
+
+
+class AgreementDFA(ProductDFA):
+    """Matches the strings that both or neither of left and right match.
+    Every pair of states can lead to a match, so this relies on the
+    default is_dead_pair."""
+
+    def combine(self, left_accepting, right_accepting):
+        return left_accepting == right_accepting
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), dfas())
+def test_product_without_dead_pairs(x, y):
+    agreement = AgreementDFA(x, y)
+    assert not agreement.is_dead_pair(DEAD, DEAD)
+    assert agreement.equivalent(ComplementDFA(SymmetricDifferenceDFA(x, y)))
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_shortest_string_is_first_matching_string(dfa):
+    assert dfa.shortest_string() == next(dfa.all_matching_strings(), None)
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), st.integers(0, 3))
+def test_rank_and_unrank_follow_enumeration(dfa, length):
+    for d in [dfa, ComplementDFA(dfa)]:
+        strings = list(itertools.islice(d.all_matching_strings_of_length(length), 50))
+        for i, s in enumerate(strings):
+            assert d.rank(s) == i
+            assert d.unrank(length, i) == s
+        with pytest.raises(IndexError):
+            d.unrank(length, d.count_strings(d.start, length))
+        with pytest.raises(IndexError):
+            d.unrank(length, -1)
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), st.binary(max_size=3))
+def test_rank_counts_smaller_matching_strings(dfa, s):
+    smaller = itertools.takewhile(
+        lambda t: t < s, dfa.all_matching_strings_of_length(len(s))
+    )
+    assert dfa.rank(s) == sum(1 for _ in smaller)
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), st.binary(max_size=3))
+def test_enumeration_resumes_after_any_string(dfa, s):
+    def shortlex(t):
+        return (len(t), t)
+
+    expected = itertools.islice(
+        (t for t in dfa.all_matching_strings() if shortlex(t) > shortlex(s)), 20
+    )
+    resumed = itertools.islice(dfa.all_matching_strings(after=s), 20)
+    assert list(resumed) == list(expected)
+
+
+def test_complement_of_dead_state_is_not_dead():
+    # Matches every string containing a non-zero byte.
+    complement = ComplementDFA(ConcreteDFA([[(0, 0)]], {0}))
+    assert complement.rank(b"\x02\x05") == 516
+    resumed = complement.all_matching_strings_of_length(2, after=b"\x02\x05")
+    assert next(resumed) == b"\x02\x06"
+    assert complement.shortest_completion(complement.transition(0, 1)) == b""
+    assert complement.shortest_completion(DEAD) is None
+    assert ComplementDFA(complement).transition(0, 1) == DEAD
+    assert list(MultiPatternDFA([complement]).scan(b"\x01\x00")) == [
+        (0, 0, 1),
+        (0, 0, 2),
+    ]
+
+
+def test_can_jump_to_the_millionth_string():
+    dfa = ConcreteDFA([{c: i + 1 for c in range(256)} for i in range(4)] + [{}], {4})
+    s = dfa.unrank(4, 10**6)
+    assert s == (10**6).to_bytes(4, "big")
+    assert dfa.rank(s) == 10**6
+    assert next(dfa.all_matching_strings(after=s)) == (10**6 + 1).to_bytes(4, "big")
+
+
+def test_enumeration_of_length_after_its_last_string():
+    dfa = ConcreteDFA([{0: 1, 1: 1}, {0: 2}, {}], {1, 2})
+    assert list(dfa.all_matching_strings_of_length(1, after=b"\0")) == [b"\1"]
+    assert list(dfa.all_matching_strings_of_length(1, after=b"\1")) == []
+    assert list(dfa.all_matching_strings_of_length(1, after=b"\1\0")) == []
+    assert list(dfa.all_matching_strings_of_length(2, after=b"\1")) == [
+        b"\0\0",
+        b"\1\0",
+    ]
+
+
+@settings(max_examples=20, deadline=None)
+@given(dfas(), st.booleans())
+def test_dfas_can_be_pickled(dfa, shared):
+    dfa.configure_caches(shared=shared)
+    dfa.max_length(dfa.start)
+    for d in [dfa, dfa.compile(), UnionDFA(dfa, ComplementDFA(dfa.compile()))]:
+        copy = pickle.loads(pickle.dumps(d))
+        assert copy.cache_info() == {}
+        assert copy.equivalent(d)
+        assert list(itertools.islice(copy.all_matching_strings(), 5)) == list(
+            itertools.islice(d.all_matching_strings(), 5)
+        )
+
+
+def test_parallel_matching_strings_agrees_with_serial():
+    # Matches strings of up to three bytes from 0-4, ending in 0 or 1.
+    # State 2 * i + j has read i bytes, and j is whether the last was 0 or 1.
+    dfa = ConcreteDFA(
+        [
+            {c: 2 * (i // 2) + 2 + (c < 2) for c in range(5)} if i < 6 else {}
+            for i in range(8)
+        ],
+        {1, 3, 5, 7},
+    )
+    expected = list(dfa.all_matching_strings())
+    ordered = list(dfa.parallel_matching_strings(processes=2, chunk_size=7))
+    assert ordered == expected
+    unordered = dfa.parallel_matching_strings(processes=2, chunk_size=7, ordered=False)
+    assert sorted(unordered) == sorted(expected)
+    assert list(dfa.parallel_matching_strings(2, 2, processes=2, chunk_size=3)) == [
+        s for s in expected if len(s) == 2
+    ]
+    complement = ComplementDFA(dfa)
+    assert list(
+        complement.parallel_matching_strings(2, 2, processes=2, chunk_size=1000)
+    ) == list(complement.all_matching_strings_of_length(2))
+
+
+def test_parallel_matching_strings_needs_bound_when_infinite():
+    dfa = ConcreteDFA([{0: 0}], {0})
+    with pytest.raises(ValueError):
+        next(dfa.parallel_matching_strings(processes=1))
+    assert list(dfa.parallel_matching_strings(max_length=3, processes=1)) == [
+        bytes(n) for n in range(4)
+    ]
+
+
+def test_parallel_matching_strings_rejects_empty_chunks():
+    dfa = ConcreteDFA([{0: 1}, {}], {1})
+    with pytest.raises(ValueError):
+        next(dfa.parallel_matching_strings(processes=1, chunk_size=0))
+
+
+def test_parallel_matching_strings_with_default_processes():
+    dfa = ConcreteDFA([{0: 1, 1: 1}, {}], {1})
+    assert list(dfa.parallel_matching_strings()) == [b"\0", b"\1"]
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), dfas())
+def test_distinguishing_string_is_shortest_difference(x, y):
+    difference = SymmetricDifferenceDFA(x, y)
+    s = x.distinguishing_string(y)
+    assert s == difference.shortest_string()
+    assert x.equivalent(y) == (s is None)
+    # ComplementDFA hides the tables, so this checks the general case
+    # agrees with the one working directly on them.
+    assert ComplementDFA(x).equivalent(ComplementDFA(y)) == (s is None)
+    assert ComplementDFA(x).distinguishing_string(ComplementDFA(y)) == s
+    if s is not None:
+        assert x.matches(s) != y.matches(s)
+        for k in range(len(s)):
+            assert not difference.has_strings(difference.start, k)
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_no_distinguishing_string_from_equivalent_dfas(dfa):
+    assert dfa.distinguishing_string(dfa.minimize()) is None
+    assert dfa.compile().distinguishing_string(dfa.canonicalise()) is None
+    # distinguishing_string checks equivalence before searching, so this
+    # is the only way the search itself can come up empty.
+    flat = dfa.compile()
+    assert dfa_module.flat_distinguishing_string(flat, flat) is None
+
+
+def test_distinguishing_string_is_shortlex_least():
+    # x matches any string of length two, and y matches \0 followed by
+    # any byte, or the single byte \1.
+    x = ConcreteDFA([{c: 1 for c in range(256)}, {c: 2 for c in range(256)}, {}], {2})
+    y = ConcreteDFA([{0: 1, 1: 2}, {c: 3 for c in range(256)}, {}, {}], {2, 3})
+    assert x.distinguishing_string(y) == bytes([1])
+    assert y.distinguishing_string(x) == bytes([1])
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_shortest_completion_of_every_state(dfa):
+    transitions = [list(dfa.raw_transitions(i)) for i in range(len(dfa))]
+    accepting = {i for i in range(len(dfa)) if dfa.is_accepting(i)}
+    for i in range(len(dfa)):
+        expected = ConcreteDFA(transitions, accepting, start=i).shortest_string()
+        assert dfa.shortest_completion(i) == expected
+        if expected is None:
+            assert dfa.distance_to_accept(i) == inf
+        else:
+            assert dfa.distance_to_accept(i) == len(expected)
+    assert dfa.shortest_completion(DEAD) is None
+    assert dfa.distance_to_accept(DEAD) == inf
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_shortest_completion_of_lazy_dfa(dfa):
+    complement = ComplementDFA(dfa)
+    assert complement.shortest_completion(complement.start) == (
+        complement.shortest_string()
+    )
+    transitions = [list(dfa.raw_transitions(i)) for i in range(len(dfa))]
+    accepting = {i for i in range(len(dfa)) if dfa.is_accepting(i)}
+    for i in range(len(dfa)):
+        restarted = ComplementDFA(ConcreteDFA(transitions, accepting, start=i))
+        assert complement.shortest_completion(i) == restarted.shortest_string()
+    assert complement.shortest_completion(UNIVERSAL) == b""
+    assert complement.distance_to_accept(DEAD) == inf
+
+
+def test_shortest_completion_uses_smallest_byte_in_class():
+    # The list puts the larger bytes first, but \0 is still the answer.
+    dfa = ConcreteDFA([[(3, 5, 1), (0, 1)], []], {1})
+    assert dfa.shortest_completion(0) == bytes([0])
+
+
+def test_product_only_explores_what_it_needs():
+    # Matches strings starting with a zero byte, and any string.
+    starts_with_zero = ConcreteDFA([{0: 1}, {c: 1 for c in range(256)}], {1})
+    everything = ConcreteDFA([{c: 0 for c in range(256)}], {0})
+    product = IntersectionDFA(starts_with_zero, everything)
+    assert product.intersects(everything)
+    assert product.transition(product.start, 1) == DEAD
+    assert not product.is_subset(ComplementDFA(everything))
+
+
+@settings(max_examples=50)
+@given(dfas(), st.integers(0, 5), st.randoms(use_true_random=False))
+def test_samples_are_matched(dfa, length, random):
+    if dfa.has_strings(dfa.start, length):
+        for s in dfa.sample_many(length, 5, random):
+            assert len(s) == length
+            assert dfa.matches(s)
+    else:
+        with pytest.raises(ValueError):
+            dfa.sample(length, random)
+
+
+def test_samples_are_uniform():
+    # Matches \0 followed by any byte in 0-3, or 1 followed by 0, so
+    # a non-uniform sampler that picked each first byte with equal
+    # probability would produce b"\1\0" far too often.
+    dfa = ConcreteDFA([{0: 1, 1: 2}, [(0, 3, 3)], {0: 3}, {}], {3})
+    counts = Counter(dfa.sample_many(2, 5000, Random(0)))
+    assert set(counts) == {b"\0\0", b"\0\1", b"\0\2", b"\0\3", b"\1\0"}
+    for count in counts.values():
+        assert 800 <= count <= 1200
+
+
+@settings(max_examples=50)
+@given(dfas(), st.lists(st.binary(max_size=10), max_size=10))
+def test_stored_dfa_round_trips(dfa, strings):
+    compiled = dfa.compile()
+    loaded = CompiledDFA.from_buffer(compiled.to_bytes())
+    assert len(loaded) == len(compiled)
+    assert loaded.start == compiled.start
+    assert loaded.byte_classes() == compiled.byte_classes()
+    for s in strings:
+        assert loaded.matches(s) == dfa.matches(s)
+
+
+def test_stored_dfa_is_loaded_in_place(tmp_path):
+    dfa = ConcreteDFA([{c: (i + 1) % 300 for c in range(10)} for i in range(300)], {0})
+    path = tmp_path / "dfa"
+    dfa.compile().save(path)
+    loaded = CompiledDFA.load(path)
+    assert isinstance(loaded.table, memoryview)
+    assert loaded.table.format == "H"
+    assert loaded.matches(bytes(300))
+    assert not loaded.matches(bytes(299))
+    assert loaded.equivalent(dfa)
+
+
+def test_stored_dfa_with_other_byte_order():
+    compiled = ConcreteDFA([{0: i + 1} for i in range(300)] + [{}], {300}).compile()
+    data = bytearray(compiled.to_bytes())
+    table_size = len(compiled.table) * compiled.table.itemsize
+    swapped = array(compiled.table.typecode, compiled.table)
+    swapped.byteswap()
+    data[-table_size:] = swapped.tobytes()
+    data[5] = 1 - data[5]
+    loaded = CompiledDFA.from_buffer(data)
+    assert loaded.matches(bytes(300))
+    assert not loaded.matches(bytes(299))
+
+
+@pytest.mark.parametrize(
+    "data", [b"", b"JDFA", b"XDFA" + bytes(300), b"JDFA\2" + bytes(300)]
+)
+def test_invalid_stored_dfas(data):
+    with pytest.raises(ValueError):
+        CompiledDFA.from_buffer(data)
+
+
+@pytest.mark.parametrize(
+    "index, value, padding",
+    [
+        # An unknown byte order.
+        (5, 2, 0),
+        # An item size with no array type, with a table of the right size.
+        (6, 3, 8),
+        # A start state past the last state.
+        (16, 2, 0),
+        # A transition to a state past the last state.
+        (-1, 2, 0),
+    ],
+)
+def test_corrupt_stored_dfas(index, value, padding):
+    data = bytearray(ConcreteDFA([{0: 0}], {0}).compile().to_bytes())
+    data[index] = value
+    data += bytes(padding)
+    with pytest.raises(ValueError):
+        CompiledDFA.from_buffer(data)
+
+
+def test_truncated_stored_dfa():
+    data = ConcreteDFA([{0: 0}], {0}).compile().to_bytes()
+    with pytest.raises(ValueError):
+        CompiledDFA.from_buffer(data[:-1])
+
+
+def test_compiled_dfa_validates_byte_classes():
+    with pytest.raises(ValueError):
+        CompiledDFA(bytes(2), b"\0", classes=bytes(10))
+    with pytest.raises(ValueError):
+        CompiledDFA(bytes(2), b"\0", classes=bytes([1] + [0] * 255))
+
+
+@settings(max_examples=50)
+@given(dfas(), st.integers(0, 30))
+def test_string_counter_agrees_with_count_strings(dfa, length):
+    counter = dfa.string_counter()
+    expected = dfa.count_strings(dfa.start, length)
+    assert counter.count(length) == expected
+    assert counter.count(length, modulus=7) == expected % 7
+    assert counter.has_strings(length) == dfa.has_strings(dfa.start, length)
+    if expected:
+        assert counter.log_count(length) == pytest.approx(math.log(expected))
+    else:
+        assert counter.log_count(length) == -inf
+
+
+def test_string_counter_at_huge_lengths():
+    # Matches strings of even length
+    dfa = ConcreteDFA([[(0, 255, 1)], [(0, 255, 0)]], {0})
+    counter = dfa.string_counter()
+    assert counter.count(10**5) == 256 ** (10**5)
+    assert counter.count(10**5 + 1) == 0
+    assert counter.count(10**18, modulus=1000) == pow(256, 10**18, 1000)
+    assert counter.count(10**18, modulus=2**62) == pow(256, 10**18, 2**62)
+    assert counter.log_count(10**9) == pytest.approx(10**9 * math.log(256))
+    assert counter.has_strings(10**18)
+    assert not counter.has_strings(10**18 + 1)
+
+
+def test_string_counter_from_other_states():
+    dfa = ConcreteDFA([{0: 1}, {0: 2, 1: 2}, {}, {}], {2, 3})
+    counter = dfa.string_counter()
+    assert len(counter) == 3
+    assert counter.count(1, state=1) == 2
+    assert counter.count(1, state=DEAD) == 0
+    assert counter.log_count(1, state=DEAD) == -inf
+    assert not counter.has_strings(0, state=DEAD)
+    with pytest.raises(ValueError):
+        counter.count(0, state=3)
+    with pytest.raises(ValueError):
+        counter.count(0, modulus=0)
+
+
+def test_string_counter_without_transitions():
+    counter = ConcreteDFA([{}], {0}).string_counter()
+    assert counter.count(0) == 1
+    # Short enough to be counted one layer at a time.
+    assert counter.count(2) == 0
+    assert counter.log_count(2) == -inf
+
+
+# A long chain of states in front makes the counter work one layer at a
+# time rather than by repeated squaring.
+@pytest.mark.parametrize("chain", [0, 30])
+@pytest.mark.parametrize("length", [200, 1000])
+def test_log_count_of_small_count_next_to_huge_one(chain, length):
+    b = ord("b")
+    transitions = [[(0, 255, i + 1)] for i in range(chain)] + [
+        [(0, b - 1, chain), (b, b, chain + 1), (b + 1, 255, chain)],
+        {ord("a"): chain + 1},
+    ]
+    counter = ConcreteDFA(transitions, {chain, chain + 1}).string_counter()
+    # One state accepts nearly 256 ** length strings and the other only
+    # accepts a single one.
+    assert counter.log_count(length, state=chain + 1) == 0.0
+    assert counter.log_count(length, state=chain) == pytest.approx(
+        math.log(counter.count(length, state=chain))
+    )
+
+
+@settings(max_examples=50, deadline=None)
+@given(dfas(), st.sampled_from([1, 3]), st.booleans())
+def test_bounded_caches_give_same_answers(dfa, max_size, shared):
+    bounded = ConcreteDFA(
+        [dict(dfa.raw_transitions(i)) for i in range(len(dfa))],
+        {i for i in range(len(dfa)) if dfa.is_accepting(i)},
+        dfa.start,
+    )
+    bounded.configure_caches(shared=shared, max_size=max_size)
+    for i in range(len(dfa)):
+        assert bounded.is_dead(i) == dfa.is_dead(i)
+        assert bounded.max_length(i) == dfa.max_length(i)
+        for n in range(4):
+            assert bounded.count_strings(i, n) == dfa.count_strings(i, n)
+            assert bounded.has_strings(i, n) == dfa.has_strings(i, n)
+    for info in bounded.cache_info().values():
+        assert info.size <= max_size
+
+
+def test_cache_info_and_clearing():
+    dfa = ConcreteDFA([{0: 1}, {0: 2}, {}], {2})
+    dfa.configure_caches(max_sizes={"count_strings": 1})
+    dfa.count_strings(0, 2)
+    dfa.count_strings(0, 2)
+    info = dfa.cache_info()
+    assert info["count_strings"].size == 1
+    assert info["count_strings"].max_size == 1
+    assert info["count_strings"].hits >= 1
+    assert info["is_live"].max_size is None
+    dfa.clear_caches()
+    assert dfa.cache_info() == {}
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_caches_across_threads(shared):
+    dfa = ConcreteDFA([{0: i + 1} for i in range(100)] + [{}], {100})
+    dfa.configure_caches(shared=shared)
+    results = []
+
+    def work():
+        results.append(dfa.max_length(dfa.start))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [100] * 4
+    # The main thread only sees the caches if they are shared.
+    assert ("max_length" in dfa.cache_info()) == shared
+
+
+@settings(max_examples=50)
+@given(st.lists(dfas() | dfas().map(ComplementDFA), max_size=4), st.binary(max_size=20))
+def test_scan_agrees_with_all_matching_regions(patterns, string):
+    scanner = MultiPatternDFA(patterns)
+    results = list(scanner.scan(string))
+    assert results == sorted(results, key=lambda m: (m[2], m[1], m[0]))
+    assert sorted(results) == sorted(
+        (pattern_id, u, v)
+        for pattern_id, pattern in enumerate(patterns)
+        for u, v in pattern.all_matching_regions(string)
+    )
+
+
+@settings(max_examples=50)
+@given(st.lists(dfas(), min_size=1, max_size=3), st.binary(max_size=10))
+def test_multi_pattern_dfa_matches_union(patterns, string):
+    scanner = MultiPatternDFA(patterns)
+    state = scanner.start
+    for c in string:
+        state = scanner.transition(state, c)
+    assert scanner.accepted_patterns(state) == tuple(
+        i for i, pattern in enumerate(patterns) if pattern.matches(string)
+    )
+    assert scanner.matches(string) == any(p.matches(string) for p in patterns)
+    classes = scanner.byte_classes()
+    representatives = scanner.class_representatives()
+    for c in range(256):
+        assert scanner.transition(scanner.start, c) == scanner.transition(
+            scanner.start, representatives[classes[c]]
+        )
+
+
+def test_scan_reports_overlapping_patterns():
+    scanner = MultiPatternDFA(
+        [
+            ConcreteDFA.from_regex(rb"ERROR"),
+            ConcreteDFA.from_regex(rb"[A-Z]+"),
+            ConcreteDFA.from_regex(rb"[0-9]+"),
+        ]
+    )
+    results = set(scanner.scan(b"ERROR 42"))
+    assert (0, 0, 5) in results
+    assert (1, 0, 5) in results
+    assert (1, 2, 4) in results
+    assert (2, 6, 8) in results
+    assert (0, 1, 5) not in results
+    assert not any(pattern_id == 2 and u < 6 for pattern_id, u, _ in results)
+
+
+def test_patterns_that_die_do_not_multiply_states():
+    # The first pattern matches "a", and has two different dead states.
+    first = ConcreteDFA([{ord("a"): 1, ord("b"): 2, ord("c"): 3}, {}, {}, {}], {1})
+    scanner = MultiPatternDFA([first, ConcreteDFA.from_regex(b"[a-z]*")])
+    after = scanner.transition(scanner.start, ord("b"))
+    assert scanner.transition(scanner.start, ord("c")) == after
+    assert scanner.transition(after, ord("c")) == after
+    assert scanner.accepted_patterns(after) == (1,)
+    assert MultiPatternDFA([]).start == DEAD
+
+
+@settings(max_examples=50)
+@given(dfas(), st.binary(max_size=100))
+def test_run_all_agrees_with_run(dfa, string):
+    compiled = dfa.compile()
+    assert list(compiled.run_all(string)) == [
+        compiled.run(string, i) for i in range(len(compiled))
+    ]
+
+
+@pytest.mark.parametrize("table_items", [0, 100, 10**6])
+@pytest.mark.parametrize("block_items", [1, 7, 10**6])
+def test_run_all_with_limits(monkeypatch, table_items, block_items):
+    monkeypatch.setattr(dfa_module, "RUN_ALL_TABLE_ITEMS", table_items)
+    monkeypatch.setattr(dfa_module, "RUN_ALL_BLOCK_ITEMS", block_items)
+    dfa = ConcreteDFA.from_regex(rb"(?:ab|c)*d?").compile()
+    string = b"abcab" * 10 + b"d"
+    assert list(dfa.run_all(string)) == [dfa.run(string, i) for i in range(len(dfa))]
+
+
+@settings(max_examples=50)
+@given(dfas(), st.binary(max_size=30), st.integers(0, 19))
+def test_accepting_positions(dfa, string, state):
+    compiled = dfa.compile()
+    assume(state < len(compiled))
+    assert list(compiled.accepting_positions(string, state)) == [
+        p
+        for p in range(len(string) + 1)
+        if compiled.is_accepting(compiled.run(string[:p], state))
+    ]
+
+
+PARALLEL_DFA = ConcreteDFA.from_regex(rb"(?:[a-z]+ [0-9]+\n)*")
+PARALLEL_INPUT = b"".join(b"abc %d\n" % i for i in range(500))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 10**6])
+def test_parallel_scanning_agrees_with_serial(chunk_size):
+    compiled = PARALLEL_DFA.compile()
+    for data in [PARALLEL_INPUT, PARALLEL_INPUT + b"x", b""]:
+        kwargs = dict(processes=2, chunk_size=chunk_size)
+        assert compiled.parallel_run(data, **kwargs) == compiled.run(data)
+        assert PARALLEL_DFA.parallel_matches(data, **kwargs) == PARALLEL_DFA.matches(
+            data
+        )
+        assert list(
+            PARALLEL_DFA.parallel_accepting_positions(data[:200], **kwargs)
+        ) == list(compiled.accepting_positions(data[:200]))
+    assert compiled.parallel_run(b"1", state=5, processes=1) == compiled.run(b"1", 5)
+    assert list(compiled.parallel_accepting_positions(b"1\n", state=5)) == list(
+        compiled.accepting_positions(b"1\n", 5)
+    )
+
+
+def test_parallel_scanning_of_files(tmp_path):
+    path = tmp_path / "input"
+    path.write_bytes(PARALLEL_INPUT)
+    compiled = PARALLEL_DFA.compile()
+    assert compiled.parallel_matches(path, processes=2, chunk_size=1000)
+    assert list(
+        compiled.parallel_accepting_positions(str(path), processes=2, chunk_size=999)
+    ) == list(compiled.accepting_positions(PARALLEL_INPUT))
+    empty = tmp_path / "empty"
+    empty.write_bytes(b"")
+    assert compiled.parallel_matches(empty, processes=1)
+
+
+def test_parallel_scanning_needs_positive_chunk_size():
+    with pytest.raises(ValueError):
+        PARALLEL_DFA.parallel_matches(b"", chunk_size=0)
+
+
+def levenshtein(s, t):
+    row = list(range(len(t) + 1))
+    for i, c in enumerate(s, 1):
+        previous, row[0] = row[0], i
+        for j, d in enumerate(t, 1):
+            previous, row[j] = row[j], min(
+                row[j] + 1, row[j - 1] + 1, previous + (c != d)
+            )
+    return row[-1]
+
+
+@st.composite
+def small_alphabet_dfas(draw):
+    states = draw(st.integers(1, 6))
+    a_state = st.integers(0, states - 1)
+    transitions = [
+        draw(st.dictionaries(st.integers(0, 2), a_state)) for _ in range(states)
+    ]
+    return ConcreteDFA(transitions, draw(st.sets(a_state)), draw(a_state))
+
+
+def edit_distance_model(dfa, s, k):
+    candidates = [
+        t
+        for length in range(len(s) + k + 1)
+        for t in dfa.all_matching_strings_of_length(length)
+    ]
+    return min(
+        (d for d in map(lambda t: levenshtein(s, t), candidates) if d <= k),
+        default=None,
+    )
+
+
+@settings(max_examples=100, deadline=None)
+@given(
+    small_alphabet_dfas(),
+    st.lists(st.integers(0, 3), max_size=5).map(bytes),
+    st.integers(0, 2),
+)
+def test_edit_distance_agrees_with_model(dfa, s, k):
+    expected = edit_distance_model(dfa, s, k)
+    assert dfa.edit_distance(s, k) == expected
+    assert DFA.edit_distance(dfa, s, k) == expected
+    assert dfa.compile().edit_distance(s, k) == expected
+    assert dfa.matches_within(s, k) == (expected is not None)
+
+
+@settings(max_examples=50, deadline=None)
+@given(
+    small_alphabet_dfas(),
+    st.lists(st.integers(0, 3), max_size=6).map(bytes),
+    st.integers(0, 2),
+)
+def test_search_within_agrees_with_model(dfa, s, k):
+    expected = []
+    for v in range(len(s) + 1):
+        distances = [edit_distance_model(dfa, s[u:v], k) for u in range(v + 1)]
+        distances = [d for d in distances if d is not None]
+        if distances:
+            expected.append((v, min(distances)))
+    assert list(dfa.search_within(s, k)) == expected
+    assert list(DFA.search_within(dfa, s, k)) == expected
+
+
+def test_approximate_matching_of_regex():
+    dfa = ConcreteDFA.from_regex(rb"colou?r|grey")
+    assert dfa.matches_within(b"color", 0)
+    assert dfa.edit_distance(b"colr", 2) == 1
+    assert dfa.edit_distance(b"gray", 2) == 1
+    assert dfa.edit_distance(b"grayish", 2) is None
+    assert not dfa.matches_within(b"grayish", 2)
+    ends = dict(dfa.search_within(b"the colr is grey", 1))
+    assert ends[8] == 1
+    assert ends[16] == 0
+    assert 3 not in ends
+
+
+def test_approximate_matching_of_large_dfa():
+    # Too many states to use bitmasks, so this takes the general path.
+    dfa = ConcreteDFA([{0: i + 1} for i in range(300)] + [{}], {300})
+    assert dfa.edit_distance(bytes(299), 2) == 1
+    assert dfa.edit_distance(bytes(297), 2) is None
+    assert dfa.compile().edit_distance(bytes(302), 2) == 2
+    assert list(dfa.search_within(bytes(299), 1)) == [(299, 1)]
+
+
+def test_approximate_matching_of_wide_dfa():
+    # Few states, but there are a hundred byte classes, so the tables for
+    # using bitmasks would be too large.
+    dfa = ConcreteDFA(
+        [{c: (i + c) % 100 for c in range(256)} for i in range(100)], {50}
+    )
+    assert not dfa_module.uses_bit_parallel(dfa)
+    assert dfa.edit_distance(bytes([49]), 1) == 1
+    assert dfa.compile().edit_distance(bytes([150]), 1) == 0
+    assert list(dfa.compile().search_within(bytes([25, 25, 1]), 0)) == [(2, 0)]
+
+
+def test_edit_distance_must_be_non_negative():
+    with pytest.raises(ValueError):
+        ConcreteDFA([{}], {0}).edit_distance(b"", -1)
+    with pytest.raises(ValueError):
+        ConcreteDFA([{}], {0}).compile().edit_distance(b"", -1)
+    with pytest.raises(ValueError):
+        ComplementDFA(ConcreteDFA([{}], {0})).edit_distance(b"", -1)
+
+
+@settings(max_examples=50)
+@given(dfas())
+def test_viable_bytes(dfa):
+    compiled = dfa.compile()
+    states = list(range(len(dfa)))
+    expected = [
+        [not dfa.is_dead(dfa.transition(i, c)) for c in range(256)] for i in states
+    ]
+    assert [list(dfa.viable_bytes(i)) for i in states] == expected
+    assert dfa.viable_bytes_many(states).tolist() == expected
+    assert compiled.viable_bytes_many(states).tolist() == expected
+    assert [list(compiled.viable_bytes(i)) for i in states] == expected
+    assert dfa.viable_bytes_many([]).shape == (0, 256)
+
+
+@settings(max_examples=50)
+@given(
+    dfas(),
+    st.lists(st.lists(st.sampled_from(b"\0\1\2ab"), max_size=4).map(bytes)),
+)
+def test_viable_tokens(dfa, tokens):
+    masker = dfa.token_masker(tokens)
+    assert len(masker) == len(tokens)
+    states = [DEAD, *range(len(dfa))]
+    expected = []
+    for state in states:
+        row = []
+        for token in tokens:
+            expected_state = state
+            for c in token:
+                expected_state = dfa.transition(expected_state, c)
+            row.append(not dfa.is_dead(expected_state))
+        expected.append(row)
+    assert [list(masker.viable_tokens(state)) for state in states] == expected
+    assert masker.viable_tokens_many(states).tolist() == expected
+    assert (
+        dfa.compile().token_masker(tokens).viable_tokens_many(range(len(dfa))).tolist()
+        == expected[1:]
+    )
+
+
+def test_viable_tokens_for_regex():
+    dfa = ConcreteDFA.from_regex(rb"\{\"[a-z]+\": [0-9]+\}")
+    tokens = [b"{", b'{"', b'{"a', b"1", b'": ', b"}", b"", b"{{"]
+    masker = dfa.token_masker(tokens, cache_size=2)
+    assert masker.viable_tokens(dfa.start).tolist() == (
+        [True, True, True, False, False, False, True, False]
+    )
+    state = dfa.start
+    for c in b'{"ab':
+        state = dfa.transition(state, c)
+    assert masker.viable_tokens(state).tolist() == (
+        [False, False, False, False, True, False, True, False]
+    )
+    assert masker.viable_tokens(state) is masker.viable_tokens(state)
+    assert not masker.viable_tokens(state).flags.writeable
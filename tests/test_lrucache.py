@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from hypothesis import given, strategies as st
+from drmaciver_junkdrawer.lrucache import CacheInfo, LRUCache
+
+
+@given(
+    st.integers(0, 5),
+    st.lists(st.tuples(st.booleans(), st.integers(0, 10), st.integers())),
+)
+def test_behaves_like_a_bounded_dict(max_size, operations):
+    cache = LRUCache(max_size=max_size)
+    # Most recently used keys go at the end.
+    model = {}
+    for is_write, key, value in operations:
+        if is_write:
+            cache[key] = value
+            model.pop(key, None)
+            model[key] = value
+            while len(model) > max_size:
+                del model[next(iter(model))]
+        else:
+            assert cache.get(key) == model.get(key)
+            if key in model:
+                model[key] = model.pop(key)
+        assert len(cache) == len(model)
+        for k in range(11):
+            assert (k in cache) == (k in model)
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache[1] = 1
+    cache[2] = 2
+    assert cache[1] == 1
+    cache[3] = 3
+    assert 1 in cache
+    assert 2 not in cache
+    assert 3 in cache
+
+
+def test_counts_hits_and_misses():
+    cache = LRUCache()
+    cache[1] = 1
+    assert cache.get(1) == 1
+    assert cache.get(2) is None
+    with pytest.raises(KeyError):
+        cache[3]
+    assert cache.setdefault(1, 2) == 1
+    assert cache.cache_info() == CacheInfo(hits=1, misses=2, max_size=None, size=1)
+    cache.clear()
+    assert cache.cache_info() == CacheInfo(hits=1, misses=2, max_size=None, size=0)
+
+
+def test_update_and_setdefault():
+    cache = LRUCache(max_size=2)
+    cache.update({1: 1, 2: 2, 3: 3})
+    assert 1 not in cache
+    assert cache.setdefault(4, 4) == 4
+    assert 2 not in cache
+
+
+def test_zero_size_cache_stores_nothing():
+    cache = LRUCache(max_size=0)
+    cache[1] = 1
+    assert len(cache) == 0
+    assert cache.setdefault(1, 2) == 2
+
+
+def test_rejects_negative_size():
+    with pytest.raises(ValueError):
+        LRUCache(max_size=-1)
+
+
+def test_can_be_shared_between_threads():
+    cache = LRUCache(max_size=50, thread_safe=True)
+
+    def work(offset):
+        for i in range(1000):
+            cache[offset + i] = i
+            cache.get(offset + i // 2)
+
+    threads = [threading.Thread(target=work, args=(1000 * t,)) for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    info = cache.cache_info()
+    assert info.size == 50
+    assert info.hits + info.misses == 4000
@@ -240,3 +240,23 @@ def test_cannot_reuse_dfa():
     x.learn(bytes(3))
     with pytest.raises(StaleDFA):
         dfa.start
+
+
+def test_matches_many_on_learned_dfa():
+    learner = LStar(lambda s: len(s) >= 3)
+    learner.learn(bytes(3))
+    strings = [bytes(n) for n in range(6)] + [b"\0\1", b"\1\1\1"]
+    assert list(learner.dfa.matches_many(strings)) == [
+        learner.dfa.matches(s) for s in strings
+    ]
+
+
+def test_learned_byte_classes_follow_normalizer():
+    learner = LStar(lambda s: len(s) == 1 and 10 <= s[0] < 20)
+    learner.learn(b"\x0a")
+    learner.learn(b"\x14")
+    dfa = learner.dfa
+    assert dfa.class_representatives() == tuple(learner.normalizer.representatives())
+    for c in range(256):
+        representative = dfa.class_representatives()[dfa.byte_classes()[c]]
+        assert learner.normalizer.normalize(c) == representative